@@ -1,6 +1,8 @@
-from utils import read_multi, write_multi, mutate_index, utilrandom as random, Substitution
-from itemrandomizer import get_ranked_items, get_item
+from utils import (read_multi, write_multi, mutate_index, utilrandom as random,
+                   Substitution, open_rom)
+from itemrandomizer import get_item, get_item_catalogue
 from formationrandomizer import get_formations, get_fsets
+from records import deepcopy_slots
 
 valid_ids = list(range(1, 0x200))
 banned_formids = [0]
@@ -133,6 +135,11 @@ def mark_taken_id(taken):
 
 
 class ChestBlock:
+    __slots__ = ["pointer", "location", "chestid", "position", "memid",
+                 "contenttype", "contents", "oldid", "value", "rank",
+                 "do_not_mutate", "ignore_dummy"]
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, pointer, location):
         self.pointer = pointer
         self.location = location
@@ -147,7 +154,7 @@ class ChestBlock:
     def read_data(self, filename):
         global extra_miabs
 
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.position = read_multi(f, length=2)
         self.memid = ord(f.read(1))
@@ -238,10 +245,9 @@ class ChestBlock:
 
     def get_current_value(self, guideline=None):
         if self.treasure:
-            items = get_ranked_items()
-            itemids = [i.itemid for i in items]
+            items = get_item_catalogue()
             try:
-                index = itemids.index(self.contents)
+                index = items.index(self.contents)
                 value = items[index].rank() // 100
             except ValueError:
                 value = 100
@@ -293,16 +299,16 @@ class ChestBlock:
         else:
             value = self.get_current_value(guideline=guideline)
 
-        items = get_ranked_items()
-        itemids = [i.itemid for i in items]
+        catalogue = get_item_catalogue()
+        items = list(catalogue.objects)
         if self.treasure:
             try:
-                index = itemids.index(self.contents)
+                index = catalogue.index(self.contents)
             except ValueError:
                 index = 0
             indexed_item = items[index]
         else:
-            lowpriced = [i for i in items if i.rank() <= value*100]
+            lowpriced = items[:catalogue.count_upto(value*100)]
             if not lowpriced:
                 lowpriced = items[:random.randint(1, 16)]
             index = max(0, len(lowpriced)-1)
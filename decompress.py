@@ -1,68 +1,173 @@
 #!/usr/bin/env python3
 
-from utils import read_multi, write_multi
-from sys import argv
+from utils import write_multi, get_rom_image
+from sys import argv, exit
 from shutil import copyfile
 
 
+BUFFER_SIZE = 0x800
+BUFFER_START = 0x7DE
+MIN_MATCH = 3
+MAX_MATCH = 34
+MAX_DISTANCE = BUFFER_SIZE - 1
+# The last few bytes of a stream are always stored as literals.
+LITERAL_TAIL = 8
+
+
 def decompress(bytestring, simple=False, complicated=True, debug=False):
-    result = bytearray([])
-    buff = bytearray(2048)
-    buffaddr = 0x7DE
+    if not isinstance(bytestring, (bytes, bytearray, memoryview)):
+        bytestring = bytes(bytestring)
+    source = memoryview(bytestring)
+    size = len(source)
+    result = bytearray()
+    buff = bytearray(BUFFER_SIZE)
+    buffaddr = BUFFER_START
+    cursor = 0
 
-    while bytestring:
-        flags, bytestring = bytestring[0], bytestring[1:]
+    while cursor < size:
+        flags = source[cursor]
+        cursor += 1
         for i in range(8):
-            if not bytestring:
+            if cursor >= size:
                 break
 
             if flags & (1 << i):
-                byte, bytestring = bytestring[0], bytestring[1:]
+                byte = source[cursor]
+                cursor += 1
                 result.append(byte)
                 buff[buffaddr] = byte
-                buffaddr += 1
-                if buffaddr == 0x800:
-                    buffaddr = 0
+                buffaddr = (buffaddr + 1) % BUFFER_SIZE
                 if debug:
-                    print("%x" % ord(byte), end=' ')
-            else:
-                low, high, bytestring = (
-                    bytestring[0], bytestring[1], bytestring[2:])
-                seekaddr = low | ((high & 0x07) << 8)
-                length = ((high & 0xF8) >> 3) + 3
-                if simple:
-                    copied = [buff[seekaddr]] * length
-                elif complicated:
-                    if buffaddr == seekaddr:
-                        raise Exception("buffaddr equals seekaddr")
-                    cycle = buffaddr - seekaddr
-                    if cycle < 0:
-                        cycle += 0x800
-                    subbuff = (buff+buff)[seekaddr:seekaddr+cycle]
-                    while len(subbuff) < length:
-                        subbuff = subbuff + subbuff
-                    copied = subbuff[:length]
-                else:
-                    copied = (buff+buff)[seekaddr:seekaddr+length]
-                assert len(copied) == length
+                    print("%x" % byte, end=' ')
+                continue
+
+            low, high = source[cursor], source[cursor+1]
+            cursor += 2
+            seekaddr = low | ((high & 0x07) << 8)
+            length = ((high & 0xF8) >> 3) + 3
+            if simple:
+                copied = bytes([buff[seekaddr]]) * length
+            elif complicated:
+                if buffaddr == seekaddr:
+                    raise Exception("buffaddr equals seekaddr")
+                # Copying one byte at a time repeats the bytes between
+                # seekaddr and buffaddr when the two ranges overlap.
+                copied = bytearray(length)
+                for j in range(length):
+                    byte = buff[(seekaddr + j) % BUFFER_SIZE]
+                    copied[j] = byte
+                    buff[buffaddr] = byte
+                    buffaddr = (buffaddr + 1) % BUFFER_SIZE
                 result += copied
                 if debug:
                     print("%x" % seekaddr, length, end=' ')
-                while copied:
-                    byte, copied = copied[0], copied[1:]
-                    buff[buffaddr] = byte
-                    buffaddr += 1
-                    if buffaddr == 0x800:
-                        buffaddr = 0
-                    if debug:
-                        print("%x" % ord(byte), end=' ')
+                continue
+            else:
+                copied = bytes(buff[(seekaddr + j) % BUFFER_SIZE]
+                               for j in range(length))
+            result += copied
             if debug:
-                print()
-                import pdb; pdb.set_trace()
+                print("%x" % seekaddr, length, end=' ')
+            for byte in copied:
+                buff[buffaddr] = byte
+                buffaddr = (buffaddr + 1) % BUFFER_SIZE
+        if debug:
+            print()
+    return result
+
+
+def recompress(bytestring, max_chain=256):
+    data = bytes([c if type(c) is int else ord(c) for c in bytestring])
+    if not data:
+        return bytearray()
+
+    # The ring buffer starts out zeroed, so the stream is encoded as if it
+    # were preceded by a full window of zeros.
+    window = bytes(MAX_DISTANCE) + data
+    size = len(window)
+    chains = {}
+
+    def insert(position):
+        if position + MIN_MATCH <= size:
+            key = window[position:position+MIN_MATCH]
+            if key in chains:
+                chains[key].append(position)
+            else:
+                chains[key] = [position]
+
+    def longest_match(position):
+        maxlen = min(MAX_MATCH, size - position)
+        if size - position <= LITERAL_TAIL or maxlen < MIN_MATCH:
+            return 0, None
+        candidates = chains.get(window[position:position+MIN_MATCH])
+        if not candidates:
+            return 0, None
+        lowest = position - MAX_DISTANCE
+        best, source = 0, None
+        for index in range(len(candidates)-1,
+                           max(-1, len(candidates)-1-max_chain), -1):
+            candidate = candidates[index]
+            if candidate < lowest:
+                break
+            length = MIN_MATCH
+            while (length < maxlen and
+                    window[candidate+length] == window[position+length]):
+                length += 1
+            if length > best:
+                best, source = length, candidate
+                if length == maxlen:
+                    break
+        return best, source
+
+    for position in range(MAX_DISTANCE):
+        insert(position)
+
+    tokens = []
+    position = MAX_DISTANCE
+    pending = longest_match(position)
+    while position < size:
+        length, source = pending
+        if length >= MIN_MATCH:
+            insert(position)
+            pending = longest_match(position+1)
+            if pending[0] > length:
+                # A longer match starts at the next byte; defer to it.
+                tokens.append(window[position])
+                position += 1
+                continue
+            address = (source - MAX_DISTANCE + BUFFER_START) % BUFFER_SIZE
+            tokens.append((address, length))
+            for i in range(position+1, position+length):
+                insert(i)
+            position += length
+        else:
+            tokens.append(window[position])
+            insert(position)
+            position += 1
+        pending = longest_match(position)
+
+    result = bytearray()
+    for i in range(0, len(tokens), 8):
+        control = 0x00
+        subresult = bytearray()
+        for bit in range(8):
+            token = tokens[i+bit] if i+bit < len(tokens) else 0
+            if type(token) is int:
+                control |= (1 << bit)
+                subresult.append(token)
+            else:
+                address, length = token
+                subresult.append(address & 0xFF)
+                subresult.append((address >> 8) | ((length-3) << 3))
+        result += bytes([control]) + subresult
+    if control != 0xFF or not subresult.endswith(bytes([0, 0])):
+        result += b'\xFF' + bytes(8)
     return result
 
 
-def recompress(bytestring):
+def recompress_exhaustive(bytestring):
+    # The original brute-force encoder, kept as a baseline for
+    # benchmark_recompress.
     global buffaddr
     bytestring = bytearray([c if type(c) is int else ord(c) for c in bytestring])
     result = bytearray()
@@ -159,11 +264,10 @@ def recompress(bytestring):
 
 
 def decompress_at_location(filename, address):
-    f = open(filename, 'r+b')
-    f.seek(address)
-    size = read_multi(f, length=2)
+    data = get_rom_image(filename).data
+    size = data[address] | (data[address+1] << 8)
     #print "Size is %s" % size
-    bytestring = f.read(size)
+    bytestring = memoryview(data)[address+2:address+2+size]
     decompressed = decompress(bytestring, complicated=True)
     return decompressed
 
@@ -206,7 +310,44 @@ class Decompressor():
         if self.maxaddress and fout.tell() >= self.maxaddress:
             raise Exception("Recompressed data out of bounds.")
 
+def benchmark_recompress(filename=None, repeat=3):
+    # Compares recompress against recompress_exhaustive for speed and size.
+    from random import Random
+    from time import perf_counter
+
+    rng = Random(0)
+    words = [bytes(rng.randrange(0x100) for _ in range(rng.randint(2, 9)))
+             for _ in range(64)]
+    samples = [
+        ("random", bytes(rng.randrange(0x100) for _ in range(0x1000))),
+        ("words", b"".join(rng.choice(words) for _ in range(0x400))),
+        ("runs", b"".join(bytes([rng.randrange(4)]) * rng.randint(1, 40)
+                          for _ in range(0x200))),
+        ]
+    if filename is not None:
+        d = Decompressor(0x2686C, fakeaddress=0x7E5000, maxaddress=0x28A70)
+        d.read_data(filename)
+        samples.append(("field code", bytes(d.data)))
+
+    print("%-12s %-22s %8s %8s %9s  %s" % (
+        "sample", "encoder", "input", "output", "seconds", "roundtrip"))
+    for name, data in samples:
+        for encoder in (recompress_exhaustive, recompress):
+            timings = []
+            for _ in range(repeat):
+                start = perf_counter()
+                compressed = encoder(data)
+                timings.append(perf_counter() - start)
+            roundtrip = decompress(compressed)[:len(data)] == data
+            print("%-12s %-22s %8d %8d %9.4f  %s" % (
+                name, encoder.__name__, len(data), len(compressed), min(timings),
+                "ok" if roundtrip else "FAILED"))
+
+
 if __name__ == "__main__":
+    if len(argv) > 1 and argv[1] == "benchmark":
+        benchmark_recompress(argv[2] if len(argv) > 2 else None)
+        exit()
     sourcefile = argv[1]
     outfile = argv[2]
     copyfile(sourcefile, outfile)
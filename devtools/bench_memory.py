@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""Usage: bench_memory.py <ROM file> [number of snapshots]
+
+Measure the memory taken by the tables parsed from a rom, and the time it
+takes to save and restore them. The parse is what load_source() does for
+a new rom; the snapshot is the same as a failed phase takes and puts back.
+"""
+
+
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from randomizer import load_source, read_source, SavedState, Snapshot
+
+sourcefile = sys.argv[1]
+numsnapshots = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+data = read_source(sourcefile)
+# The pristine state is saved by the first load; it is not part of the
+# parse being measured.
+SavedState.saved[None] = SavedState()
+
+print("Loading tables from '{0}'".format(sourcefile))
+tracemalloc.start()
+start = perf_counter()
+load_source(data)
+parse = perf_counter() - start
+current, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+# load_source() keeps a saved copy of the tables as well as the tables.
+print("parse    {0:8.3f}s".format(parse))
+print("current  {0:8.1f} KiB".format(current / 1024))
+print("peak     {0:8.1f} KiB".format(peak / 1024))
+
+saves, restores = [], []
+for _ in range(numsnapshots):
+    start = perf_counter()
+    snapshot = Snapshot()
+    saves.append(perf_counter() - start)
+    start = perf_counter()
+    snapshot.restore()
+    restores.append(perf_counter() - start)
+
+print("\n{0} snapshots".format(numsnapshots))
+print("save     {0:8.3f}s".format(min(saves)))
+print("restore  {0:8.3f}s".format(min(restores)))
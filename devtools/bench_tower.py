@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""Usage: bench_tower.py <ROM file> [number of seeds] [number of maps]
+
+Time the ancient cave tower generation over a range of seeds. A digest of
+every entrance generated is printed at the end, so that the output of two
+versions of towerrandomizer can be compared.
+"""
+
+
+import os
+import sys
+import traceback
+from hashlib import md5
+from time import perf_counter
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from randomizer import load_source, read_source, SOURCE_ROM
+from locationrandomizer import get_locations
+import towerrandomizer
+from utils import utilrandom as random
+
+sourcefile = sys.argv[1]
+numseeds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+nummaps = int(sys.argv[3]) if len(sys.argv) > 3 else 85
+
+print("Loading tables from '{0}'".format(sourcefile))
+data = read_source(sourcefile)
+load_source(data)
+
+times, failures = [], []
+digest = md5()
+for seed in range(numseeds):
+    load_source(data)
+    random.seed(seed)
+    start = perf_counter()
+    try:
+        towerrandomizer.randomize_tower(SOURCE_ROM, ancient=True,
+                                        nummaps=nummaps)
+    except Exception:
+        failures.append(seed)
+        print("Seed {0} failed:".format(seed))
+        traceback.print_exc()
+        continue
+    times.append(perf_counter() - start)
+    for l in sorted(get_locations(), key=lambda l: l.locid):
+        for e in l.entrances:
+            digest.update(repr((l.locid, e.x, e.y, e.dest,
+                                e.destx, e.desty)).encode())
+
+print("\n{0} seeds, {1} maps, {2} failed".format(
+    numseeds, nummaps, len(failures)))
+if times:
+    times.sort()
+    print("total  {0:8.3f}s".format(sum(times)))
+    print("mean   {0:8.3f}s".format(sum(times) / len(times)))
+    print("median {0:8.3f}s".format(times[len(times) // 2]))
+    print("max    {0:8.3f}s".format(times[-1]))
+print("digest {0}".format(digest.hexdigest()))
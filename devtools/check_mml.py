@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Usage: check_mml.py [--update]
+
+Compile every .mml file in custom/music with mml2mfvi, on its own and
+with each .mmlappend, with and without sfx mode, and compare a digest of
+each result against devtools/mml_digests.txt. Any change to the compiler
+that changes its output shows up here; bump COMPILER_VERSION in
+mml2mfvi.py if it is meant to. --update writes the digests afresh.
+Exits with status 1 if any digest differs or is missing.
+"""
+
+
+import contextlib
+import hashlib
+import io
+import os
+import sys
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(here)
+
+from mml2mfvi import mml_to_akao
+
+MUSIC_PATH = os.path.join(here, "custom", "music")
+DIGEST_FILE = os.path.join(here, "devtools", "mml_digests.txt")
+
+
+def digest(output):
+    h = hashlib.sha1()
+    for variant in sorted(output):
+        data, inst = output[variant]
+        h.update(variant.encode("latin-1") + b"\0")
+        h.update(data.encode("latin-1") + b"\0")
+        h.update(inst.encode("latin-1") + b"\0")
+    return h.hexdigest()
+
+
+def compile_all():
+    names = sorted(os.listdir(MUSIC_PATH))
+    songs = [n for n in names if n.endswith(".mml")]
+    appends = [None] + [n for n in names if n.endswith(".mmlappend")]
+    digests = {}
+    for song in songs:
+        with open(os.path.join(MUSIC_PATH, song), 'r') as f:
+            mml = f.read()
+        for append in appends:
+            text = mml
+            if append is not None:
+                with open(os.path.join(MUSIC_PATH, append), 'r') as f:
+                    text += f.read()
+            for sfxmode in [False, True]:
+                # The compiler prints its warnings; they are not checked.
+                with contextlib.redirect_stdout(io.StringIO()):
+                    output = mml_to_akao(text, song, sfxmode)
+                key = "%s %s %d" % (song, append or "-", sfxmode)
+                digests[key] = digest(output)
+    return digests
+
+
+def read_digests():
+    digests = {}
+    with open(DIGEST_FILE, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                key, value = line.rsplit(' ', 1)
+                digests[key] = value
+    return digests
+
+
+digests = compile_all()
+if "--update" in sys.argv[1:]:
+    with open(DIGEST_FILE, 'w') as f:
+        f.write("# <song> <mmlappend or -> <sfx mode> <sha1>\n"
+                "# Written by devtools/check_mml.py --update.\n")
+        for key in sorted(digests):
+            f.write("%s %s\n" % (key, digests[key]))
+    print("Wrote %s digests to %s" % (len(digests), DIGEST_FILE))
+    sys.exit(0)
+
+expected = read_digests()
+failures = sorted(key for key in set(digests) | set(expected)
+                  if digests.get(key) != expected.get(key))
+for key in failures:
+    if key not in digests:
+        print("MISSING: %s" % key)
+    elif key not in expected:
+        print("NEW:     %s" % key)
+    else:
+        print("CHANGED: %s" % key)
+print("%s of %s compiled outputs match." %
+      (len(digests) - len([k for k in failures if k in digests]),
+       len(digests)))
+sys.exit(1 if failures else 0)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Usage: check_startup.py [help budget ms] [import budget ms]
+
+Check how long the randomizer takes to start, using python -X importtime.
+`randomizer.py --help` must not import anything from the randomizer but
+options.py, and must finish its imports within the first budget; a plain
+`import randomizer` must not load randomizer.DEFERRED_MODULES and must
+finish within the second. The slowest imports are listed either way.
+Exits with status 1 if a check fails.
+"""
+
+
+import os
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+help_budget = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+import_budget = float(sys.argv[2]) if len(sys.argv) > 2 else 500
+local_modules = set(name[:-3] for name in os.listdir(here)
+                    if name.endswith(".py"))
+
+
+def importtime(args):
+    # The top-level imports, as (name, cumulative microseconds), and every
+    # import as (name, self microseconds).
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args,
+                            cwd=here, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    toplevel, imports = [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            own, cumulative = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        imports.append((name.strip(), own))
+        if not name.startswith("  "):
+            toplevel.append((name.strip(), cumulative))
+    return toplevel, imports
+
+
+def report(title, toplevel, imports, budget):
+    total = sum(cumulative for (_, cumulative) in toplevel) / 1000.0
+    print("{0:24} {1:8.1f}ms  (budget {2:.0f}ms)".format(title, total, budget))
+    for name, own in sorted(imports, key=lambda i: -i[1])[:5]:
+        print("    {0:32} {1:8.1f}ms".format(name, own / 1000.0))
+    return total <= budget
+
+
+failures = []
+toplevel, imports = importtime(["randomizer.py", "--help"])
+if not report("randomizer.py --help", toplevel, imports, help_budget):
+    failures.append("--help is over budget")
+loaded = sorted(set(name for (name, _) in imports
+                    if name.split(".")[0] in local_modules) - set(["options"]))
+if loaded:
+    failures.append("--help imports %s" % ", ".join(loaded))
+
+toplevel, imports = importtime(["-c", "import randomizer"])
+if not report("import randomizer", toplevel, imports, import_budget):
+    failures.append("import randomizer is over budget")
+sys.path.append(here)
+os.chdir(here)
+from randomizer import DEFERRED_MODULES
+loaded = sorted(set(name for (name, _) in imports) & set(DEFERRED_MODULES))
+if loaded:
+    failures.append("import randomizer imports %s" % ", ".join(loaded))
+
+for failure in failures:
+    print("FAILED: %s" % failure)
+sys.exit(1 if failures else 0)
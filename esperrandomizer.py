@@ -1,5 +1,6 @@
-from utils import hex2int, int2bytes, Substitution, utilrandom as random
-from skillrandomizer import get_ranked_spells, get_spell
+from utils import (hex2int, int2bytes, Substitution, utilrandom as random,
+                   open_rom)
+from skillrandomizer import get_ranked_spells, get_spell, get_spell_catalogue
 from functools import reduce
 
 items = None
@@ -51,8 +52,8 @@ def get_candidates(myrank, set_lower=True):
         lower_bound = rankbounds[myrank-1]
     else:
         lower_bound = 0
-    candidates = [s for s in spells if s.rank() in
-                        range(lower_bound, upper_bound)]
+    candidates = get_spell_catalogue(magic_only=True).between(
+        lower_bound, upper_bound)
     if not candidates:
         candidates = spells
     fresh = [s for s in candidates if s not in used]
@@ -147,7 +148,7 @@ class EsperBlock:
 
     def read_data(self, filename):
         global spells
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         if spells is None:
             spells = get_ranked_spells(filename, magic_only=True)
@@ -1,14 +1,26 @@
 #! /usr/bin/env python3
 
-from utils import read_multi, write_multi, utilrandom as random
+from utils import read_multi, write_multi, utilrandom as random, open_rom
 from math import log
 from monsterrandomizer import monsterdict
+from records import Record, deepcopy_slots
 
 fsetdict = None
 formdict = None
 
+FORMATION_RECORD = Record(0xf6200, 576, [
+    ("mouldbyte", 1), ("enemies_present", 1), ("enemy_ids", 6, list),
+    ("enemy_pos", 6, list), ("bosses", 1)])
+FORMATION_AUX_RECORD = Record(0xf5900, 576, [
+    ("misc1", 1), ("misc2", 1), ("eventscript", 1), ("misc3", 1)])
+
 
 class Formation():
+    __slots__ = (["formid", "pointer", "auxpointer", "ap", "enemies",
+                  "big_enemy_ids"] +
+                 FORMATION_RECORD.names + FORMATION_AUX_RECORD.names)
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, formid):
         self.formid = formid
         self.pointer = 0xf6200 + (formid*15)
@@ -93,29 +105,20 @@ class Formation():
         return any([m.battle_event for m in self.present_enemies])
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
-        f.seek(self.pointer)
-        self.mouldbyte = ord(f.read(1))
-        self.enemies_present = ord(f.read(1))
-        self.enemy_ids = list(f.read(6))
-        self.enemy_pos = list(f.read(6))
-        self.bosses = ord(f.read(1))
-
-        f.seek(self.auxpointer)
-        self.misc1 = ord(f.read(1))
-        self.misc2 = ord(f.read(1))
-        self.eventscript = ord(f.read(1))
-        self.misc3 = ord(f.read(1))
+        for record in [FORMATION_RECORD.read(filename, self.pointer),
+                       FORMATION_AUX_RECORD.read(filename, self.auxpointer)]:
+            for name, value in record.items():
+                setattr(self, name, value)
 
         appointer = 0x1fb400 + self.formid
         if appointer < 0x1fb600:
+            f = open_rom(filename)
             f.seek(0x1fb400 + self.formid)
             self.ap = ord(f.read(1))
+            f.close()
         else:
             self.ap = None
 
-        f.close()
-
     @property
     def mould(self):
         return self.mouldbyte >> 4
@@ -211,18 +214,10 @@ class Formation():
             self.set_music(6)
 
     def write_data(self, fout):
-        fout.seek(self.pointer)
-        fout.write(bytes([self.mouldbyte]))
-        fout.write(bytes([self.enemies_present]))
-        fout.write(bytes(self.enemy_ids))
-        fout.write(bytes(self.enemy_pos))
-        fout.write(bytes([self.bosses]))
-
-        fout.seek(self.auxpointer)
-        fout.write(bytes([self.misc1]))
-        fout.write(bytes([self.misc2]))
-        fout.write(bytes([self.eventscript]))
-        fout.write(bytes([self.misc3]))
+        FORMATION_RECORD.write(fout, self.pointer,
+                               FORMATION_RECORD.get(self))
+        FORMATION_AUX_RECORD.write(fout, self.auxpointer,
+                                   FORMATION_AUX_RECORD.get(self))
 
         if self.ap is not None:
             fout.seek(0x1fb400 + self.formid)
@@ -259,7 +254,7 @@ class Formation():
 
     def read_mould(self, filename):
         mouldspecsptrs = 0x2D01A
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         pointer = mouldspecsptrs + (2*self.mould)
         f.seek(pointer)
         pointer = read_multi(f, length=2) | 0x20000
@@ -362,7 +357,7 @@ class FormationSet():
         return all([f.veldty for f in self.formations])
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.formids = []
         if self.setid <= 0xFF:
@@ -504,6 +499,22 @@ def get_fset(setid):
     return fsetdict[setid]
 
 
+def get_enemy_fsets(setids=None):
+    # The formation sets each monster appears in, out of `setids` (or all
+    # of them). Sets and formations are rewritten all through a run, so
+    # this reflects them as they are now.
+    if setids is None:
+        fsets = get_fsets()
+    else:
+        fsets = [get_fset(setid) for setid in setids]
+    enemy_fsets = {}
+    for fset in fsets:
+        for f in fset.formations:
+            for e in f.present_enemies:
+                enemy_fsets.setdefault(e, set()).add(fset.setid)
+    return enemy_fsets
+
+
 if __name__ == "__main__":
     from sys import argv
     from monsterrandomizer import get_monsters
@@ -0,0 +1,119 @@
+from bisect import bisect_left, bisect_right, insort
+
+from utils import DeadEndError
+
+# Every allocation from every pool, as (start, end, pool name, description).
+rom_map = []
+
+
+def reset_rom_map():
+    del rom_map[:]
+
+
+def record_claim(start, end, name=None, desc=None):
+    rom_map.append((start, end, name or "", desc or ""))
+
+
+def get_rom_map():
+    return ["0x{0:06x}-0x{1:06x} {2:>5}  {3:<10} {4}".format(
+                start, end, end - start, name, desc)
+            for (start, end, name, desc) in sorted(set(rom_map))]
+
+
+class FreeSpace(object):
+    """A pool of free ROM space kept as a set of disjoint intervals.
+
+    Intervals are half-open, [start, end). Two sorted indexes are kept:
+    one by start address, used for claims and address-order search, and
+    one by (size, age), used for best-fit lookups with bisect. Among
+    blocks of equal size the oldest wins, which is the order the old
+    list-based allocator happened to use. Like that allocator, freed
+    blocks are not merged with their neighbours, since merging would
+    change which block a best-fit lookup picks.
+    """
+    def __init__(self, blocks=None, name=None):
+        self.name = name
+        self.starts = []
+        self.ends = {}
+        self.sizes = []
+        self.ages = {}
+        self.counter = 0
+        for start, end in (blocks or []):
+            self.free(start, end)
+
+    def __iter__(self):
+        return iter([(start, self.ends[start]) for start in self.starts])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return "FreeSpace(%s)" % ", ".join(
+            ["%x-%x" % block for block in self])
+
+    @property
+    def total(self):
+        return sum(end - start for (start, end) in self)
+
+    def _add(self, start, end):
+        insort(self.starts, start)
+        self.ends[start] = end
+        self.ages[start] = self.counter
+        insort(self.sizes, (end - start, self.counter, start))
+        self.counter += 1
+
+    def _remove(self, start):
+        end = self.ends.pop(start)
+        age = self.ages.pop(start)
+        del self.starts[bisect_left(self.starts, start)]
+        del self.sizes[bisect_left(self.sizes, (end - start, age, start))]
+        return end
+
+    def free(self, start, end):
+        if end <= start:
+            return
+        self._add(start, end)
+
+    def claim(self, start, end, desc=None):
+        if end <= start:
+            return
+        index = bisect_right(self.starts, start)
+        if index > 0 and self.ends[self.starts[index-1]] > start:
+            index -= 1
+        while index < len(self.starts) and self.starts[index] < end:
+            blockstart = self.starts[index]
+            blockend = self._remove(blockstart)
+            if blockstart < start:
+                self._add(blockstart, start)
+                index += 1
+            if end < blockend:
+                self._add(end, blockend)
+                index += 1
+        record_claim(start, end, self.name, desc)
+
+    def find(self, size, first_fit=False):
+        # Returns the start of the smallest block that can hold `size`
+        # bytes, or of the lowest-addressed one if `first_fit` is set.
+        if first_fit:
+            for start in self.starts:
+                if self.ends[start] - start >= size:
+                    return start
+        else:
+            index = bisect_left(self.sizes, (size,))
+            if index < len(self.sizes):
+                return self.sizes[index][2]
+        raise DeadEndError("Not enough free space")
+
+    def allocate(self, size, desc=None, first_fit=False):
+        start = self.find(size, first_fit=first_fit)
+        self.claim(start, start + size, desc=desc)
+        return start
+
+    def copy(self):
+        new = FreeSpace(name=self.name)
+        new.starts = list(self.starts)
+        new.ends = dict(self.ends)
+        new.sizes = list(self.sizes)
+        new.ages = dict(self.ages)
+        new.counter = self.counter
+        return new
@@ -1,8 +1,9 @@
-from utils import (hex2int, write_multi, read_multi, ITEM_TABLE,
+from utils import (hex2int, ITEM_TABLE,
                    CUSTOM_ITEMS_TABLE, mutate_index,
                    name_to_bytes, utilrandom as random,
-                   Substitution)
+                   Substitution, open_rom, RankedCatalogue)
 from skillrandomizer import SpellBlock, get_ranked_spells
+from records import Record
 # future blocks: chests, morphs, shops
 
 ITEM_STATS = ["learnrate", "learnspell", "fieldeffect",
@@ -12,6 +13,9 @@ ITEM_STATS = ["learnrate", "learnspell", "fieldeffect",
               "magstam", "breakeffect", "otherproperties", "power",
               "hitmdef", "elemabsorbs", "elemnulls", "elemweaks",
               "statusacquire2", "mblockevade", "specialaction"]
+ITEM_RECORD = Record(0x185000, 255, (
+    [("itemtype", 1), ("equippable", 2)] +
+    [(key, 1) for key in ITEM_STATS] + [("price", 2)]))
 
 STATPROTECT = {"fieldeffect": 0xdc,
                "statusprotect1": 0x00,
@@ -28,6 +32,7 @@ STATPROTECT = {"fieldeffect": 0xdc,
 all_spells = None
 effects_used = []
 itemdict = {}
+item_catalogue = None
 customs = {}
 changed_commands = []
 
@@ -125,11 +130,8 @@ class ItemBlock:
         self.degree = value
 
     def read_stats(self, filename):
-        global all_spells
-
-        f = open(filename, 'r+b')
-        f.seek(self.pointer)
-        self.itemtype = ord(f.read(1))
+        record = ITEM_RECORD.read(filename, self.pointer)
+        self.itemtype = record["itemtype"]
 
         itemtype = self.itemtype & 0x0f
         (self.is_tool, self.is_weapon, self.is_armor, self.is_relic,
@@ -156,11 +158,10 @@ class ItemBlock:
         #usable_battle = self.itemtype & 0x20
         #usable_field = self.itemtype & 0x40
 
-        self.equippable = read_multi(f, length=2)
+        self.equippable = record["equippable"]
         self.heavy = bool(self.equippable & 0x8000)
 
-        stats = list(f.read(len(ITEM_STATS)))
-        self.features = dict(list(zip(ITEM_STATS, stats)))
+        self.features = dict((key, record[key]) for key in ITEM_STATS)
 
         # move flags for "randomly cast" and "destroy if used"
         # so breakeffect can use the full range of spells
@@ -169,12 +170,9 @@ class ItemBlock:
             self.features["otherproperties"] |= break_flags >> 4
             self.features["breakeffect"] &= ~0xC0
 
-        self.price = read_multi(f, length=2)
-
-        if all_spells is None:
-            all_spells = get_ranked_spells(filename)
-            all_spells = [s for s in all_spells if s.valid]
+        self.price = record["price"]
 
+        f = open_rom(filename)
         f.seek(0x2CE408 + (8*self.itemid))
         self.weapon_animation = list(f.read(8))
 
@@ -188,8 +186,20 @@ class ItemBlock:
 
         f.close()
 
+    @property
+    def price(self):
+        return self._price
+
+    @price.setter
+    def price(self, value):
+        # An item's rank is its price unless the price is too low to mean
+        # anything, so a new price can move the item in the catalogue.
+        self._price = value
+        invalidate_item_catalogue()
+
     def ban(self):
         self.banned = True
+        invalidate_item_catalogue()
 
     def become_another(self, customdict=None, tier=None):
         customs = get_custom_items()
@@ -239,16 +249,10 @@ class ItemBlock:
         self.ban()
 
     def write_stats(self, fout):
-        fout.seek(self.pointer)
-        fout.write(bytes([self.itemtype]))
-
         self.confirm_heavy()
-        write_multi(fout, self.equippable, length=2)
-
-        s = bytes([self.features[key] for key in ITEM_STATS])
-        fout.write(s)
-
-        write_multi(fout, self.price, length=2)
+        record = dict(self.features, itemtype=self.itemtype,
+                      equippable=self.equippable, price=self.price)
+        ITEM_RECORD.write(fout, self.pointer, record)
 
         if self.is_weapon or (self.itemtype & 0x0f) == 0x01:
             if self.itemid < 93:
@@ -313,8 +317,8 @@ class ItemBlock:
             spells = list(filter(custom, spells))
 
         spells = sorted(spells, key=lambda s: s.rank())
-        items = get_ranked_items()
-        index = items.index(self)
+        items = get_item_catalogue()
+        index = items.index(self.itemid)
         index = int((index / float(len(items))) * len(spells))
         index = mutate_index(index, len(spells), [False, True, True],
                              (-5, 4), (-3, 3))
@@ -916,7 +920,11 @@ def items_from_table(tablefile):
 
 
 def get_items(filename=None, allow_banned=False):
-    global itemdict
+    global itemdict, all_spells
+    if all_spells is None:
+        all_spells = get_ranked_spells(filename)
+        all_spells = [s for s in all_spells if s.valid]
+
     if itemdict:
         to_return = [i for i in list(itemdict.values()) if i]
         if not allow_banned:
@@ -953,9 +961,38 @@ def get_secret_item():
     return item
 
 
+# Filters for get_item_catalogue(), by the kind of shop that sells them.
+ITEM_KINDS = {"weapons": lambda i: i.is_weapon or i.is_tool,
+              "armor": lambda i: i.is_armor,
+              "relics": lambda i: i.is_relic,
+              "consumables": lambda i: i.is_consumable,
+              "items": lambda i: not (i.is_weapon or i.is_armor or
+                                      i.is_relic)}
+
+
+def invalidate_item_catalogue():
+    global item_catalogue
+    item_catalogue = None
+
+
+def get_item_catalogue(filename=None, allow_banned=False, kind=None):
+    global item_catalogue
+    # get_items() also reads the spells for this run if they are not read
+    # yet, which is part of what getting the items has always done.
+    if item_catalogue is None or all_spells is None:
+        item_catalogue = RankedCatalogue(
+            get_items(filename, allow_banned=True), "itemid")
+
+    catalogue = item_catalogue
+    if not allow_banned:
+        catalogue = catalogue.subset("allowed", lambda i: not i.banned)
+    if kind is not None:
+        catalogue = catalogue.subset(kind, ITEM_KINDS[kind])
+    return catalogue
+
+
 def get_ranked_items(filename=None, allow_banned=False):
-    items = get_items(filename, allow_banned)
-    return sorted(items, key=lambda i: i.rank())
+    return list(get_item_catalogue(filename, allow_banned).objects)
 
     
 def unhack_tintinabar(fout):
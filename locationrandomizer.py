@@ -4,7 +4,9 @@ from utils import (read_multi, write_multi, battlebg_palettes, MAP_NAMES_TABLE,
                    decompress, line_wrap, USED_LOCATIONS_TABLE,
                    UNUSED_LOCATIONS_TABLE, MAP_BATTLE_BG_TABLE,
                    ENTRANCE_REACHABILITY_TABLE, LOCATION_MAPS_TABLE,
-                   utilrandom as random)
+                   utilrandom as random, open_rom)
+from records import Record, deepcopy_slots
+from tablecache import load_table
 from copy import copy
 
 
@@ -12,38 +14,53 @@ locations = None
 zones = None
 unused_locs = None
 reachdict = None
-mapnames = {}
 locdict = {}
 chest_id_counts = None
-for line in open(MAP_NAMES_TABLE):
-    key, value = tuple(line.strip().split(':'))
-    key = int(key, 0x10)
-    mapnames[key] = value
-
-
-mapbattlebgs = {}
-for line in open(MAP_BATTLE_BG_TABLE):
-    a, b = tuple(line.strip().split())
-    mapbattlebgs[int(a)] = int(b, 0x10)
-
-maplocations = {}
-maplocations_reverse = {}
-for line in open(LOCATION_MAPS_TABLE):
-    a, b = tuple(line.strip().split(':'))
-    b = b.strip().strip(',').split(',')
-    locids = []
-    for locid in b:
-        if '+' in locid:
-            l = int(locid.strip('+'))
-            locids.extend([l, l+1, l+2, l+3])
-        else:
-            locids.append(int(locid))
 
-    if a not in maplocations_reverse:
-        maplocations_reverse[a] = []
-    for locid in sorted(locids):
-        maplocations[locid] = a
-        maplocations_reverse[a].append(locid)
+
+def read_map_names(sources):
+    mapnames = {}
+    for line in open(sources[0]):
+        key, value = tuple(line.strip().split(':'))
+        key = int(key, 0x10)
+        mapnames[key] = value
+    return mapnames
+
+
+def read_map_battlebgs(sources):
+    mapbattlebgs = {}
+    for line in open(sources[0]):
+        a, b = tuple(line.strip().split())
+        mapbattlebgs[int(a)] = int(b, 0x10)
+    return mapbattlebgs
+
+
+def read_location_maps(sources):
+    maplocations = {}
+    maplocations_reverse = {}
+    for line in open(sources[0]):
+        a, b = tuple(line.strip().split(':'))
+        b = b.strip().strip(',').split(',')
+        locids = []
+        for locid in b:
+            if '+' in locid:
+                l = int(locid.strip('+'))
+                locids.extend([l, l+1, l+2, l+3])
+            else:
+                locids.append(int(locid))
+
+        if a not in maplocations_reverse:
+            maplocations_reverse[a] = []
+        for locid in sorted(locids):
+            maplocations[locid] = a
+            maplocations_reverse[a].append(locid)
+    return maplocations, maplocations_reverse
+
+
+mapnames = load_table([MAP_NAMES_TABLE], read_map_names)
+mapbattlebgs = load_table([MAP_BATTLE_BG_TABLE], read_map_battlebgs)
+maplocations, maplocations_reverse = load_table([LOCATION_MAPS_TABLE],
+                                                read_location_maps)
 
 
 def add_location_map(location_name, mapid):
@@ -67,6 +84,11 @@ def get_chest_id_counts():
 
 
 class NPCBlock():
+    __slots__ = ["pointer", "locid", "npcid", "palette", "unknown", "membit",
+                 "memaddr", "event_addr", "x", "y", "graphics",
+                 "graphics_index", "facing"]
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, pointer, locid):
         self.pointer = pointer
         self.locid = locid
@@ -75,7 +97,7 @@ class NPCBlock():
         self.npcid = npcid
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         value = read_multi(f, length=4)
         self.palette = (value & 0x1C0000) >> 18
@@ -103,6 +125,9 @@ class NPCBlock():
 
 
 class EventBlock():
+    __slots__ = ["pointer", "locid", "eventid", "x", "y", "event_addr"]
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, pointer, locid):
         self.pointer = pointer
         self.locid = locid
@@ -111,7 +136,7 @@ class EventBlock():
         self.eventid = eventid
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.x = ord(f.read(1))
         self.y = ord(f.read(1))
@@ -134,7 +159,7 @@ class Zone():
         self.names = {}
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.setids = list(f.read(4))
         f.seek(self.ratepointer)
@@ -202,8 +227,26 @@ class Zone():
         fout.write(bytes([self.rates]))
 
 
+LOCATION_RECORD = Record(0x2D8F00, 415, [
+    ("name_id", 1), ("layers_to_animate", 1), ("_battlebg", 1),
+    ("unknown0", 1), ("tileproperties", 1), ("attacks", 1), ("unknown1", 1),
+    ("graphic_sets", 4, list), ("tileformations", 2), ("mapdata", 4),
+    ("unknown2", 1), ("bgshift", 4, list), ("unknown3", 1),
+    ("layer12dimensions", 1), ("unknown4", 1), ("palette_index", 3),
+    ("music", 1), ("unknown5", 1), ("width", 1), ("height", 1),
+    ("layerpriorities", 1)])
+
+
 # 415 locations
 class Location():
+    # The tower fills in the last few for the maps it uses.
+    __slots__ = [
+        "locid", "pointer", "entrance_set", "name", "altname", "setid",
+        "entrancebackups", "chests", "npcs", "events",
+        "new", "ancient_rank", "restrank", "routerank", "copied",
+        "party_id", "secret_treasure"] + LOCATION_RECORD.names
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, locid, dummy=False):
         self.locid = locid
         if dummy:
@@ -422,32 +465,11 @@ class Location():
         return (self.mapdata >> 20) & 0x3FF
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
-        f.seek(self.pointer)
-
-        self.name_id = ord(f.read(1))
-        self.layers_to_animate = ord(f.read(1))
-        self._battlebg = ord(f.read(1))
-        self.unknown0 = ord(f.read(1))
-        self.tileproperties = ord(f.read(1))  # mult by 2
-        self.attacks = ord(f.read(1))
-        self.unknown1 = ord(f.read(1))
-        self.graphic_sets = list(f.read(4))
-        self.tileformations = read_multi(f, length=2, reverse=True)
-        self.mapdata = read_multi(f, length=4)
-        self.unknown2 = ord(f.read(1))
-        self.bgshift = list(f.read(4))
-        self.unknown3 = ord(f.read(1))
-        self.layer12dimensions = ord(f.read(1))
-        self.unknown4 = ord(f.read(1))
-        self.palette_index = read_multi(f, length=3)
-        self.music = ord(f.read(1))
-        self.unknown5 = ord(f.read(1))
-        self.width = ord(f.read(1))
-        self.height = ord(f.read(1))
-        self.layerpriorities = ord(f.read(1))
-        assert f.tell() == self.pointer + 0x21
+        for name, value in LOCATION_RECORD.read(filename,
+                                                self.pointer).items():
+            setattr(self, name, value)
 
+        f = open_rom(filename)
         f.seek(0xf5600 + self.locid)
         self.setid = ord(f.read(1))
 
@@ -502,36 +524,7 @@ class Location():
     def write_data(self, fout):
         if self.pointer is None:
             self.pointer = 0x2D8F00 + (33 * self.locid)
-        fout.seek(self.pointer)
-
-        def write_attributes(*args):
-            for attribute in args:
-                attribute = getattr(self, attribute)
-                try:
-                    attribute = bytes([attribute])
-                except TypeError:
-                    attribute = bytes(attribute)
-                fout.write(attribute)
-
-        write_attributes("name_id", "layers_to_animate", "_battlebg",
-                         "unknown0", "tileproperties", "attacks",
-                         "unknown1", "graphic_sets")
-
-        write_multi(fout, self.tileformations, length=2, reverse=True)
-        write_multi(fout, self.mapdata, length=4, reverse=True)
-
-        write_attributes(
-            "unknown2", "bgshift", "unknown3", "layer12dimensions",
-            "unknown4")
-
-        write_multi(fout, self.palette_index, length=3)
-
-        write_attributes("music", "unknown5", "width", "height",
-                         "layerpriorities")
-        try:
-            assert fout.tell() == self.pointer + 0x21
-        except:
-            print(fout.tell() - (self.pointer + 0x21))
+        LOCATION_RECORD.write(fout, self.pointer, LOCATION_RECORD.get(self))
 
         fout.seek(0xf5600 + self.locid)
         fout.write(bytes([self.setid]))
@@ -560,7 +553,7 @@ class Location():
 
     def read_chests(self, filename):
         from chestrandomizer import ChestBlock
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.chestpointer)
         begin = read_multi(f, length=2)
         end = read_multi(f, length=2)
@@ -574,7 +567,7 @@ class Location():
             self.chests.append(c)
 
     def read_npcs(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.npcpointer)
         begin = read_multi(f, length=2)
         end = read_multi(f, length=2)
@@ -590,7 +583,7 @@ class Location():
             self.npcs.append(e)
 
     def read_events(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.eventpointer)
         begin = read_multi(f, length=2)
         end = read_multi(f, length=2)
@@ -719,12 +712,16 @@ class Location():
 
 
 class Entrance():
+    __slots__ = ["pointer", "entid", "location", "x", "y", "dest", "destx",
+                 "desty", "_entrances"]
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, pointer=None):
         self.pointer = pointer
         self.entid = None
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.x = ord(f.read(1))
         self.y = ord(f.read(1))
@@ -819,8 +816,10 @@ class Entrance():
 
 
 class LongEntrance(Entrance):
+    __slots__ = ["width"]
+
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.x = ord(f.read(1))
         self.y = ord(f.read(1))
@@ -847,6 +846,10 @@ class LongEntrance(Entrance):
 
 
 class EntranceSet():
+    __slots__ = ["entid", "pointer", "longpointer", "entrances",
+                 "longentrances", "location"]
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, entid):
         self.entid = entid
         self.pointer = 0x1fbb00 + (2*entid)
@@ -859,7 +862,7 @@ class EntranceSet():
         return set([e.destination for e in self.entrances])
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         start = read_multi(f, length=2)
         end = read_multi(f, length=2)
@@ -875,7 +878,7 @@ class EntranceSet():
             e.read_data(filename)
             e.set_location(self.location)
 
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.longpointer)
         start = read_multi(f, length=2)
         end = read_multi(f, length=2)
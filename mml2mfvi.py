@@ -4,6 +4,8 @@ import sys, os, re, traceback, copy
 from mmltbl import *
 
 mml_log = "\n" if __name__ == "__main__" else None
+#bump whenever a change to the compiler changes its output
+COMPILER_VERSION = 1
 
 def byte_insert(data, position, newdata, maxlength=0, end=0):
     while position > len(data):
@@ -24,6 +26,47 @@ def int_insert(data, position, newdata, length, reversed=True):
     if not reversed: l.reverse()
     return byte_insert(data, position, "".join(l), length)
 
+def int_bytes(n, length):
+    return bytes([(n >> (i*8)) & 0xFF for i in range(length)])
+
+#matches the parameter characters that follow a command
+param_re = re.compile("[0-9,.+x-]*")
+#matches a run of whitespace and the parameter characters after it
+space_re = re.compile("\\s+[0-9,.+x-]*")
+#matches a run of whitespace, possibly empty
+blank_re = re.compile("\\s*")
+#matches the numbers in a command's parameters
+number_re = re.compile("[0-9]+")
+#matches the numbers inside a {} channel marker
+channel_re = re.compile("([0-9]+)(?=.)", re.S)
+
+def read_run(regex, m, pos, below):
+    #carries a run on from the end of one frame into the frames below,
+    #while `regex` (a repeated character class) matches up to their ends;
+    #returns what it read and where reading goes on
+    found = []
+    while pos >= len(m) and below:
+        m, pos = below.pop()
+        end = regex.match(m, pos).end()
+        found.append(m[pos:end])
+        pos = end
+    return "".join(found), m, pos
+
+def read_until(c, m, pos, below):
+    #reads up to the next `c`, through the frames below if need be;
+    #returns the text before it, whether there was one, and where
+    #reading goes on (just after it)
+    found = []
+    while True:
+        end = m.find(c, pos)
+        if end >= 0:
+            found.append(m[pos:end])
+            return "".join(found), True, m, end + 1
+        found.append(m[pos:])
+        if not below:
+            return "".join(found), False, m, len(m)
+        m, pos = below.pop()
+
 def warn(fileid, cmd, msg):
     global mml_log
     m = "{}: WARNING: in {:<10}: {}".format(fileid, cmd, msg)
@@ -235,55 +278,61 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
     for i, line in enumerate(mml):
         mml[i] = line.split('#')[0].lower()
             
-    m = list(" ".join(mml))
+    #the song is read from a string through an index cursor. Text that
+    #expands into more mml (cdefs, drum blocks) becomes a frame of its own,
+    #read before the rest, and the frame it interrupted waits in `below`;
+    #reads that reach the end of a frame carry on into the one below it.
+    m = " ".join(mml)
+    pos = 0
+    below = []
     targets, channels, pendingjumps = {}, {}, {}
-    data = "\x00" * 0x26
+    data = bytearray(0x26)
     defaultlength = 8
     thissegment = 1
     next_jumpid = 1
     state = {}
     jumpout = []
     
-    while len(m):
-        command = m.pop(0)
+    while True:
+        if pos >= len(m):
+            if not below: break
+            m, pos = below.pop()
+            continue
+        command = m[pos]
+        #whitespace, along with any parameters after it, does nothing
+        if command.isspace():
+            pos = space_re.match(m, pos).end()
+            if pos >= len(m) and below:
+                if m[pos-1].isspace():
+                    _, m, pos = read_run(blank_re, m, pos, below)
+                    pos = param_re.match(m, pos).end()
+                _, m, pos = read_run(param_re, m, pos, below)
+            continue
+        pos += 1
         
         #single character macros
         if command in cdefs:
-            repl = list(cdefs[command] + " ")
-            m = repl + m
+            below.append((m, pos))
+            m, pos = cdefs[command] + " ", 0
         #conditionally executed statements
         if command in ignore:
-            while len(m):
-                next = m.pop(0)
-                if next == command:
-                    break
+            _, _, m, pos = read_until(command, m, pos, below)
             continue
         #inline comment // channel marker
         elif command == "{":
-            thisnumber = ""    
-            numbers = []
-            while len(m):
-                command += m.pop(0)
-                if command[-1] in "1234567890":
-                    thisnumber += command[-1]
-                elif thisnumber:
-                    numbers.append(int(thisnumber))
-                    thisnumber = ""
-                if command[-1] == "}": break
-            for n in numbers:
+            text, found, m, pos = read_until("}", m, pos, below)
+            command = "{" + text + ("}" if found else "")
+            for n in channel_re.findall(command):
+                n = int(n)
                 if n <= 16 and n >= 1:
                     channels[n] = len(data)
             continue
         #drum mode
         elif command in drums:
-            mls, dms = [], []
+            mls = []
             drumset = drums[command]
-            while len(m):
-                if m[0] != command:
-                    dms.append(m.pop(0))
-                else:
-                    m.pop(0)
-                    break
+            text, _, m, pos = read_until(command, m, pos, below)
+            dms = list(text)
             dbgdms = "".join(dms)
             lockstate = False
             silent = False
@@ -365,26 +414,36 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
                         s += "o{}".format(drumset[dcom].octave)
                         state['o0'] = drumset[dcom].octave
                     s += drumset[dcom].note
-                    if not silent: mls.extend(list(s))
-            mlog("drum: processed {} -> {}".format(dbgdms, "".join(mls)))
-            mls.extend(m)
-            m = mls
+                    if not silent: mls.append(s)
+            mls = "".join(mls)
+            mlog("drum: processed {} -> {}".format(dbgdms, mls))
+            below.append((m, pos))
+            m, pos = mls, 0
             continue
             
         #populate command variables
-        if command == "%": command += m.pop(0)
+        if command == "%":
+            while pos >= len(m) and below:
+                m, pos = below.pop()
+            command += m[pos]
+            pos += 1
         prefix = command
-        if len(m):
-            while m[0] in "1234567890,.+-x":
-                command += m.pop(0)
-                if not len(m): break
+        r = param_re.match(m, pos)
+        command += r.group()
+        pos = r.end()
+        if pos >= len(m) and below:
+            more, m, pos = read_run(param_re, m, pos, below)
+            command += more
         
         #catch @0x before parsing params
         if "|" in command:
             command = "@0x2" + command[1:]
         if "@0x" in command:
             while len(command) < 5:
-                command += m.pop(0)
+                while pos >= len(m) and below:
+                    m, pos = below.pop()
+                command += m[pos]
+                pos += 1
             number = command[-2:]
             try:
                 number = int(number, 16)
@@ -393,24 +452,22 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
                 number = 0x20
             command = "@" + str(number)
                     
-        modifier = ""
-        params = []
-        for c in command:
-            if c in "+-":
-                modifier = c
-        thisnumber = ""
-        is_negative = False
-        for c in command[len(prefix):] + " ":
-            if c in "1234567890":
-                thisnumber += c
-            elif c == "-" and prefix not in "abcdefg^r":
-                is_negative = True
-            elif thisnumber:
-                params.append(0x100-int(thisnumber) if is_negative else int(thisnumber))
-                thisnumber = ""
-                is_negative = False
-        dots = len([c for c in command if c == "."])
-        
+        if "-" in command[len(prefix):] and prefix not in "abcdefg^r":
+            params = []
+            thisnumber = ""
+            is_negative = False
+            for c in command[len(prefix):] + " ":
+                if c in "1234567890":
+                    thisnumber += c
+                elif c == "-":
+                    is_negative = True
+                elif thisnumber:
+                    params.append(0x100-int(thisnumber) if is_negative else int(thisnumber))
+                    thisnumber = ""
+                    is_negative = False
+        else:
+            params = [int(n) for n in number_re.findall(command, len(prefix))]
+
         if (prefix, len(params)) not in command_tbl and len(params):
             if (prefix + str(params[0]), len(params) - 1) in command_tbl:
                 prefix += str(params.pop(0))
@@ -418,6 +475,9 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
         #print "processing command {} -> {} {} mod {} dots {}".format(command, prefix, params, modifier, dots)
         #case: notes
         if prefix in "abcdefg^r":
+            i = max(command.rfind("+"), command.rfind("-"))
+            modifier = command[i] if i >= 0 else ""
+            dots = command.count(".")
             pitch = note_tbl[prefix]
             if prefix not in "^r":
                 pitch += 1 if "+" in modifier else 0
@@ -429,11 +489,11 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
             else:
                 length = params[0]
             if dots and str(length)+"." in length_tbl:
-                akao = chr(pitch * 14 + length_tbl[str(length)+"."][0])
+                akao = bytearray([pitch * 14 + length_tbl[str(length)+"."][0]])
                 dots -= 1
                 length *= 2
             elif length in length_tbl:
-                akao = chr(pitch * 14 + length_tbl[length][0])
+                akao = bytearray([pitch * 14 + length_tbl[length][0]])
             else:
                 warn(fileid, command, "Unrecognized note length {}".format(length))
                 continue
@@ -444,11 +504,11 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
                 dots -= 1
                 length *= 2
                 if dots and str(length)+"." in length_tbl:
-                    akao += chr(note_tbl["^"]*14 + length_tbl[str(length)+"."][0])
+                    akao.append(note_tbl["^"]*14 + length_tbl[str(length)+"."][0])
                     dots -= 1
                     length *= 2
                 else:
-                    akao += chr(note_tbl["^"]*14 + length_tbl[length][0])
+                    akao.append(note_tbl["^"]*14 + length_tbl[length][0])
             data += akao
         #case: simple commands
         elif (prefix, len(params)) in command_tbl:
@@ -465,16 +525,16 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
                 targets["jo%d"%next_jumpid] = len(data) + 1
                 next_jumpid += 1    
             #general case
-            akao = chr(command_tbl[prefix, len(params)])
+            akao = bytearray([command_tbl[prefix, len(params)]])
             #special case: pansweep
             if prefix == "p" and len(params) == 3:
                 params = params[1:]
             #general case
-            while len(params):
-                if params[0] >= 256:
-                    warn(fileid, command, "Parameter {} out of range, substituting 0".format(params[0]))
-                    params[0] = 0
-                akao += chr(params.pop(0))
+            for p in params:
+                if p >= 256:
+                    warn(fileid, command, "Parameter {} out of range, substituting 0".format(p))
+                    p = 0
+                akao.append(p)
             data += akao
         #case: default length
         elif prefix == "l" and len(params) == 1:
@@ -502,10 +562,11 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
                 if "seg%d"%thissegment in targets:
                     target = targets["seg%d"%thissegment]
                 else:
-                    data += "\xEB"
+                    data.append(0xEB)
                     thissegment += 1
                     continue
-            data += "\xF6" + int_insert("  ",0,target,2)
+            data.append(0xF6)
+            data += int_bytes(target, 2)
             thissegment += 1
         #case: jump out of loop
         elif prefix == "j":
@@ -522,7 +583,8 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
             if params[0] >= 256:
                 warn(fileid, command, "Parameter {} out of range, substituting 1".format(params[0]))
                 params[0] = 1
-            data += "\xF5" + chr(params[0]) + int_insert("  ",0,target,2)
+            data += bytearray([0xF5, params[0]])
+            data += int_bytes(target, 2)
         #case: hard jump without ending segment
         elif prefix == "%j":
             if len(params)==1:
@@ -532,7 +594,8 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
                     target = len(data)
                     pendingjumps[len(data)+1] = params[0]
             else: continue
-            data += "\xF6" + int_insert("  ",0,target,2)
+            data.append(0xF6)
+            data += int_bytes(target, 2)
         #case: conditional jump
         elif prefix == ":" and len(params) == 1:
             if params[0] in targets:
@@ -540,28 +603,30 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
             else:
                 target = len(data)
                 pendingjumps[len(data)+1] = params[0]
-            data += "\xFC" + int_insert("  ",0,target,2)
+            data.append(0xFC)
+            data += int_bytes(target, 2)
     
     #insert pending jumps
     for k, v in pendingjumps.items():
         if v in targets:
-            data = int_insert(data, k, targets[v], 2)
+            data[k:k+2] = int_bytes(targets[v], 2)
         else:
             warn(fileid, command, "Jump destination {} not found in file".format(v))
     #set up header
-    header = int_insert("\x00"*0x26, 0, len(data)-2, 2)
-    header = int_insert(header, 2, 0x26, 2)
-    header = int_insert(header, 4, len(data), 2)
+    header = bytearray(0x26)
+    header[0:2] = int_bytes(len(data)-2, 2)
+    header[2:4] = int_bytes(0x26, 2)
+    header[4:6] = int_bytes(len(data), 2)
     for i in range(0,8):
         if i not in channels:
             channels[i] = len(data)
     for k, v in channels.items():
-        header = int_insert(header, 4 + k*2, v, 2)
+        header[4+k*2:6+k*2] = int_bytes(v, 2)
         if k <= 8 and k+8 not in channels:
-            header = int_insert(header, 4 + (k+8)*2, v, 2)
-    data = byte_insert(data, 0, header, 0x26)
+            header[4+(k+8)*2:6+(k+8)*2] = int_bytes(v, 2)
+    data[0:0x26] = header
     
-    return data
+    return data.decode('latin-1')
     
 def clean_end():
     print("Processing ended.")
@@ -1,11 +1,14 @@
 import copy
+from bisect import bisect_right
 
 from utils import (hex2int, write_multi, read_multi, ENEMY_TABLE,
+                   read_palette, write_palette,
                    name_to_bytes, get_palette_transformer, mutate_index,
-                   make_table, utilrandom as random)
+                   make_table, utilrandom as random, open_rom, numpy)
 from skillrandomizer import SpellBlock, get_spell, get_ranked_spells
-from itemrandomizer import get_ranked_items, get_item
+from itemrandomizer import get_ranked_items, get_item, get_item_catalogue
 from namerandomizer import generate_attack
+from records import Record, deepcopy_slots
 
 
 stat_order = ['speed', 'attack', 'hit%', 'evade%', 'mblock%',
@@ -20,6 +23,7 @@ shortnames = {'level': 'lv',
 
 metamorphs = None
 all_spells = None
+spell_classes = None
 HIGHEST_LEVEL = 77
 xps = []
 gps = []
@@ -30,7 +34,21 @@ AICODES = {0xF0: 3, 0xF1: 1, 0xF2: 3, 0xF3: 2,
            }
 monsterdict = {}
 
+# The stats kept in MonsterBlock.stats rather than as attributes.
+MONSTER_STATS = stat_order + ['hp', 'mp', 'xp', 'gp', 'level']
+MONSTER_RECORD = Record(0xF0000, 384, (
+    [(key, 1) for key in stat_order] +
+    [('hp', 2), ('mp', 2), ('xp', 2), ('gp', 2), ('level', 1),
+     ('morph', 1), ('misc1', 1), ('misc2', 1), ('immunities', 3, list),
+     ('absorb', 1), ('null', 1), ('weakness', 1), ('attackanimation', 1),
+     ('statuses', 4, list), ('special', 1)]))
+
 globalweights, avgs = None, {}
+# What MonsterBlock.rank scores a monster on, in the order the weights
+# are given in.
+RANK_KEYS = ["defense", "elements", "evasion", "hp", "immunities",
+             "itemrank", "level", "offense", "speed"]
+LEVELFACTOR, HPFACTOR = len(RANK_KEYS)*2, len(RANK_KEYS)
 
 statusdict = {"blind": (0, 0x01),
               "zombie": (0, 0x02),
@@ -118,6 +136,62 @@ def read_ai_table(table):
     return aiscripts
 
 
+class SpellClasses:
+    """Spells that mutate_ai may swap for one another.
+
+    Two spells are similar when they agree on the attributes in `key`.
+    Each class lists its members in rank order, without the blitzes,
+    swdtechs, espers and slots, once as a whole and once with only the
+    valid spells. Ties in rank keep the order of `spells`, as sorting that
+    list by rank would.
+    """
+    def __init__(self, spells):
+        self.spells = spells
+        self.order = dict((s.spellid, (s.rank(), i))
+                          for (i, s) in enumerate(spells))
+        self.spelldict = dict((s.spellid, s) for s in spells)
+        self.keys = dict((s.spellid, self.key(s)) for s in spells)
+        self.similar = {}
+        self.valid = {}
+        for s in sorted(spells, key=lambda s: self.order[s.spellid]):
+            key = self.keys[s.spellid]
+            similar = self.similar.setdefault(key, [])
+            valid = self.valid.setdefault(key, [])
+            if s.is_blitz or s.is_swdtech or s.is_esper or s.is_slots:
+                continue
+            similar.append(s)
+            if s.valid:
+                valid.append(s)
+
+    @staticmethod
+    def key(s):
+        return (s.target_enemy_default, s.target_everyone, s.target_dead,
+                s.healing, s.unreflectable, s.abort_on_allies)
+
+    def get_ranked(self, spellids):
+        return sorted([self.spelldict[i] for i in spellids
+                       if i in self.spelldict],
+                      key=lambda s: self.order[s.spellid])
+
+    def get_candidates(self, skill, valid_only=False, banned=()):
+        key = self.keys[skill.spellid]
+        candidates = self.valid[key] if valid_only else self.similar[key]
+        candidates = [c for c in candidates if c.spellid not in banned]
+        if skill not in candidates:
+            ranks = [c.rank() for c in candidates]
+            candidates.insert(bisect_right(ranks, skill.rank()), skill)
+        return candidates
+
+
+def get_spell_classes():
+    # Ranks are settled by the time monsters are mutated (madworld shuffles
+    # them first), so the classes are built once per all_spells.
+    global spell_classes
+    if spell_classes is None or spell_classes.spells is not all_spells:
+        spell_classes = SpellClasses(all_spells)
+    return spell_classes
+
+
 def get_item_normal():
     items = get_ranked_items()
     base = ((len(items)-1) // 2)
@@ -130,6 +204,18 @@ def get_item_normal():
 
 
 class MonsterBlock:
+    # The stats in MONSTER_STATS are kept in `stats`; the rest of the
+    # record is kept as attributes.
+    __slots__ = [
+        "name", "graphicname", "id", "pointer", "itemptr", "controlptr",
+        "sketchptr", "rageptr", "aiptr", "specialeffectpointer", "stats",
+        "oldlevel", "items", "controls", "sketches", "rages", "ai",
+        "aiscript", "graphics", "moulds", "width", "height", "miny", "maxy",
+        "ambusher", "attackname", "auxloc", "changed_name", "_rank_cache",
+        "morph", "misc1", "misc2", "immunities", "absorb", "null",
+        "weakness", "attackanimation", "statuses", "special"]
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, name, monster_id):
         self.name = name
         self.graphicname = self.name
@@ -613,41 +699,20 @@ class MonsterBlock:
         self.copy_visible(chosen)
 
     def read_stats(self, filename):
-        global all_spells
         global HIGHEST_LEVEL
 
-        f = open(filename, 'r+b')
-        f.seek(self.pointer)
-        for key in stat_order:
-            self.stats[key] = ord(f.read(1))
-        self.stats['hp'] = read_multi(f, length=2)
-        self.stats['mp'] = read_multi(f, length=2)
-        self.stats['xp'] = read_multi(f, length=2)
-        self.stats['gp'] = read_multi(f, length=2)
-        self.stats['level'] = ord(f.read(1))
+        record = MONSTER_RECORD.read(filename, self.pointer)
+        for key in MONSTER_STATS:
+            self.stats[key] = record.pop(key)
+        for name, value in record.items():
+            setattr(self, name, value)
         self.oldlevel = self.stats['level']
         if self.stats['xp'] > 0:
             xps.append((self.oldlevel, self.stats['xp']))
         if self.stats['gp'] > 0:
             gps.append((self.oldlevel, self.stats['gp']))
 
-        self.morph = ord(f.read(1))
-        self.misc1 = ord(f.read(1))
-        self.misc2 = ord(f.read(1))
-
-        f.seek(self.pointer + 20)
-        self.immunities = list(f.read(3))
-        self.absorb = ord(f.read(1))
-        self.null = ord(f.read(1))
-        self.weakness = ord(f.read(1))
-
-        f.seek(self.pointer + 26)
-        self.attackanimation = ord(f.read(1))
-
-        f.seek(self.pointer + 27)
-        self.statuses = list(f.read(4))
-        self.special = ord(f.read(1))
-
+        f = open_rom(filename)
         f.seek(self.itemptr)
         self.items = list(f.read(4))
 
@@ -666,9 +731,6 @@ class MonsterBlock:
         f.seek(self.aiptr)
         self.ai = read_multi(f, length=2)
 
-        if all_spells is None:
-            all_spells = get_ranked_spells(filename)
-
         f.close()
 
         self.read_ai(filename)
@@ -708,15 +770,11 @@ class MonsterBlock:
             return
 
         skillset = set(self.get_skillset())
+        spell_classes = get_spell_classes()
 
         def similar(s1, s2):
-            a = s1.target_enemy_default == s2.target_enemy_default
-            b = s1.target_everyone == s2.target_everyone
-            c = s1.target_dead == s2.target_dead
-            d = s1.healing == s2.healing
-            e = s1.unreflectable == s2.unreflectable
-            f = s1.abort_on_allies == s2.abort_on_allies
-            return (a and b and c and d and e and f)
+            return (spell_classes.keys[s1.spellid] ==
+                    spell_classes.keys[s2.spellid])
         if madworld: 
             restricted = []
         elif easyrace:
@@ -727,16 +785,11 @@ class MonsterBlock:
         banned = restricted
         # No blizzard or tek laser in solo terra
         if safe_solo_terra:
-            from formationrandomizer import get_fset
-            for id in [0x39, 0x3A]:
-                fset = get_fset(id)
-                for f in fset.formations:
-                    if self in f.present_enemies:
-                        banned.extend([0xB5, 0xBA])
-                        break
-            
-        oldskills = sorted([s for s in all_spells if s.spellid in skillset],
-                           key=lambda s: s.rank())
+            from formationrandomizer import get_enemy_fsets
+            for id in get_enemy_fsets([0x39, 0x3A]).get(self, []):
+                banned.extend([0xB5, 0xBA])
+
+        oldskills = spell_classes.get_ranked(skillset)
         if change_skillset:
             skillmap = {}
             for skill in oldskills:
@@ -748,17 +801,9 @@ class MonsterBlock:
                     newskill = skill
                 else:
                     skillset.remove(skill.spellid)
-                    candidates = [s for s in all_spells if similar(s, skill)]
-                    candidates = [s for s in candidates if not
-                                  (s.is_blitz or s.is_swdtech or s.is_esper
-                                   or s.is_slots)]
-                    if random.choice([True, False]):
-                        candidates = [c for c in candidates if c.valid]
-                    candidates = [c for c in candidates if
-                                  c.spellid not in banned]
-                    if skill not in candidates:
-                        candidates.append(skill)
-                    candidates = sorted(candidates, key=lambda s: s.rank())
+                    candidates = spell_classes.get_candidates(
+                        skill, valid_only=random.choice([True, False]),
+                        banned=banned)
 
                     if self.is_boss or self.boss_death:
                         index = candidates.index(skill)
@@ -771,8 +816,7 @@ class MonsterBlock:
                 skillset.add(newskill.spellid)
                 skillmap[skill.spellid] = newskill.spellid
 
-        sortedskills = sorted([s for s in all_spells if s.spellid in skillset],
-                              key=lambda s: s.rank())
+        sortedskills = spell_classes.get_ranked(skillset)
 
         def mutate_action_skill(spellid):
             skill = [s for s in oldskills if s.spellid == spellid]
@@ -907,7 +951,7 @@ class MonsterBlock:
         self.aiscript = newscript
 
     def read_ai(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         pointer = self.ai + 0xF8700
         f.seek(pointer)
         seen = False
@@ -1024,33 +1068,11 @@ class MonsterBlock:
     def write_stats(self, fout):
         self.set_minimum_mp()
 
-        fout.seek(self.pointer)
-        for key in stat_order:
-            fout.write(bytes([self.stats[key]]))
-        write_multi(fout, self.stats['hp'], length=2)
-        write_multi(fout, self.stats['mp'], length=2)
-        write_multi(fout, self.stats['xp'], length=2)
-        write_multi(fout, self.stats['gp'], length=2)
-        fout.write(bytes([self.stats['level']]))
-
-        fout.write(bytes([self.morph]))
-        fout.write(bytes([self.misc1]))
-        fout.write(bytes([self.misc2]))
-
-        fout.seek(self.pointer + 20)
-        for i in self.immunities:
-            fout.write(bytes([i]))
-        fout.write(bytes([self.absorb]))
-        fout.write(bytes([self.null]))
-        fout.write(bytes([self.weakness]))
-
-        fout.seek(self.pointer + 26)
-        fout.write(bytes([self.attackanimation]))
-
-        fout.seek(self.pointer + 27)
-        for s in self.statuses:
-            fout.write(bytes([s]))
-        fout.write(bytes([self.special]))
+        record = dict(self.stats)
+        for name in MONSTER_RECORD.names:
+            if name not in record:
+                record[name] = getattr(self, name)
+        MONSTER_RECORD.write(fout, self.pointer, record)
 
         fout.seek(self.itemptr)
         fout.write(bytes(self.items))
@@ -1326,8 +1348,7 @@ class MonsterBlock:
         if random.choice([True, False]):
             random.shuffle(self.items)
 
-        items = get_ranked_items()
-        itemids = [i.itemid for i in items]
+        items = get_item_catalogue()
         new_items = []
         for i in self.items:
             if i == 0xFF:
@@ -1336,15 +1357,15 @@ class MonsterBlock:
                     new_items.append(0xFF)
                     continue
 
-            if i not in itemids:
+            try:
+                index = items.index(i)
+            except ValueError:
                 index = 0
-            else:
-                index = itemids.index(i)
-            index = mutate_index(index, len(itemids),
+            index = mutate_index(index, len(items),
                                  [False, False, False, True],
                                  (-3, 3), (-2, 2))
 
-            new_items.append(itemids[index])
+            new_items.append(items[index].itemid)
 
         new_items = [get_item(i) for i in new_items]
         steals, drops = (new_items[:2], new_items[2:])
@@ -1373,15 +1394,14 @@ class MonsterBlock:
         return rank
 
     def get_item_appropriate(self):
-        items = get_ranked_items()
+        items = get_item_catalogue()
         rank = self.level_rank()
         index = int(len(items) * rank)
         index = mutate_index(index, len(items),
                              [False, True],
                              (-3, 3), (-2, 2))
 
-        ranked_items = sorted(items, key=lambda i: i.rank())
-        item = ranked_items[index]
+        item = items[index]
         #print "%s/%s" % (self.stats['level'], HIGHEST_LEVEL), item.name
         return item
 
@@ -1432,8 +1452,7 @@ class MonsterBlock:
         self.stats['xp'] = fuddle(self.stats['xp'])
         self.stats['gp'] = fuddle(self.stats['gp'])
 
-        items = get_ranked_items()
-        itemids = [i.itemid for i in items]
+        items = get_item_catalogue()
         new_items = []
         for i in self.items:
             if i == 0xFF:
@@ -1442,12 +1461,12 @@ class MonsterBlock:
                 candidates = [i for i in candidates if i != 0xFF]
                 i = random.choice(sorted(candidates))
 
-            index = itemids.index(i)
-            index = mutate_index(index, len(itemids),
+            index = items.index(i)
+            index = mutate_index(index, len(items),
                                  [False, True],
                                  (-2, 4), (-1, 2))
 
-            new_items.append(itemids[index])
+            new_items.append(items[index].itemid)
 
         self.items = new_items
         assert 0xFF not in self.items
@@ -1693,42 +1712,37 @@ class MonsterBlock:
         itemrank = items[0] + (items[1]*7) + ((items[2] + (items[3]*7))*2)
         return itemrank / 32.0
 
+    def rank_features(self):
+        # The monster's score on each of RANK_KEYS, before weighting.
+        stats = self.stats
+        return (max(1, stats['def'] + stats['mdef']),
+                max(1, bin(self.absorb | self.null).count('1')),
+                max(1, stats['evade%'] + stats['mblock%']),
+                stats['hp'],
+                max(1, sum(bin(i).count('1') for i in self.immunities)),
+                max(1, self.itemrank()),
+                stats['level'],
+                max(1, stats['attack'], stats['mpow']),
+                stats['speed'])
+
     def rank(self, weights=None):
-        global globalweights
-        funcs = {}
-        funcs['level'] = lambda m: m.stats['level']
-        funcs['hp'] = lambda m: m.stats['hp']
-        funcs['defense'] = lambda m: max(1, m.stats['def'] + m.stats['mdef'])
-        funcs['offense'] = lambda m: max(1, m.stats['attack'], m.stats['mpow'])
-        funcs['evasion'] = lambda m: max(1, m.stats['evade%'] +
-                                         m.stats['mblock%'])
-        funcs['speed'] = lambda m: m.stats['speed']
-        funcs['elements'] = lambda m: max(1, bin(m.absorb | m.null).count('1'))
-        funcs['immunities'] = lambda m: max(1, sum(bin(i).count('1')
-                                            for i in m.immunities))
-        funcs['itemrank'] = lambda m: max(1, m.itemrank())
-
-        if not avgs:
-            monsters = get_monsters()
-            monsters = [m for m in monsters if not (m.is_boss or m.boss_death)]
-            for key in funcs:
-                avgs[key] = (sum(funcs[key](m) for m in monsters) /
-                             float(len(monsters)))
-
-        if weights is None:
-            if globalweights is None:
-                globalweights = [random.randint(0, 50) + random.randint(0, 50) for _ in avgs]
-            weights = globalweights
-        elif isinstance(weights, int):
-            weights = [50 for _ in avgs]
-
-        weights = dict(list(zip(sorted(avgs.keys()), weights)))
-        LEVELFACTOR, HPFACTOR = len(avgs)*2, len(avgs)
+        # Monsters are ranked over and over (formations and formation sets
+        # sum their monsters' ranks), mostly while nothing about them
+        # changes. The last rank is kept along with everything it came
+        # from (the features, whether the ai is the Blaze one, and the
+        # weights), so it is only worked out again when one of those has
+        # changed, however that happened. The features themselves are
+        # still gathered on every call; only the weighted sum is saved.
+        weights = get_rank_weights(weights)
+        features = self.rank_features()
+        cache_key = (features, self.has_blaze, weights)
+        cached = getattr(self, "_rank_cache", None)
+        if cached is not None and cached[0] == cache_key:
+            return cached[1]
+
         total = 0
-        for key in sorted(avgs):
-            if key == "level":
-                weights[key] = max(50, weights[key])
-            weighted = weights[key] * funcs[key](self) / avgs[key]
+        for key, feature, weight in zip(RANK_KEYS, features, weights):
+            weighted = weight * feature / avgs[key]
             if key == "level":
                 weighted *= LEVELFACTOR
             elif key == "hp":
@@ -1738,6 +1752,7 @@ class MonsterBlock:
         if self.has_blaze:
             total *= 1.5
 
+        self._rank_cache = (cache_key, total)
         return total
 
     def dummy_item(self, item):
@@ -1764,6 +1779,11 @@ def monsters_from_table(tablefile):
 
 
 def get_monsters(filename=None):
+    global all_spells
+    if all_spells is None:
+        get_ranked_items(filename)
+        all_spells = get_ranked_spells(filename)
+
     if monsterdict:
         return sorted(list(monsterdict.values()), key=lambda m: m.id)
 
@@ -1787,20 +1807,87 @@ def get_monster(monster_id):
     return monsterdict[monster_id]
 
 
+def get_rank_weights(weights=None):
+    # The weights MonsterBlock.rank uses, in RANK_KEYS order. The averages
+    # are taken, and the global weights rolled, the first time any monster
+    # is ranked.
+    global globalweights
+    if not avgs:
+        monsters = get_monsters()
+        monsters = [m for m in monsters if not (m.is_boss or m.boss_death)]
+        features = [m.rank_features() for m in monsters]
+        for i, key in enumerate(RANK_KEYS):
+            avgs[key] = (sum(f[i] for f in features) / float(len(monsters)))
+
+    if weights is None:
+        if globalweights is None:
+            globalweights = [random.randint(0, 50) + random.randint(0, 50)
+                             for _ in avgs]
+        weights = globalweights
+    elif isinstance(weights, int):
+        weights = [50 for _ in avgs]
+
+    weights = list(weights[:len(RANK_KEYS)])
+    weights[RANK_KEYS.index("level")] = max(
+        50, weights[RANK_KEYS.index("level")])
+    return tuple(weights)
+
+
+def get_monster_ranks(monsters, weights=None):
+    # The rank of every monster in `monsters`, worked out as one array
+    # operation when numpy is around. The arithmetic is the same as in
+    # MonsterBlock.rank, in the same order, so the results are too.
+    monsters = list(monsters)
+    if numpy is None or not monsters:
+        return [m.rank(weights) for m in monsters]
+
+    weights = get_rank_weights(weights)
+    rows = [m.rank_features() for m in monsters]
+    features = numpy.array(rows, dtype=numpy.float64)
+    total = numpy.zeros(len(monsters))
+    for i, (key, weight) in enumerate(zip(RANK_KEYS, weights)):
+        weighted = weight * features[:, i] / avgs[key]
+        if key == "level":
+            weighted *= LEVELFACTOR
+        elif key == "hp":
+            weighted *= HPFACTOR
+        total += weighted
+    blazes = [m.has_blaze for m in monsters]
+    total *= numpy.array([1.5 if blaze else 1 for blaze in blazes])
+
+    ranks = total.tolist()
+    for m, row, blaze, rank in zip(monsters, rows, blazes, ranks):
+        m._rank_cache = ((row, blaze, weights), rank)
+    return ranks
+
+
+def sort_by_rank(monsters, weights=None):
+    monsters = list(monsters)
+    ranks = get_monster_ranks(monsters, weights)
+    if numpy is None:
+        order = sorted(range(len(monsters)), key=lambda i: ranks[i])
+    else:
+        order = numpy.argsort(ranks, kind="stable").tolist()
+    return [monsters[i] for i in order]
+
+
 def get_ranked_monsters(filename=None, bosses=True):
     monsters = get_monsters(filename=filename)
     if not bosses:
         monsters = [m for m in monsters if m.id <= 0xFF]
-    monsters = sorted(monsters, key=lambda m: m.rank())
+    monsters = sort_by_rank(monsters)
     return monsters
 
 
 def shuffle_monsters(monsters, safe_solo_terra=True):
-    monsters = sorted(monsters, key=lambda m: m.rank())
+    monsters = sort_by_rank(monsters)
     monsters = [m for m in monsters if m.name.strip('_')]
     monsters = [m for m in monsters if m.display_name[:2] != "L."]
     bosses = [m for m in monsters if m.is_boss or m.boss_death]
     nonbosses = [m for m in monsters if m not in bosses]
+    if safe_solo_terra:
+        from formationrandomizer import get_enemy_fsets
+        narshe_caves = get_enemy_fsets([0x39, 0x3A])
     for m in monsters:
         if m.is_boss or m.boss_death:
             candidates = bosses
@@ -1842,15 +1929,7 @@ def shuffle_monsters(monsters, safe_solo_terra=True):
                                       for b in banned_narshe_skills)
 
             if banned_from_narshe:
-                in_narshe_caves = False
-
-                for id in [0x39, 0x3A]:
-                    from formationrandomizer import get_fset
-                    fset = get_fset(id)
-                    for f in fset.formations:
-                        if m in f.present_enemies or n in f.present_enemies:
-                            in_narshe_caves = True
-                            break
+                in_narshe_caves = m in narshe_caves or n in narshe_caves
 
             if not banned_from_narshe or not in_narshe_caves:
                 m.swap_ai(n)
@@ -1866,7 +1945,7 @@ class MonsterGraphicBlock:
 
     def read_data(self, filename):
         global palette_pools
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.graphics = read_multi(f, length=2)
         f.seek(self.pointer+2)
@@ -1882,8 +1961,7 @@ class MonsterGraphicBlock:
         self.palette_values = []
         numcolors = 0x20
 
-        for i in range(numcolors):
-            color = read_multi(f, length=2)
+        for color in read_palette(f, numcolors):
             blue = (color & 0x7c00) >> 10
             green = (color & 0x03e0) >> 5
             red = color & 0x001f
@@ -1946,8 +2024,7 @@ class MonsterGraphicBlock:
             return
 
         fout.seek(palette_pointer)
-        for color in self.palette_data:
-            write_multi(fout, color, length=2)
+        write_palette(fout, self.palette_data)
 
     def mutate_palette(self, alternatives=None):
         transformer = get_palette_transformer(basepalette=self.palette_data)
@@ -1959,7 +2036,7 @@ class MetamorphBlock:
         self.pointer = pointer
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.items = list(f.read(4))
         f.close()
@@ -6,8 +6,11 @@
 import configparser, os.path, re
 from copy import copy
 
-from utils import (utilrandom as rng, open_mei_fallback as open)
-from mml2mfvi import mml_to_akao
+from utils import (utilrandom as rng, open_mei_fallback as open,
+                   DeadEndError)
+from freespace import record_claim
+from songcache import SongCache
+from tablecache import load_table
 
 try:
     from sys import _MEIPASS
@@ -48,6 +51,7 @@ CONFIG.add_section('MusicPtr')
 CONFIG.add_section('General')
 
 freespace = None
+song_cache = SongCache()
 spoiler = {}
 f_tellmewhy = False
 DEBUG = False
@@ -76,18 +80,39 @@ def to_default(cfgname):
 def despoil(t=""):
     pass
 
+def read_config(sources):
+    config = configparser.ConfigParser()
+    config.read(sources)
+    return config
+
+def load_config(*vpaths):
+    # safepath() gives a list of places to look when frozen
+    sources = []
+    for vpath in vpaths:
+        path = safepath(vpath)
+        sources.extend(path if isinstance(path, list) else [path])
+    return load_table(sources, read_config)
+
 def dprint(t):
     pass
 
 ### begin functions shared with nascentorder
 
 def byte_insert(data, position, newdata, maxlength=0, end=0):
-    while position > len(data):
-        data = data + b"\x00"
+    # bytearrays are modified in place (and returned); other sequences
+    # are rebuilt as before.
+    if position > len(data):
+        if isinstance(data, bytearray):
+            data.extend(bytes(position - len(data)))
+        else:
+            data = data + bytes(position - len(data))
     if end:
         maxlength = end - position + 1
     if maxlength and len(data) > maxlength:
         newdata = newdata[:maxlength]
+    if isinstance(data, bytearray):
+        data[position:position+len(newdata)] = newdata
+        return data
     return data[:position] + newdata + data[position+len(newdata):]
 
     
@@ -110,8 +135,14 @@ def bytes_to_int(data, reversed=True):
             n = (n << (8 * i)) + d
     return n
     
-def put_somewhere(romdata, newdata, desc, f_silent=False):
-    global freespace, spoiler
+def put_somewhere(romdata, newdata, desc, f_silent=False, undo=None):
+    # The music pool stays a plain list, first fit in list order, rather
+    # than a freespace.FreeSpace: songs have to land where they always
+    # have, and that depends on the quirks below (claim_space drops the
+    # tail of a block it claims from the middle of, free_space merges
+    # blocks one byte apart and may shrink one it swallows, and the list
+    # is only kept sorted once something is freed or claimed).
+    global freespace
     if freespace is None:
         init_freespace()
     success = False
@@ -120,14 +151,15 @@ def put_somewhere(romdata, newdata, desc, f_silent=False):
         if room < len(newdata):
             continue
         else:
+            if undo is not None:
+                undo.append((start, bytes(romdata[start:start+len(newdata)])))
             romdata = byte_insert(romdata, start, newdata)
             freespace[i] = (start+len(newdata), end)
-            if 'ROM Map' not in spoiler: spoiler['ROM Map'] = []
-            spoiler['ROM Map'].append("  0x{:x} -- {}".format(start, desc))
-            success= True
+            record_claim(start, start+len(newdata), "music", desc.strip())
+            success = True
             break
     if not success:
-        if not silent: print("ERROR: not enough free space to insert {}\n\n".format(desc))
+        if not f_silent: print("ERROR: not enough free space to insert {}\n\n".format(desc))
         assert False
     return (romdata, start, end)
             
@@ -167,10 +199,11 @@ def free_space(start, end):
             newfs.append((start, end))
     freespace = newfs
 
-def claim_space(startc, endc):
+def claim_space(startc, endc, desc=None):
     global freespace
     if freespace is None: return
     if startc > endc: return
+    record_claim(startc, endc+1, "music", desc)
     newfs = []
     for i, (start, end) in enumerate(sorted(freespace)):
         if startc <= start and endc >= end:
@@ -196,8 +229,7 @@ def claim_space(startc, endc):
     
 def insert_instruments(data_in, metadata_pos= False):
     data = data_in
-    samplecfg = configparser.ConfigParser()
-    samplecfg.read(safepath(os.path.join('tables', 'samples.txt')))
+    samplecfg = load_config(os.path.join('tables', 'samples.txt'))
         
     #pull out instrument infos
     sampleptrs = [int(s.strip(),16) for s in CONFIG.get('MusicPtr', 'brrpointers').split(',')]
@@ -272,7 +304,7 @@ def insert_instruments(data_in, metadata_pos= False):
     CONFIG.set('MusicPtr', 'brrpointers', "{:x}, {:x}".format(sampleptrs[0], sampleptrs[0]+len(data)))
     if metadata_pos:
         p = metadata_pos
-        metadata = b"\x00"*0x600
+        metadata = bytearray(0x600)
         metadata = byte_insert(metadata, 0x0, loopdata)
         metadata = byte_insert(metadata, 0x200, pitchdata)
         metadata = byte_insert(metadata, 0x400, adsrdata)
@@ -373,9 +405,8 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
         i += 1
         
     # build identifier table
-    songconfig = configparser.ConfigParser()
-    songconfig.read(safepath(os.path.join('tables','defaultsongs.txt')))
-    songconfig.read(safepath(os.path.join('custom', 'songs.txt' if not f_altsonglist else 'songs_alt.txt')))
+    songconfig = load_config(os.path.join('tables','defaultsongs.txt'),
+                             os.path.join('custom', 'songs.txt' if not f_altsonglist else 'songs_alt.txt'))
     songtable = {}
     for ss in songconfig.items('SongSlots'):
         vals = [s.strip() for s in ss[1].split(',')]
@@ -476,7 +507,7 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
                 newidx += 1
             else:
                 bossids[i] = int(id, 16)
-        claim_space(songptraddrs[0], songptraddrs[0] + 3*len(songtable))
+        claim_space(songptraddrs[0], songptraddrs[0] + 3*len(songtable), desc="SONG POINTERS")
         
         # what this is trying to do is:
         # we judge songs by pure INTENSITY or by combined INTENSITY and GRANDEUR
@@ -614,32 +645,23 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
             except IOError:
                 print("couldn't open {}".format(sfx))
                 
-        return mml_to_akao(mml, name, True if id in [0x29, 0x4F] else False)
+        return song_cache.compile(mml, name, True if id in [0x29, 0x4F] else False)
     
-    def process_tierboss(opts, used_songs=[]):
-        opts = [o.strip() for o in opts.split(',')]
-        opts = [o for o in opts if usage_id(o) not in used_songs]
-        attempts = 0
-        fallback = False
-        while True:
-            attempts += 1
-            if attempts >= 1000:
-                print("warning: check your tierboss config in songs.txt")
-                fallback = True
-                attempts = 0
-            retry = False
-            tiernames = rng.sample(opts, 3)
-            tierfiles = []
-            for n in tiernames:
-                try:
-                    with open(os.path.join(MUSIC_PATH, n + '_dm.mml'), 'r') as f:
-                        tierfiles.append(f.read())
-                except IOError:
-                    print("couldn't open {}".format(n + '_dm.mml'))
-                    retry = True
-            if retry: continue
-            
-            mml = re.sub('[~!]', '', tierfiles[0])
+    # each song is rewritten differently for each place in the medley;
+    # the files do not change between attempts, so neither do those.
+    tierparts = {}
+    def tierpart(name, position):
+        if (name, position) in tierparts:
+            return tierparts[name, position]
+        try:
+            with open(os.path.join(MUSIC_PATH, name + '_dm.mml'), 'r') as f:
+                mml = f.read()
+        except IOError:
+            print("couldn't open {}".format(name + '_dm.mml'))
+            return None
+        
+        if position == 0:
+            mml = re.sub('[~!]', '', mml)
             mml = re.sub('[?_]', '?', mml)
             mml = re.sub('j([0-9]+),([0-9]+)', 'j\g<1>,555\g<2>', mml)
             mml = re.sub('([;:\$])([0-9]+)(?![,0-9])', '\g<1>555\g<2>', mml)
@@ -649,9 +671,8 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
             mml = re.sub('\$555444([0-9])', '{\g<1>}', mml)
             mml = re.sub('#def\s+(\S+)\s*=', '#def 555\g<1>=', mml, flags=re.IGNORECASE)
             mml = re.sub("'(.*)'", "'555\g<1>'", mml)
-            tierfiles[0] = mml
-            
-            mml = re.sub('[?!]', '', tierfiles[1])
+        elif position == 1:
+            mml = re.sub('[?!]', '', mml)
             mml = re.sub('[~_]', '?', mml)
             mml = re.sub('j([0-9]+),([0-9]+)', 'j\g<1>,666\g<2>', mml)
             mml = re.sub('([;:\$])([0-9]+)(?![,0-9])', '\g<1>666\g<2>', mml)
@@ -662,9 +683,8 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
             mml = re.sub('#def\s+(\S+)\s*=', '#def 666\g<1>=', mml, flags=re.IGNORECASE)
             mml = re.sub("'(.*)'", "'666\g<1>'", mml)
             mml = re.sub('"', ')', mml)
-            tierfiles[1] = mml
-            
-            mml = re.sub('[?_]', '', tierfiles[2])
+        else:
+            mml = re.sub('[?_]', '', mml)
             mml = re.sub('[~!]', '?', mml)
             mml = re.sub('j([0-9]+),([0-9]+)', 'j\g<1>,777\g<2>', mml)
             mml = re.sub('([;:\$])([0-9]+)(?![,0-9])', '\g<1>777\g<2>', mml)
@@ -674,14 +694,36 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
             mml = re.sub('#def\s+(\S+)\s*=', '#def 777\g<1>=', mml, flags=re.IGNORECASE)
             mml = re.sub("'(.*)'", "'777\g<1>'", mml)
             mml = re.sub('"', '(', mml)
-            tierfiles[2] = mml
+        tierparts[name, position] = mml
+        return mml
+    
+    def process_tierboss(opts, used_songs=[]):
+        opts = [o.strip() for o in opts.split(',')]
+        opts = [o for o in opts if usage_id(o) not in used_songs]
+        if len(opts) < 3:
+            raise DeadEndError("Not enough unused tierboss songs.")
+        attempts = 0
+        while True:
+            attempts += 1
+            if attempts >= 1000:
+                print("warning: check your tierboss config in songs.txt")
+                raise DeadEndError("No tierboss medley fits.")
+            tiernames = rng.sample(opts, 3)
+            tierfiles = [tierpart(n, i) for i, n in enumerate(tiernames)]
+            if None in tierfiles: continue
             
             mml = "#VARIANT / \n#VARIANT ? ignore \n" + tierfiles[0] + tierfiles[1] + tierfiles[2]
             ## uncomment to debug tierboss MML
             #with open("lbdebug.mml", "w") as f:
             #    f.write(mml)
                 
-            akao = mml_to_akao(mml, str(tiernames), variant='_default_')
+            # triples that an earlier run found too big are turned down
+            # without compiling them; a triple never compiled before is
+            # compiled the first time it comes up
+            size = song_cache.size(song_cache.key(mml, variant='_default_'))
+            if size is not None and size > 0x1002:
+                continue
+            akao = song_cache.compile(mml, str(tiernames), variant='_default_')
             inst = bytes(akao['_default_'][1], encoding='latin-1')
             akao = bytes(akao['_default_'][0], encoding='latin-1')
             if len(akao) > 0x1002:
@@ -690,6 +732,14 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
         for n in tiernames: used_songs.append(usage_id(n))
         return (akao, inst)
         
+    # song data is written into data_in in place; this undoes those
+    # writes if the song set has to be abandoned.
+    undo = []
+    def revert(data):
+        while undo:
+            start, old = undo.pop()
+            byte_insert(data, start, old)
+
     # choose replacement songs
     used_songs_backup = used_songs
     songtable_backup = songtable
@@ -887,13 +937,13 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
         songdata = b"" * len(space)
         songinst = data[isetlocs[0]:isetlocs[1]+1]    
         if f_moveinst: free_space(isetlocs[0], isetlocs[1])
-        claim_space(songptraddrs[0], songptraddrs[0] + 3*(len(songtable)+1))
+        claim_space(songptraddrs[0], songptraddrs[0] + 3*(len(songtable)+1), desc="SONG POINTERS")
         for ident, s in songtable.items():
             if not s.is_pointer:
                 try:
-                    data, start, end = put_somewhere(data, s.data, "  (song) [{:02x}] {}".format(s.id, s.changeto), True)
+                    data, start, end = put_somewhere(data, s.data, "  (song) [{:02x}] {}".format(s.id, s.changeto), True, undo=undo)
                 except AssertionError:
-                    data = data_in
+                    revert(data)
                     continue
                 songinst = byte_insert(songinst, s.id * isetsize, s.inst, isetsize)
                 songptrdata = int_insert(songptrdata, s.id * 3, start + HIROM, 3)
@@ -907,7 +957,8 @@ def process_custom_music(data_in, eventmodes="", f_randomize=True, f_battleprog=
         print("    try increasing available space or adjusting song insert list")
         print("    to use less space")
         print()
-        return data_in
+        revert(data)
+        raise DeadEndError("No valid music set.")
     
     # build battle music related tables
     if f_battleprog:
@@ -1061,13 +1112,11 @@ def randomize_music(fout, f_mchaos=False, codes=[], form_music_overrides={}):
         events += "W"
     if 'halloween' in codes:
         events += "H"
-    fout.seek(0)
-    data = fout.read()
+    # The music pipeline edits the output buffer's bytearray in place.
+    data = fout.data
     data = insert_instruments(data, INST_METADATA_OFFSET)
     data = process_custom_music(data, f_mchaos=f_mchaos, eventmodes=events)
     data = process_formation_music_by_table(data, form_music_overrides=form_music_overrides)
-    
-    fout.seek(0)
-    fout.write(data)
+    assert data is fout.data
     return "\n".join(spoiler['Music'])
     
\ No newline at end of file
@@ -2,18 +2,48 @@
 
 from utils import (ENEMY_NAMES_TABLE, MODIFIERS_TABLE, MOVES_TABLE,
                    NAMEGEN_TABLE, utilrandom as random)
+from tablecache import load_table
+
+
+def read_enemy_names(sources):
+    names = set(line.strip() for line in open(sources[0]))
+    # Every prefix of every name in use, so that a new name can be
+    # checked against all of them with a few set lookups.
+    prefixes = set(name[:i] for name in names
+                   for i in range(len(name) + 1))
+    return names, prefixes
+
+
+def read_generator(sources):
+    generator = {}
+    lookback = None
+    for line in open(sources[0]):
+        key, values = tuple(line.strip().split())
+        generator[key] = values
+        if not lookback:
+            lookback = len(key)
+    starts = sorted([s for s in generator if s[0].isupper()])
+    return generator, lookback, starts
+
 
 modifiers = [line.strip() for line in open(MODIFIERS_TABLE)]
 moves = [line.strip() for line in open(MOVES_TABLE)]
-enemynames = [line.strip() for line in open(ENEMY_NAMES_TABLE).readlines()]
-
-generator = {}
-lookback = None
-for line in open(NAMEGEN_TABLE):
-    key, values = tuple(line.strip().split())
-    generator[key] = values
-    if not lookback:
-        lookback = len(key)
+enemynames, nameprefixes = load_table([ENEMY_NAMES_TABLE], read_enemy_names)
+generator, lookback, starts = load_table([NAMEGEN_TABLE], read_generator)
+
+
+def name_taken(name):
+    # Whether `name` is in use, or, for a name long enough that it would
+    # be noticed, whether it starts or is the start of a name in use.
+    if name in enemynames:
+        return True
+    if len(name) > (lookback+1):
+        if name in nameprefixes:
+            return True
+        for i in range(len(name)):
+            if name[:i] in enemynames:
+                return True
+    return False
 
 
 def generate_name(size=None, maxsize=10):
@@ -29,7 +59,6 @@ def generate_name(size=None, maxsize=10):
         return False
 
     while True:
-        starts = sorted([s for s in generator if s[0].isupper()])
         name = random.choice(starts)
         name = name[:size]
         while len(name) < size:
@@ -51,22 +80,12 @@ def generate_name(size=None, maxsize=10):
             c = random.choice(generator[key])
             name = name + c
 
-        for ename in enemynames:
-            if name == ename:
-                name = ""
-                break
-
-        if name:
-            for ename in enemynames:
-                if len(name) > (lookback+1):
-                    length = min(len(name), len(ename))
-                    if name[:length] == ename[:length]:
-
-                        name = ""
-                        break
+        if name_taken(name):
+            name = ""
 
         if len(name) >= size:
-            enemynames.append(name)
+            enemynames.add(name)
+            nameprefixes.update(name[:i] for i in range(len(name) + 1))
             return name
 
 
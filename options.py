@@ -0,0 +1,159 @@
+"""The version, flags and secret codes, and the command line answers that
+need nothing else: --help and --check. This module must not import any
+of the rom modules; randomizer.py runs it before importing them."""
+
+from sys import exit
+
+VERSION = "2"
+BETA = False
+VERSION_ROMAN = "II"
+if BETA:
+    VERSION_ROMAN += " BETA"
+
+FLAG_HELP = '''o   Shuffle characters' in-battle commands.
+w   Generate new commands for characters, replacing old commands.
+z   Always have "Sprint Shoes" effect.
+b   Make the game more balanced by removing exploits such as Joker Doom,
+        Vanish/Doom, and the Evade/Mblock bug.
+m   Randomize enemy stats.
+c   Randomize palettes and names of various things.
+i   Randomize the stats of equippable items.
+q   Randomize what equipment each character can wear and character stats.
+e   Randomize esper spells and levelup bonuses.
+t   Randomize treasure, including chests, colosseum, shops, and enemy drops.
+u   Umaro risk. (Random character will be berserk)
+l   Randomize blitz inputs.
+n   Randomize window background colors.
+f   Randomize enemy formations.
+s   Swap character graphics around.
+p   Randomize the palettes of spells and weapon animations.
+d   Randomize final dungeon.
+g   Randomize dances
+k   Randomize the clock in Zozo
+r   Randomize character locations in the world of ruin.
+0-9 Shorthand for the text saved under that digit, if any
+-   Use all flags EXCEPT the ones listed'''
+
+FLAGS = "owzbmciqetulnfspdgkr"
+
+# In the order they are taken out of the flag string, which matters where
+# one code is part of another.
+SECRET_CODES = {
+    'airship': "AIRSHIP MODE",
+    'partyparty': "CRAZY PARTY MODE",
+    'bravenudeworld': "TINA PARTY MODE",
+    'suplexwrecks': "SUPLEX MODE",
+    'strangejourney': "BIZARRE ADVENTURE",
+    'dearestmolulu': "ENCOUNTERLESS MODE",
+    'canttouchthis': "INVINCIBILITY",
+    'easymodo': "EASY MODE",
+    'norng': "NO RNG MODE",
+    'endless9': "ENDLESS NINE MODE",
+    'equipanything': "EQUIP ANYTHING MODE",
+    'collateraldamage': "ITEM BREAK MODE",
+    'repairpalette': "PALETTE REPAIR",
+    'llg': "LOW LEVEL GAME MODE",
+    'naturalmagic': "NATURAL MAGIC MODE",
+    'naturalstats': "NATURAL STATS MODE",
+    'playsitself': "AUTOBATTLE MODE",
+    'bingoboingo': "BINGO BONUS",
+    'worringtriad': "START IN WOR",
+    'ancientcave': "CHAOS TOWER MODE",
+    'speedcave': "FAST CHAOS TOWER MODE",
+    'racecave': "EXTRA FAST CHAOS TOWER MODE",
+    'metronome': "R-CHAOS MODE",
+    'quikdraw': "QUIKDRAW MODE",
+    'makeover': "SPRITE REPLACEMENT MODE",
+    'kupokupo': "MOOGLE MODE",
+    'capslockoff': "Mixed Case Names Mode",
+    'replaceeverything': "REPLACE ALL SKILLS MODE",
+    'allcombos': "ALL COMBOS MODE",
+    'randomboost': "RANDOM BOOST MODE",
+    'dancingmaduin': "RESTRICTED ESPERS MODE",
+    'masseffect': "WILD EQUIPMENT EFFECT MODE",
+    'darkworld': "SLASHER'S DELIGHT MODE",
+    'supernatural': "SUPER NATURAL MAGIC MODE",
+    'madworld': "TIERS FOR FEARS MODE",
+    'randombosses': "RANDOM BOSSES MODE",
+    'electricboogaloo': "WILD ITEM BREAK MODE",
+    'notawaiter': "CUTSCENE SKIPS",
+    'rushforpower': "OLD VARGAS FIGHT MODE",
+    'johnnydmad': "MUSIC REPLACEMENT MODE",
+    'johnnyachaotic': "MUSIC MANGLING MODE",
+    'easyrace': "EASY RACE MODE",
+}
+
+# Choose what randomize() writes; the rom alone if none are given.
+OUTPUT_ARGS = ["--ips", "--bps", "--rom"]
+
+USAGE = '''Usage:
+  randomizer.py [<rom> <version>.<flags>.<seed> [test]] [<output>...]
+                [--timing | --profile]
+  randomizer.py batch [-j<processes>] <rom> <version>.<flags>.<seed>...
+                [<output>...]
+  randomizer.py --check <version>.<flags>.<seed>
+  randomizer.py --help
+
+Anything not given on the command line is asked for. A blank seed picks
+one from the clock, and blank flags turn every flag on.
+
+Outputs:
+  --ips   Write an IPS patch against the (unheadered) source rom
+  --bps   Write a BPS patch against the (unheadered) source rom
+  --rom   Write the randomized rom as well; it is left out when a patch
+          is asked for, and written on its own otherwise.'''
+
+
+def check_fullseed(fullseed):
+    """Split a seed string into (version, flags, seed, codes, unused),
+    with the secret codes found in the flags and the characters left over
+    that are not flags, digits or dashes. The randomizer takes those
+    without complaint and they change nothing, so they are only reported.
+    Raises ValueError if it is not a seed string."""
+    try:
+        version, flags, seed = tuple(fullseed.split('.'))
+    except ValueError:
+        raise ValueError('Seed should be in the format '
+                         '<version>.<flags>.<seed>')
+    seed = seed.strip()
+    if seed and not seed.isdigit():
+        raise ValueError('Seed "%s" is not a number' % seed)
+
+    rest = flags.lower()
+    codes = []
+    for code in SECRET_CODES:
+        if code in rest:
+            rest = rest.replace(code, '')
+            codes.append(code)
+    unused = sorted(set(c for c in rest
+                        if c not in FLAGS + "0123456789- "))
+    return version, flags, seed, codes, unused
+
+
+def run_info_commands(args):
+    # Exits after --help or --check; anything else is left to the
+    # randomizer.
+    if len(args) > 1 and args[1] in ["-h", "--help"]:
+        print('Beyond Chaos EX randomizer version "%s".\n' % VERSION)
+        print(USAGE + "\n\nFlags:\n" + FLAG_HELP)
+        exit()
+
+    if len(args) > 1 and args[1] == "--check":
+        if len(args) < 3:
+            print(USAGE)
+            exit(2)
+        try:
+            version, flags, seed, codes, unused = check_fullseed(
+                args[2].strip())
+        except ValueError as e:
+            print("ERROR: %s" % e)
+            exit(1)
+        if version and version != VERSION:
+            print("WARNING! Version mismatch! "
+                  "This seed will not produce the expected result!")
+        for code in codes:
+            print("SECRET CODE: %s" % SECRET_CODES[code])
+        if unused:
+            print("NOTE: These flags do nothing: %s" % ''.join(unused))
+        print("Seed string is valid.")
+        exit()
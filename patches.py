@@ -0,0 +1,128 @@
+"""IPS and BPS patches that turn the source rom into a randomized one.
+
+Both are made by comparing the finished rom with the source, rather than
+by keeping track of writes: the music inserter edits the rom buffer
+directly, and a region written with the bytes it already had needs no
+patch at all.
+"""
+
+import re
+from zlib import crc32
+
+# A record starting at this offset would read as the end of the patch.
+IPS_EOF = 0x454F46
+IPS_MAX_SIZE = 0xFFFF
+# Shorter runs of one byte are cheaper as plain data than as an RLE record.
+IPS_RLE_MIN = 16
+BPS_RLE_MIN = 8
+
+
+def changed_runs(source, target, gap=0):
+    """The (start, end) ranges where target differs from source, joining
+    ranges that are at most `gap` bytes apart. Anything past the end of
+    the source counts as changed."""
+    size = min(len(source), len(target))
+    # XORing the two as big integers keeps the comparison in C.
+    diff = (int.from_bytes(source[:size], 'little') ^
+            int.from_bytes(target[:size], 'little')).to_bytes(size, 'little')
+    runs = []
+    for match in re.finditer(b'[^\x00]+', diff):
+        start, end = match.span()
+        if runs and start - runs[-1][1] <= gap:
+            runs[-1][1] = end
+        else:
+            runs.append([start, end])
+    if len(target) > size:
+        if runs and size - runs[-1][1] <= gap:
+            runs[-1][1] = len(target)
+        else:
+            runs.append([size, len(target)])
+    return runs
+
+
+def repeats(data, start, end, length):
+    # (start, end, is_repeat) pieces of data[start:end], where the
+    # repeats are runs of one byte at least `length` long.
+    pattern = re.compile(b'(.)\\1{%d,}' % (length - 1), re.DOTALL)
+    position = start
+    for match in pattern.finditer(data, start, end):
+        if match.start() > position:
+            yield position, match.start(), False
+        yield match.start(), match.end(), True
+        position = match.end()
+    if position < end:
+        yield position, end, False
+
+
+def make_ips(source, target):
+    if len(target) > IPS_EOF:
+        raise ValueError("IPS patches cannot reach past 0x%x; use BPS."
+                         % IPS_EOF)
+    patch = bytearray(b"PATCH")
+    # A record costs five bytes, so joining two records across a gap of
+    # up to five unchanged bytes costs nothing.
+    for start, end in changed_runs(source, target, gap=5):
+        for first, last, repeat in repeats(target, start, end, IPS_RLE_MIN):
+            for offset in range(first, last, IPS_MAX_SIZE):
+                size = min(last - offset, IPS_MAX_SIZE)
+                patch += offset.to_bytes(3, 'big')
+                if repeat:
+                    patch += b"\x00\x00" + size.to_bytes(2, 'big')
+                    patch.append(target[offset])
+                else:
+                    patch += size.to_bytes(2, 'big')
+                    patch += target[offset:offset+size]
+    patch += b"EOF"
+    if len(target) < len(source):
+        patch += len(target).to_bytes(3, 'big')
+    return bytes(patch)
+
+
+def bps_number(value):
+    encoded = bytearray()
+    while True:
+        low = value & 0x7F
+        value >>= 7
+        if value == 0:
+            encoded.append(0x80 | low)
+            return encoded
+        encoded.append(low)
+        value -= 1
+
+
+def make_bps(source, target, metadata=b""):
+    patch = bytearray(b"BPS1")
+    patch += bps_number(len(source))
+    patch += bps_number(len(target))
+    patch += bps_number(len(metadata))
+    patch += metadata
+
+    def action(command, length):
+        patch.extend(bps_number(((length - 1) << 2) | command))
+
+    # Actions: 0 copies the source at the same offset, 1 is literal data
+    # and 3 copies earlier output, which repeats a byte when it starts
+    # one byte back.
+    output, copy_offset = 0, 0
+    for start, end in changed_runs(source, target, gap=2):
+        if start > output:
+            action(0, start - output)
+        for first, last, repeat in repeats(target, start, end, BPS_RLE_MIN):
+            if repeat:
+                action(1, 1)
+                patch.append(target[first])
+                action(3, last - first - 1)
+                delta = first - copy_offset
+                patch += bps_number((abs(delta) << 1) | (delta < 0))
+                copy_offset = last - 1
+            else:
+                action(1, last - first)
+                patch += target[first:last]
+        output = end
+    if output < len(target):
+        action(0, len(target) - output)
+
+    patch += crc32(source).to_bytes(4, 'little')
+    patch += crc32(target).to_bytes(4, 'little')
+    patch += crc32(patch).to_bytes(4, 'little')
+    return bytes(patch)
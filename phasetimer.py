@@ -0,0 +1,163 @@
+import cProfile
+import json
+import os
+import tracemalloc
+from functools import wraps
+from time import perf_counter, process_time
+
+
+def count_changed(old, new):
+    # Number of byte positions that differ, plus any growth. XORing the
+    # two buffers as big integers keeps the whole thing in C.
+    size = max(len(old), len(new))
+    diff = (int.from_bytes(old, 'little') ^
+            int.from_bytes(new, 'little')).to_bytes(size, 'little')
+    return size - diff.count(0)
+
+
+class PhaseTimer(object):
+    """Records wall time, CPU time, peak memory and ROM bytes changed for
+    every phase of a randomization run.
+
+    A phase is any call to a function wrapped with `instrument`, so phases
+    can nest; each record carries its depth. Peak memory comes from
+    tracemalloc, which slows the run down considerably, so it can be
+    switched off. With `profile` set, each top-level phase also gets its
+    own cProfile profile.
+    """
+    def __init__(self, memory=True, profile=False):
+        self.memory = memory
+        self.profile = profile
+        self.phases = []
+        self.profiles = []
+        self.stack = []
+        self.wrapped = []
+        self.get_rom = lambda: None
+        self.started = None
+        self.peak = 0
+
+    def start(self, get_rom=None):
+        if get_rom is not None:
+            self.get_rom = get_rom
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.started = (perf_counter(), process_time())
+
+    def stop(self):
+        for namespace, name, function in reversed(self.wrapped):
+            setattr(namespace, name, function)
+        self.wrapped = []
+        wall, cpu = self.started
+        self.total = {"wall": perf_counter() - wall,
+                      "cpu": process_time() - cpu}
+        if self.memory and tracemalloc.is_tracing():
+            self.total["peak_memory"] = max(
+                self.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    def instrument(self, namespace, names):
+        for name in names:
+            function = getattr(namespace, name)
+            setattr(namespace, name, self.wrap(name, function))
+            self.wrapped.append((namespace, name, function))
+
+    def wrap(self, name, function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def rom_bytes(self):
+        rom = self.get_rom()
+        if rom is None:
+            return b""
+        return bytes(rom.data)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+
+class Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        timer = self.timer
+        self.depth = len(timer.stack)
+        self.index = len(timer.phases)
+        self.record = {"name": self.name, "depth": self.depth}
+        timer.phases.append(self.record)
+        timer.stack.append(self)
+
+        self.peak = 0
+        if timer.memory and tracemalloc.is_tracing():
+            # The parent's peak so far has to be kept before resetting it.
+            parent = timer.stack[-2] if self.depth else timer
+            parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        self.rom = timer.rom_bytes()
+        if timer.profile and self.depth == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.wall, self.cpu = perf_counter(), process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu = perf_counter() - self.wall, process_time() - self.cpu
+        timer = self.timer
+        if self.profiler is not None:
+            self.profiler.disable()
+            timer.profiles.append((self.index, self.name, self.profiler))
+
+        self.record["wall"] = wall
+        self.record["cpu"] = cpu
+        self.record["rom_bytes_changed"] = count_changed(
+            self.rom, timer.rom_bytes())
+        if timer.memory and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            self.record["peak_memory"] = self.peak
+        if exc[0] is not None:
+            self.record["error"] = exc[0].__name__
+
+        timer.stack.pop()
+        parent = timer.stack[-1] if timer.stack else timer
+        parent.peak = max(parent.peak, self.peak)
+        return False
+
+
+def write_report(timer, filename, profile_dir=None):
+    # Per name totals leave out calls made from inside a call of the same
+    # name, so that a phase that calls itself is not counted twice.
+    totals, names = {}, []
+    for record in timer.phases:
+        del names[record["depth"]:]
+        total = totals.setdefault(record["name"],
+                                  {"calls": 0, "wall": 0, "cpu": 0})
+        total["calls"] += 1
+        if record["name"] not in names:
+            total["wall"] += record.get("wall", 0)
+            total["cpu"] += record.get("cpu", 0)
+        names.append(record["name"])
+
+    toplevel = sum(r.get("wall", 0) for r in timer.phases
+                   if r["depth"] == 0)
+    report = {"total": timer.total,
+              "outside_phases": {"wall": timer.total["wall"] - toplevel},
+              "phases": timer.phases,
+              "by_name": sorted(
+                  [dict(name=name, **total)
+                   for (name, total) in totals.items()],
+                  key=lambda t: t["wall"], reverse=True)}
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    if profile_dir and timer.profiles:
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        for index, name, profiler in timer.profiles:
+            profiler.dump_stats(os.path.join(
+                profile_dir, "%03d.%s.prof" % (index, name)))
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
-from time import time, sleep, gmtime
 from sys import argv, exit
-from shutil import copyfile
+if __name__ == "__main__":
+    # --help and --check need none of the rom modules imported below.
+    from options import run_info_commands
+    run_info_commands(argv)
+
+from time import time, gmtime
 import os
+from copy import deepcopy
 from hashlib import md5
+from importlib import import_module
+from io import IOBase
+from random import Random
+from types import (ModuleType, FunctionType, BuiltinFunctionType, MethodType,
+                   MemberDescriptorType)
 from utils import (ESPER_TABLE,
                    CHAR_TABLE, COMMAND_TABLE, LOCATION_TABLE,
                    LOCATION_PALETTE_TABLE, CHARACTER_PALETTE_TABLE,
@@ -14,10 +24,12 @@ from utils import (ESPER_TABLE,
                    MOOGLE_NAMES_TABLE, SKIP_EVENTS_TABLE, DANCE_NAMES_TABLE,
                    Substitution, shorttexttable, name_to_bytes,
                    hex2int, int2bytes, read_multi, write_multi,
+                   read_palette, write_palette,
                    generate_swapfunc, shift_middle, get_palette_transformer,
                    battlebg_palettes, set_randomness_multiplier,
                    mutate_index, utilrandom as random, open_mei_fallback,
-                   dialogue_to_bytes)
+                   dialogue_to_bytes, RomImage, RomBuffer, set_rom_image,
+                   get_rom_image, open_rom, DeadEndError)
 from skillrandomizer import (SpellBlock, CommandBlock, SpellSub, ComboSpellSub,
                              RandomSpellSub, MultipleSpellSub, ChainSpellSub,
                              get_ranked_spells, get_spell)
@@ -25,8 +37,9 @@ from monsterrandomizer import (MonsterGraphicBlock, get_monsters,
                                get_metamorphs, get_ranked_monsters,
                                shuffle_monsters, get_monster, read_ai_table)
 from itemrandomizer import (reset_equippable, get_ranked_items, get_item,
-                            reset_special_relics, reset_rage_blizzard,
-                            reset_cursed_shield, unhack_tintinabar)
+                            get_item_catalogue, reset_special_relics,
+                            reset_rage_blizzard, reset_cursed_shield,
+                            unhack_tintinabar)
 from esperrandomizer import (EsperBlock, allocate_espers)
 from shoprandomizer import (ShopBlock, buy_owned_breakable_tools)
 from namerandomizer import generate_name
@@ -35,24 +48,28 @@ from formationrandomizer import (get_formations, get_fsets,
 from locationrandomizer import (EntranceSet,
                                 get_locations, get_location, get_zones)
 from chestrandomizer import mutate_event_items, get_event_items
-from towerrandomizer import randomize_tower
-from musicrandomizer import randomize_music
-from menufeatures import (improve_item_display, improve_gogo_status_menu, improve_rage_menu, show_original_names, improve_dance_menu)
 from decompress import Decompressor
+from freespace import FreeSpace, get_rom_map, reset_rom_map
+from options import (VERSION, BETA, VERSION_ROMAN, FLAG_HELP,
+                     SECRET_CODES, OUTPUT_ARGS)
+from patches import make_ips, make_bps
 
 
-VERSION = "2"
-BETA = False
-VERSION_ROMAN = "II"
-if BETA:
-    VERSION_ROMAN += " BETA"
+# Imported by the phases that use them, through import_deferred, not on
+# startup.
+DEFERRED_MODULES = ["menufeatures", "musicrandomizer", "towerrandomizer"]
 TEST_ON = False
 TEST_SEED = "3.partypartymakeovercapslockoffnotawaitereasyrace-ul.42070"
 TEST_FILE = "FF3.smc"
 seed, flags = None, None
 seedcounter = 1
 sourcefile, outfile = None, None
+# The name the source rom is registered under while it is randomized.
+SOURCE_ROM = "<source rom>"
 fout = None
+# Canned replies to the prompts asked during randomization, for runs with
+# nobody at the keyboard. Missing replies count as a blank line.
+answers = None
 
 
 NEVER_REPLACE = ["fight", "item", "magic", "row", "def", "magitek", "lore",
@@ -72,6 +89,8 @@ REPLACE_ENEMIES = [0x10f, 0x136, 0x137]
 REPLACE_FORMATIONS = [0x20e, 0x1ca, 0x1e9, 0x1fa]
 KEFKA_EXTRA_FORMATION = 0x1FF  # Fake Atma
 NOREPLACE_FORMATIONS = [0x232, 0x1c5, 0x1bb, 0x230, KEFKA_EXTRA_FORMATION]
+# How many times a phase that fails is tried before the seed is given up.
+RETRY_ATTEMPTS = 5
 
 
 TEK_SKILLS = (# [0x18, 0x6E, 0x70, 0x7D, 0x7E] +
@@ -89,6 +108,12 @@ changed_commands = set([])
 randlog = {}
 
 
+def ask(prompt, key):
+    if answers is not None:
+        return answers.get(key, "")
+    return input(prompt)
+
+
 def log(text, section):
     global randlog
     if section not in randlog:
@@ -186,6 +211,45 @@ def reseed():
     seedcounter += (seedcounter * 2) + 1
 
 
+def get_subseed(name, attempt):
+    # Depends only on the seed, so a seed that needs a retry always gets
+    # the same one.
+    key = "%s.%s.%s" % (seed, name, attempt)
+    return int(md5(key.encode()).hexdigest(), 16) % (10**10)
+
+
+def retry_phase(function, *args, **kwargs):
+    # Some phases can paint themselves into a corner (the tower router,
+    # the ancient cave, the hidden formations, the music inserter). Rather
+    # than throw away the whole seed, such a phase is undone and run again
+    # with a sub-seed of its own. The phase's arguments are rolled back
+    # with everything else. The first attempt uses the usual random
+    # stream, so seeds that never fail are unchanged, and the phases after
+    # it are reseeded as normal either way. Only a DeadEndError is retried;
+    # anything else is a bug, and is left to stop the seed.
+    name = function.__name__
+    snapshot = Snapshot([args, kwargs])
+    retries = []
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            result = function(*args, **kwargs)
+            break
+        except DeadEndError as e:
+            if attempt == RETRY_ATTEMPTS:
+                raise
+            snapshot.restore()
+            subseed = get_subseed(name, attempt)
+            s = "%s failed (%s), retried with sub-seed %s" % (name, e, subseed)
+            print(s)
+            retries.append(s)
+            random.seed(subseed)
+    # The rollback takes the log back as well, so the retries are only
+    # logged once there are no more of them.
+    for s in retries:
+        log(s, section=None)
+    return result
+
+
 def rewrite_title(text):
     while len(text) < 20:
         text += ' '
@@ -196,18 +260,17 @@ def rewrite_title(text):
     fout.write(bytes([int(VERSION)]))
 
 
-def rewrite_checksum(filename=None):
-    if filename is None:
-        filename = outfile
+def rewrite_checksum(f=None):
+    if f is None:
+        f = fout
     MEGABIT = 0x20000
-    f = open(filename, 'r+b')
+    f.seek(0)
     subsums = [sum(f.read(MEGABIT)) for _ in range(32)]
     checksum = sum(subsums) & 0xFFFF
     f.seek(0xFFDE)
     write_multi(f, checksum, length=2)
     f.seek(0xFFDC)
     write_multi(f, checksum ^ 0xFFFF, length=2)
-    f.close()
 
 
 class AutoLearnRageSub(Substitution):
@@ -273,46 +336,6 @@ class EnableEsperMagicSub(Substitution):
         super(EnableEsperMagicSub, self).write(filename)
 
 
-class FreeBlock:
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
-
-    @property
-    def size(self):
-        return self.end - self.start
-
-    def unfree(self, start, length):
-        end = start + length
-        if start < self.start:
-            raise Exception("Used space out of bounds (left)")
-        elif end > self.end:
-            raise Exception("Used space out of bounds (right)")
-        newfree = []
-        if self.start != start:
-            newfree.append(FreeBlock(self.start, start))
-        if end != self.end:
-            newfree.append(FreeBlock(end, self.end))
-        self.start, self.end = None, None
-        return newfree
-
-
-def get_appropriate_freespace(freespaces, size):
-    candidates = [c for c in freespaces if c.size >= size]
-    if not candidates:
-        raise Exception("Not enough free space")
-
-    candidates = sorted(candidates, key=lambda f: f.size)
-    return candidates[0]
-
-
-def determine_new_freespaces(freespaces, myfs, size):
-    freespaces.remove(myfs)
-    fss = myfs.unfree(myfs.start, size)
-    freespaces.extend(fss)
-    return freespaces
-
-
 equip_offsets = {"weapon": 15,
                  "shield": 16,
                  "helm": 17,
@@ -517,7 +540,7 @@ class WindowBlock():
         self.pointer = 0x2d1c00 + (windowid * 0x20)
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.palette = []
         if 'christmas' in activated_codes:
@@ -653,14 +676,14 @@ def get_espers():
 
 
 def randomize_colosseum(filename, fout, pointer):
-    item_objs = get_ranked_items(filename)
+    item_objs = get_item_catalogue(filename)
     monster_objs = get_ranked_monsters(filename, bosses=False)
     items = [i.itemid for i in item_objs]
     monsters = [m.id for m in monster_objs]
     results = []
     for i in range(0xFF):
         try:
-            index = items.index(i)
+            index = item_objs.index(i)
         except ValueError:
             continue
         trade = index
@@ -675,11 +698,11 @@ def randomize_colosseum(filename, fout, pointer):
         while random.randint(1, 3) < 3:
             opponent += random.randint(-1, 1)
             opponent = max(0, min(opponent, len(monsters)-1))
+        wager_obj = item_objs[index]
+        opponent_obj = monster_objs[opponent]
+        win_obj = item_objs[trade]
         trade = items[trade]
         opponent = monsters[opponent]
-        wager_obj = [j for j in item_objs if j.itemid == i][0]
-        opponent_obj = [m for m in monster_objs if m.id == opponent][0]
-        win_obj = [j for j in item_objs if j.itemid == trade][0]
         fout.seek(pointer + (i*4))
         fout.write(bytes([opponent]))
         fout.seek(pointer + (i*4) + 2)
@@ -1003,9 +1026,8 @@ def manage_commands_new(commands):
     # replacing jump makes the character never come back down
     # replacing mimic screws up enemy skills too
     characters = get_characters()
-    freespaces = []
-    freespaces.append(FreeBlock(0x2A65A, 0x2A800))
-    freespaces.append(FreeBlock(0x2FAAC, 0x2FC6D))
+    freespaces = FreeSpace([(0x2A65A, 0x2A800), (0x2FAAC, 0x2FC6D)],
+                           name="commands")
 
     multibannedlist = [0x63, 0x58, 0x5B]
 
@@ -1319,13 +1341,11 @@ def manage_commands_new(commands):
                 assert False
             break
 
-        myfs = get_appropriate_freespace(freespaces, s.size)
-        s.set_location(myfs.start)
+        s.set_location(freespaces.allocate(s.size, desc=c.name))
         if not hasattr(s, "bytestring") or not s.bytestring:
             s.generate_bytestring()
         s.write(fout)
         c.setpointer(s.location, fout)
-        freespaces = determine_new_freespaces(freespaces, myfs, s.size)
 
         if len(newname) > 7:
             newname = newname.replace('-', '')
@@ -1379,13 +1399,11 @@ def manage_commands_new(commands):
         magitek.allow_while_confused(fout)
         magitek.allow_while_berserk(fout)
 
-        myfs = get_appropriate_freespace(freespaces, s.size)
-        s.set_location(myfs.start)
+        s.set_location(freespaces.allocate(s.size, desc="magitek"))
         if not hasattr(s, "bytestring") or not s.bytestring:
             s.generate_bytestring()
         s.write(fout)
         magitek.setpointer(s.location, fout)
-        freespaces = determine_new_freespaces(freespaces, myfs, s.size)
 
     gogo_enable_all_sub = Substitution()
     gogo_enable_all_sub.bytestring = bytes([0xEA] * 2)
@@ -1402,21 +1420,16 @@ def manage_commands_new(commands):
 
 def manage_suplex(commands, monsters):
     characters = get_characters()
-    freespaces = []
-    freespaces.append(FreeBlock(0x2A65A, 0x2A800))
-    freespaces.append(FreeBlock(0x2FAAC, 0x2FC6D))
+    freespaces = FreeSpace([(0x2FAAC, 0x2FC6D)], name="commands")
     c = [d for d in commands.values() if d.id == 5][0]
-    myfs = freespaces.pop()
     s = SpellSub(spellid=0x5F)
     sb = SpellBlock(0x5F, sourcefile)
-    s.set_location(myfs.start)
+    s.set_location(freespaces.allocate(s.size, desc="suplex"))
     s.write(fout)
     c.targeting = sb.targeting
     c.setpointer(s.location, fout)
     c.newname(sb.name, fout)
     c.unsetmenu(fout)
-    fss = myfs.unfree(s.location, s.size)
-    freespaces.extend(fss)
     for c in characters:
         c.set_battle_command(0, command_id=0)
         c.set_battle_command(1, command_id=5)
@@ -1556,7 +1569,7 @@ def manage_equip_umaro(freespaces):
     equip_umaro_sub.set_location(0x39EF6)
     equip_umaro_sub.write(fout)
 
-    f = open(sourcefile, 'r+b')
+    f = open_rom(sourcefile)
     f.seek(0xC359D)
     old_unequipper = f.read(218)
     f.close()
@@ -1590,10 +1603,10 @@ def manage_equip_umaro(freespaces):
     unequip_umaro_sub.set_location(0xC351E)
     unequip_umaro_sub.write(fout)
 
-    myfs = get_appropriate_freespace(freespaces, 234)
-    pointer = myfs.start
+    pointer = freespaces.find(234)
     unequip_umaro_sub.bytestring = generate_unequipper(pointer, not_current_party=True)
-    freespaces = determine_new_freespaces(freespaces, myfs, unequip_umaro_sub.size)
+    freespaces.claim(pointer, pointer + unequip_umaro_sub.size,
+                     desc="umaro unequipper")
     unequip_umaro_sub.set_location(pointer)
     unequip_umaro_sub.write(fout)
     unequip_umaro_sub.bytestring = [
@@ -1802,9 +1815,7 @@ def activate_airship_mode(freespaces):
         [0xFF] +  # end map script
         [0xFE]  # end subroutine
         )
-    myfs = get_appropriate_freespace(freespaces, set_airship_sub.size)
-    pointer = myfs.start
-    freespaces = determine_new_freespaces(freespaces, myfs, set_airship_sub.size)
+    pointer = freespaces.allocate(set_airship_sub.size, desc="airship mode")
 
     set_airship_sub.set_location(pointer)
     set_airship_sub.write(fout)
@@ -1909,7 +1920,7 @@ def manage_balance(newslots=True):
 
     manage_rng()
     if newslots:
-        randomize_slots(outfile, fout, 0x24E4A)
+        randomize_slots(sourcefile, fout, 0x24E4A)
 
     death_abuse_sub.write(fout)
 
@@ -1971,7 +1982,7 @@ def manage_final_boss(freespaces):
     kefka2 = get_monster(0x11a)  # dummied kefka
     for m in [kefka1, kefka2]:
         pointer = m.ai + 0xF8700
-        freespaces.append(FreeBlock(pointer, pointer + m.aiscriptsize))
+        freespaces.free(pointer, pointer + m.aiscriptsize)
     aiscripts = read_ai_table(FINAL_BOSS_AI_TABLE)
 
     aiscript = aiscripts['KEFKA 1']
@@ -2008,10 +2019,9 @@ def manage_final_boss(freespaces):
     k2formation.lookup_enemies()
 
     for m in [kefka1, kefka2]:
-        myfs = get_appropriate_freespace(freespaces, m.aiscriptsize)
-        pointer = myfs.start
+        pointer = freespaces.allocate(m.aiscriptsize,
+                                      desc="%s AI" % m.name.strip('_'))
         m.set_relative_ai(pointer)
-        freespaces = determine_new_freespaces(freespaces, myfs, m.aiscriptsize)
 
     kefka1.write_stats(fout)
     kefka2.write_stats(fout)
@@ -2136,7 +2146,7 @@ def manage_monster_appearance(monsters, preserve_graphics=False):
 def recolor_character_palette(pointer, palette=None, flesh=False, middle=True, santa=False):
     fout.seek(pointer)
     if palette is None:
-        palette = [read_multi(fout, length=2) for _ in range(16)]
+        palette = read_palette(fout, 16)
         outline, eyes, hair, skintone, outfit1, outfit2, NPC = (
             palette[:2], palette[2:4], palette[4:6], palette[6:8],
             palette[8:10], palette[10:12], palette[12:])
@@ -2179,8 +2189,7 @@ def recolor_character_palette(pointer, palette=None, flesh=False, middle=True, s
         palette = new_palette
 
     fout.seek(pointer)
-    for p in palette:
-        write_multi(fout, p, length=2)
+    write_palette(fout, palette)
     return palette
 
 
@@ -2749,10 +2758,10 @@ def manage_palettes(change_to, char_ids):
 
     def recolor_palette(pointer, size):
         fout.seek(pointer)
-        palette = [read_multi(fout, length=2) for _ in range(size)]
+        palette = read_palette(fout, size)
         palette = transformer(palette)
         fout.seek(pointer)
-        [write_multi(fout, c, length=2) for c in palette]
+        write_palette(fout, palette)
 
     recolor_palette(0x2cfd4, 23)
     recolor_palette(0x268000+(7*0x20), 16)
@@ -2782,7 +2791,7 @@ def manage_colorize_animations():
     for i in range(240):
         pointer = 0x126000 + (i*16)
         fout.seek(pointer)
-        palette = [read_multi(fout, length=2) for _ in range(8)]
+        palette = read_palette(fout, 8)
         palettes.append(palette)
 
     for i, palette in enumerate(palettes):
@@ -2790,7 +2799,7 @@ def manage_colorize_animations():
         palette = transformer(palette)
         pointer = 0x126000 + (i*16)
         fout.seek(pointer)
-        [write_multi(fout, c, length=2) for c in palette]
+        write_palette(fout, palette)
 
 
 def manage_items(items, changed_commands=None):
@@ -2932,9 +2941,7 @@ def manage_reorder_rages(freespaces):
         0x60,               # RTS
         ]
 
-    myfs = get_appropriate_freespace(freespaces, rage_reorder_sub.size)
-    pointer = myfs.start
-    freespaces = determine_new_freespaces(freespaces, myfs, rage_reorder_sub.size)
+    pointer = freespaces.allocate(rage_reorder_sub.size, desc="rage reorder")
     rage_reorder_sub.set_location(pointer)
     rage_reorder_sub.write(fout)
 
@@ -3050,9 +3057,7 @@ def manage_esper_boosts(freespaces):
     assert esper_boost_sub.bytestring.count(0x60) == 3
     boost_subs.append(esper_boost_sub)
     for boost_sub in boost_subs:
-        myfs = get_appropriate_freespace(freespaces, boost_sub.size)
-        pointer = myfs.start
-        freespaces = determine_new_freespaces(freespaces, myfs, boost_sub.size)
+        pointer = freespaces.allocate(boost_sub.size, desc="esper boost")
         boost_sub.set_location(pointer)
 
         if None in boost_sub.bytestring:
@@ -3157,7 +3162,7 @@ def manage_treasure(monsters, shops=True, easyrace=False):
         buyables = manage_shops()
 
     pointer = 0x1fb600
-    results = randomize_colosseum(outfile, fout, pointer)
+    results = randomize_colosseum(sourcefile, fout, pointer)
     wagers = dict([(a.itemid, c) for (a, b, c, d) in results])
 
     def ensure_striker():
@@ -3559,17 +3564,17 @@ def manage_formations_hidden(formations, freespaces, esper_graphics=None, form_m
                 raise Exception("Double mutation detected.")
 
             try:
-                myfs = get_appropriate_freespace(freespaces, ue.aiscriptsize)
-            except:
+                freespaces.find(ue.aiscriptsize)
+            except DeadEndError:
                 continue
 
             break
         else:
-            continue
+            raise DeadEndError("No room for the AI of enemy %x." % ue.id)
 
-        pointer = myfs.start
+        pointer = freespaces.allocate(ue.aiscriptsize,
+                                      desc="%x AI" % ue.id)
         ue.set_relative_ai(pointer)
-        freespaces = determine_new_freespaces(freespaces, myfs, ue.aiscriptsize)
 
         itembreaker = 'collateraldamage' in activated_codes
         randombosses = 'randombosses' in activated_codes
@@ -3589,8 +3594,7 @@ def manage_formations_hidden(formations, freespaces, esper_graphics=None, form_m
         ue.changed_name = name
         ue.misc1 &= (0xFF ^ 0x4)  # always show name
         ue.write_stats(fout)
-        fout.flush()
-        ue.read_ai(outfile)
+        ue.read_ai(RomImage(fout.getvalue()))
         mutated_ues.append(ue.id)
         for m in get_monsters():
             if m.id != ue.id:
@@ -3774,7 +3778,7 @@ def manage_colorize_dungeons(locations=None, freespaces=None):
 
     from itertools import product
     if freespaces is None:
-        freespaces = [FreeBlock(0x271530, 0x271650)]
+        freespaces = FreeSpace([(0x271530, 0x271650)], name="palettes")
 
     done = []
     for line in open(LOCATION_PALETTE_TABLE):
@@ -3824,7 +3828,7 @@ def manage_colorize_dungeons(locations=None, freespaces=None):
             if pointer in done:
                 #raise Exception("Already recolored palette %x" % pointer)
                 continue
-            raw_palette = [read_multi(fout, length=2) for i in range(0x30)]
+            raw_palette = read_palette(fout, 0x30)
             if transformer is None:
                 if bg in [0x33, 0x34, 0x35, 0x36]:
                     transformer = get_palette_transformer(always=True)
@@ -3834,17 +3838,17 @@ def manage_colorize_dungeons(locations=None, freespaces=None):
             new_palette = transformer(raw_palette)
 
             fout.seek(pointer)
-            [write_multi(fout, c, length=2) for c in new_palette]
+            write_palette(fout, new_palette)
             done.append(pointer)
 
         for p in palettes:
             if p in done:
                 raise Exception("Already recolored palette %x" % p)
             fout.seek(p)
-            raw_palette = [read_multi(fout, length=2) for i in range(0x80)]
+            raw_palette = read_palette(fout, 0x80)
             new_palette = transformer(raw_palette)
             fout.seek(p)
-            [write_multi(fout, c, length=2) for c in new_palette]
+            write_palette(fout, new_palette)
             done.append(p)
 
 
@@ -3856,40 +3860,40 @@ def manage_colorize_dungeons(locations=None, freespaces=None):
 def manage_colorize_wor():
     transformer = get_palette_transformer(always=True)
     fout.seek(0x12ed00)
-    raw_palette = [read_multi(fout, length=2) for i in range(0x80)]
+    raw_palette = read_palette(fout, 0x80)
     new_palette = transformer(raw_palette)
     fout.seek(0x12ed00)
-    [write_multi(fout, c, length=2) for c in new_palette]
+    write_palette(fout, new_palette)
 
     fout.seek(0x12ef40)
-    raw_palette = [read_multi(fout, length=2) for i in range(0x60)]
+    raw_palette = read_palette(fout, 0x60)
     new_palette = transformer(raw_palette)
     fout.seek(0x12ef40)
-    [write_multi(fout, c, length=2) for c in new_palette]
+    write_palette(fout, new_palette)
 
     fout.seek(0x12ef00)
-    raw_palette = [read_multi(fout, length=2) for i in range(0x12)]
+    raw_palette = read_palette(fout, 0x12)
     airship_transformer = get_palette_transformer(basepalette=raw_palette)
     new_palette = airship_transformer(raw_palette)
     fout.seek(0x12ef00)
-    [write_multi(fout, c, length=2) for c in new_palette]
+    write_palette(fout, new_palette)
 
     for battlebg in [1, 5, 0x29, 0x2F]:
         palettenum = battlebg_palettes[battlebg]
         pointer = 0x270150 + (palettenum * 0x60)
         fout.seek(pointer)
-        raw_palette = [read_multi(fout, length=2) for i in range(0x30)]
+        raw_palette = read_palette(fout, 0x30)
         new_palette = transformer(raw_palette)
         fout.seek(pointer)
-        [write_multi(fout, c, length=2) for c in new_palette]
+        write_palette(fout, new_palette)
 
     for palette_index in [0x16, 0x2c, 0x2d, 0x29]:
         field_palette = 0x2dc480 + (256 * palette_index)
         fout.seek(field_palette)
-        raw_palette = [read_multi(fout, length=2) for i in range(0x80)]
+        raw_palette = read_palette(fout, 0x80)
         new_palette = transformer(raw_palette)
         fout.seek(field_palette)
-        [write_multi(fout, c, length=2) for c in new_palette]
+        write_palette(fout, new_palette)
 
 
 
@@ -4016,8 +4020,9 @@ def manage_encounter_rate():
 
 
 def manage_tower():
+    towerrandomizer = import_deferred("towerrandomizer")
     locations = get_locations()
-    randomize_tower(filename=sourcefile)
+    towerrandomizer.randomize_tower(filename=sourcefile)
     for l in locations:
         if l.locid in [0x154, 0x155] + list(range(104, 108)):
             # leo's thamasa, etc
@@ -4483,13 +4488,13 @@ def manage_bingo():
            "    i   Items\n"
            "    m   Monsters\n"
            "    s   Spells")
-    bingoflags = input("> ").strip()
+    bingoflags = ask("> ", "bingoflags").strip()
     if not bingoflags:
         bingoflags = "aims"
     bingoflags = [c for c in "aims" if c in bingoflags]
 
     print("What size grid? (default: 5)")
-    size = input("> ").strip()
+    size = ask("> ", "bingosize").strip()
     if not size:
         size = 5
     else:
@@ -4497,7 +4502,7 @@ def manage_bingo():
     target_score = float(target_score) * (size**2)
 
     print("What difficulty level? Easy, Normal, or Hard? (e/n/h)")
-    difficulty = input("> ").strip()
+    difficulty = ask("> ", "bingodifficulty").strip()
     if not difficulty:
         difficulty = "n"
     else:
@@ -4506,7 +4511,7 @@ def manage_bingo():
             difficulty = "n"
 
     print("Generate how many cards? (default: 1)")
-    numcards = input("> ").strip()
+    numcards = ask("> ", "bingocards").strip()
     if not numcards:
         numcards = 1
     else:
@@ -4867,7 +4872,7 @@ def manage_clock():
     random.shuffle(wrong_hours)
     hour_to_hex = [dialogue_to_bytes('2', null_terminate=False),dialogue_to_bytes('4', null_terminate=False), dialogue_to_bytes('6', null_terminate=False), dialogue_to_bytes('8', null_terminate=False), dialogue_to_bytes('10', null_terminate=False), dialogue_to_bytes('12', null_terminate=False)]
 
-    f = open(sourcefile, 'r+b')
+    f = open_rom(sourcefile)
     start = 0xDACC7
     end = 0xDAD18
     f.seek(start)
@@ -4887,7 +4892,7 @@ def manage_clock():
     ptr_start = 0xCE602
     ptr_index = 0x416
 
-    f = open(outfile, 'r+b')
+    f = fout
     offset = 0
 
     #adjust text pointers
@@ -4903,8 +4908,6 @@ def manage_clock():
         f.seek(location)
         write_multi(f, ptr + offset, 2)
 
-    f.close()
-
     # Change text that says "Hand's pointin' at the two."
     if minute != 0:
         minute_text_sub = Substitution()
@@ -5131,7 +5134,6 @@ def manage_ancient(form_music_overrides={}):
     for c in characters:
         i = c.id
         cptr = 0x2d7ca0 + 0x15 + (i*22)
-        fout.flush()
         fout.seek(cptr)
         level = ord(fout.read(1))
         level &= 0xF3
@@ -5319,12 +5321,16 @@ def manage_ancient(form_music_overrides={}):
     pilot_sub.set_location(0xC2110)
     pilot_sub.write(fout)
 
+    towerrandomizer = import_deferred("towerrandomizer")
     if "racecave" in activated_codes:
-        randomize_tower(filename=sourcefile, ancient=True, nummaps=50)
+        towerrandomizer.randomize_tower(filename=sourcefile, ancient=True,
+                                        nummaps=50)
     elif "speedcave" in activated_codes:
-        randomize_tower(filename=sourcefile, ancient=True, nummaps=85)
+        towerrandomizer.randomize_tower(filename=sourcefile, ancient=True,
+                                        nummaps=85)
     else:
-        randomize_tower(filename=sourcefile, ancient=True, nummaps=300)
+        towerrandomizer.randomize_tower(filename=sourcefile, ancient=True,
+                                        nummaps=300)
     manage_map_names()
 
     unused_enemies = [u for u in get_monsters() if u.id in REPLACE_ENEMIES]
@@ -6188,7 +6194,7 @@ def manage_dances():
          dances = random.sample(spells, 32)
          dances = [s.spellid for s in dances]
     else:
-        f = open(sourcefile, 'r+b')
+        f = open_rom(sourcefile)
         f.seek(0x0FFE80)
         dances = bytes(f.read(32))
         f.close()
@@ -6516,16 +6522,24 @@ def expand_rom():
         expand_sub.write(fout)
 
 
-def randomize():
-    global outfile, sourcefile, flags, seed, fout, ALWAYS_REPLACE, NEVER_REPLACE
+def randomize(args=None, replies=None):
+    global outfile, answers
 
-    args = list(argv)
+    args = list(argv if args is None else args)
+    answers = replies
+    timer = None
+    if "--timing" in args or "--profile" in args:
+        from phasetimer import PhaseTimer
+        timer = PhaseTimer(profile="--profile" in args)
+        args = [a for a in args if a not in ["--timing", "--profile"]]
+    patch_formats = [f for f in ["ips", "bps"] if "--" + f in args]
+    keep_rom = "--rom" in args or not patch_formats
+    args = [a for a in args if a not in OUTPUT_ARGS]
     if TEST_ON:
         while len(args) < 3:
             args.append(None)
         args[1] = TEST_FILE
         args[2] = TEST_SEED
-    sleep(0.5)
     print('You are using Beyond Chaos EX randomizer version "%s".' % VERSION)
     if BETA:
         print("WARNING: This version is a beta! Things may not work correctly.")
@@ -6572,30 +6586,6 @@ def randomize():
         print("Success! Using valid rom file: %s\n" % sourcefile)
     del(f)
 
-    flaghelptext = '''o   Shuffle characters' in-battle commands.
-w   Generate new commands for characters, replacing old commands.
-z   Always have "Sprint Shoes" effect.
-b   Make the game more balanced by removing exploits such as Joker Doom,
-        Vanish/Doom, and the Evade/Mblock bug.
-m   Randomize enemy stats.
-c   Randomize palettes and names of various things.
-i   Randomize the stats of equippable items.
-q   Randomize what equipment each character can wear and character stats.
-e   Randomize esper spells and levelup bonuses.
-t   Randomize treasure, including chests, colosseum, shops, and enemy drops.
-u   Umaro risk. (Random character will be berserk)
-l   Randomize blitz inputs.
-n   Randomize window background colors.
-f   Randomize enemy formations.
-s   Swap character graphics around.
-p   Randomize the palettes of spells and weapon animations.
-d   Randomize final dungeon.
-g   Randomize dances
-k   Randomize the clock in Zozo
-r   Randomize character locations in the world of ruin.
-0-9 Shorthand for the text saved under that digit, if any
--   Use all flags EXCEPT the ones listed'''
-
     speeddial_opts = {}
     saveflags = False
     if len(args) > 2:
@@ -6615,7 +6605,7 @@ r   Randomize character locations in the world of ruin.
             except IOError:
                 pass
 
-            print(flaghelptext + "\n")
+            print(FLAG_HELP + "\n")
             print("Save frequently used flag sets by adding 0: through 9: before the flags.")
             for k, v in sorted(speeddial_opts.items()):
                 print("    %s: %s" % (k, v))
@@ -6643,7 +6633,6 @@ r   Randomize character locations in the world of ruin.
     else:
         seed = int(seed)
     seed = seed % (10**10)
-    reseed()
 
     if saveflags:
         try:
@@ -6657,40 +6646,128 @@ r   Randomize character locations in the world of ruin.
         tempname = sourcefile.rsplit('.', 1)
     else:
         tempname = [sourcefile, 'smc']
-    outfile = '.'.join([tempname[0], str(seed), tempname[1]])
+    patchfiles = ['.'.join([tempname[0], str(seed), f])
+                  for f in patch_formats]
+    if keep_rom:
+        outfile = '.'.join([tempname[0], str(seed), tempname[1]])
+    else:
+        outfile = patchfiles[0]
     outlog = '.'.join([tempname[0], str(seed), 'txt'])
 
     if len(data) % 0x400 == 0x200:
         print("NOTICE: Headered ROM detected. Output file will have no header.")
         data = data[0x200:]
-        sourcefile = '.'.join([tempname[0], "unheadered", tempname[1]])
-        f = open(sourcefile, 'w+b')
-        f.write(data)
-        f.close()
 
     h = md5(data).hexdigest()
     if h != MD5HASH:
         print ("WARNING! The md5 hash of this file does not match the known "
                "hash of the english FF6 1.0 rom!")
-        x = input("Continue? y/n ")
+        x = ask("Continue? y/n ", "continue")
         if not (x and x.lower()[0] == 'y'):
             return
 
-    copyfile(sourcefile, outfile)
-
     flags = flags.lower()
     flags = flags.replace('endless9', 'endless~nine~')
     for d in "0123456789":
         if d in speeddial_opts:
-            replacement = speeddial_opts[d]
-        else:
-            replacement = ''
-        flags = flags.replace(d, replacement)
+            flags = flags.replace(d, speeddial_opts[d])
     flags = flags.replace('endless~nine~', 'endless9')
 
     if version and version != VERSION:
         print ("WARNING! Version mismatch! "
                "This seed will not produce the expected result!")
+
+    options = {'timer': timer}
+    if 'randomboost' in flags:
+        options['randomboost'] = ask("Please enter a randomness "
+                                     "multiplier value (blank for tierless): ",
+                                     "randomboost")
+
+    rom, spoiler = generate(data, flags, seed, options)
+
+    if keep_rom:
+        f = open(outfile, 'wb')
+        f.write(rom)
+        f.close()
+
+    # The patches apply to the unheadered source, which is what the
+    # output rom was made from.
+    for patch_format, patchfile in zip(patch_formats, patchfiles):
+        make_patch = make_ips if patch_format == "ips" else make_bps
+        f = open(patchfile, 'wb')
+        f.write(make_patch(data, rom))
+        f.close()
+
+    f = open(outlog, 'w+')
+    f.write(spoiler)
+    f.close()
+
+    if timer is not None:
+        report = '.'.join([tempname[0], str(seed), 'timing', 'json'])
+        profiles = '.'.join([tempname[0], str(seed), 'profile'])
+        from phasetimer import write_report
+        write_report(timer, report, profile_dir=profiles)
+        print("Timing report: %s" % report)
+
+    for patchfile in patchfiles:
+        if patchfile != outfile:
+            print("Patch: %s" % patchfile)
+    print("Randomization successful. Output filename: %s\n" % outfile)
+
+    if 'bingoboingo' in activated_codes:
+        manage_bingo()
+
+
+def generate(source_bytes, flags, seed, options=None):
+    """Randomize the unheadered rom in `source_bytes`.
+
+    `flags` is the flag string, secret codes included, and `seed` is the
+    seed number. `options` holds the replies to what the command line
+    asks about: "randomboost" is the randomness multiplier (blank or
+    missing for tierless). It can also hold a PhaseTimer as "timer", which
+    then times every phase of the run. Nothing is asked, and the rom and
+    log are returned rather than written out; the text tables and custom
+    songs are still read from disk, and the table and song caches under
+    cache/ may be written. Returns the new rom and the spoiler log.
+    """
+    options = options or {}
+    timer = options.get('timer')
+    if timer is None:
+        load_source(source_bytes)
+        return randomize_rom(flags, seed, options)
+
+    from sys import modules
+    module = modules[__name__]
+    timer.start(get_rom=lambda: fout)
+    timer.instrument(module, ["load_source"] + sorted(
+        name for (name, value) in vars(module).items()
+        if isinstance(value, FunctionType) and
+        name.split('_')[0] in ["manage", "randomize"] and
+        name not in ["randomize_rom", "randomize_batch"]))
+    # The tower and music phases live in modules that are only imported
+    # when the flags call for them, so they are not in vars(module).
+    timer.instrument(import_deferred("towerrandomizer"), ["randomize_tower"])
+    timer.instrument(import_deferred("musicrandomizer"), ["randomize_music"])
+    timer.instrument(Decompressor, ["compress_and_write"])
+    try:
+        load_source(source_bytes)
+        return randomize_rom(flags, seed, options)
+    finally:
+        timer.stop()
+
+
+def randomize_rom(flagstring, seednum, options):
+    global flags, seed, sourcefile, fout, ALWAYS_REPLACE, NEVER_REPLACE
+
+    flags = flagstring.lower()
+    flags = flags.replace('endless9', 'endless~nine~')
+    for d in "0123456789":
+        flags = flags.replace(d, '')
+    flags = flags.replace('endless~nine~', 'endless9')
+    seed = int(seednum) % (10**10)
+    sourcefile = SOURCE_ROM
+    reseed()
+
     s = "Using seed: %s.%s.%s" % (VERSION, flags, seed)
     print(s)
     log(s, section=None)
@@ -6699,53 +6776,13 @@ r   Randomize character locations in the world of ruin.
     log("For more information, visit https://github.com/subtractionsoup/beyondchaos",
         section=None)
 
+    reset_rom_map()
     commands = commands_from_table(COMMAND_TABLE)
     commands = dict([(c.name, c) for c in commands])
 
     characters = get_characters()
 
-    secret_codes['airship'] = "AIRSHIP MODE"
-    secret_codes['partyparty'] = "CRAZY PARTY MODE"
-    secret_codes['bravenudeworld'] = "TINA PARTY MODE"
-    secret_codes['suplexwrecks'] = "SUPLEX MODE"
-    secret_codes['strangejourney'] = "BIZARRE ADVENTURE"
-    secret_codes['dearestmolulu'] = "ENCOUNTERLESS MODE"
-    secret_codes['canttouchthis'] = "INVINCIBILITY"
-    secret_codes['easymodo'] = "EASY MODE"
-    secret_codes['norng'] = "NO RNG MODE"
-    secret_codes['endless9'] = "ENDLESS NINE MODE"
-    secret_codes['equipanything'] = "EQUIP ANYTHING MODE"
-    secret_codes['collateraldamage'] = "ITEM BREAK MODE"
-    secret_codes['repairpalette'] = "PALETTE REPAIR"
-    secret_codes['llg'] = "LOW LEVEL GAME MODE"
-    secret_codes['naturalmagic'] = "NATURAL MAGIC MODE"
-    secret_codes['naturalstats'] = "NATURAL STATS MODE"
-    secret_codes['playsitself'] = "AUTOBATTLE MODE"
-    secret_codes['bingoboingo'] = "BINGO BONUS"
-    secret_codes['worringtriad'] = "START IN WOR"
-    secret_codes['ancientcave'] = "CHAOS TOWER MODE"
-    secret_codes['speedcave'] = "FAST CHAOS TOWER MODE"
-    secret_codes['racecave'] = "EXTRA FAST CHAOS TOWER MODE"
-    secret_codes['metronome'] = "R-CHAOS MODE"
-    secret_codes['quikdraw'] = "QUIKDRAW MODE"
-    secret_codes['makeover'] = "SPRITE REPLACEMENT MODE"
-    secret_codes['kupokupo'] = "MOOGLE MODE"
-    secret_codes['capslockoff'] = "Mixed Case Names Mode"
-    secret_codes['replaceeverything'] = "REPLACE ALL SKILLS MODE"
-    secret_codes['allcombos'] = "ALL COMBOS MODE"
-    secret_codes['randomboost'] = "RANDOM BOOST MODE"
-    secret_codes['dancingmaduin'] = "RESTRICTED ESPERS MODE"
-    secret_codes['masseffect'] = "WILD EQUIPMENT EFFECT MODE"
-    secret_codes['darkworld'] = "SLASHER'S DELIGHT MODE"
-    secret_codes['supernatural'] = "SUPER NATURAL MAGIC MODE"
-    secret_codes['madworld'] = "TIERS FOR FEARS MODE"
-    secret_codes['randombosses'] = "RANDOM BOSSES MODE"
-    secret_codes['electricboogaloo'] = "WILD ITEM BREAK MODE"
-    secret_codes['notawaiter'] = "CUTSCENE SKIPS"
-    secret_codes['rushforpower'] = "OLD VARGAS FIGHT MODE"
-    secret_codes['johnnydmad'] = "MUSIC REPLACEMENT MODE"
-    secret_codes['johnnyachaotic'] = "MUSIC MANGLING MODE"
-    secret_codes['easyrace'] = "EASY RACE MODE"
+    secret_codes.update(SECRET_CODES)
     s = ""
     for code, text in secret_codes.items():
         if code in flags:
@@ -6768,8 +6805,7 @@ r   Randomize character locations in the world of ruin.
     print(s.strip())
 
     if 'randomboost' in activated_codes:
-        x = input("Please enter a randomness "
-                      "multiplier value (blank for tierless): ")
+        x = options.get('randomboost')
         try:
             multiplier = float(x)
             if multiplier <= 0:
@@ -6780,7 +6816,7 @@ r   Randomize character locations in the world of ruin.
     elif 'madworld' in activated_codes or 'easyrace' in activated_codes:
         set_randomness_multiplier(None)
 
-    fout = open(outfile, "r+b")
+    fout = RomBuffer(get_rom_image(sourcefile).data)
     expand_rom()
 
     print (
@@ -6805,20 +6841,20 @@ r   Randomize character locations in the world of ruin.
 
     if 'o' in flags and 'suplexwrecks' not in activated_codes:
         manage_commands(commands)
-        improve_gogo_status_menu(fout)
+        import_deferred("menufeatures").improve_gogo_status_menu(fout)
     reseed()
 
     spells = get_ranked_spells(sourcefile)
     if 'madworld' in activated_codes or 'easyrace' in activated_codes:
         random.shuffle(spells)
         for i, s in enumerate(spells):
-            s._rank = i+1
+            s.set_rank(i+1)
             s.valid = True
     if 'w' in flags and 'suplexwrecks' not in activated_codes:
         if 'quikdraw' in activated_codes:
             ALWAYS_REPLACE += ["rage"]
         _, freespaces = manage_commands_new(commands)
-        improve_gogo_status_menu(fout)
+        import_deferred("menufeatures").improve_gogo_status_menu(fout)
     reseed()
 
     if 'z' in flags:
@@ -6841,10 +6877,9 @@ r   Randomize character locations in the world of ruin.
     zones = get_zones(sourcefile)
     get_metamorphs(sourcefile)
 
-    aispaces = []
-    aispaces.append(FreeBlock(0xFCF50, 0xFCF50 + 384))
-    aispaces.append(FreeBlock(0xFFF47, 0xFFF47 + 87))
-    aispaces.append(FreeBlock(0xFFFBE, 0xFFFBE + 66))
+    aispaces = FreeSpace([(0xFCF50, 0xFCF50 + 384),
+                          (0xFFF47, 0xFFF47 + 87),
+                          (0xFFFBE, 0xFFFBE + 66)], name="ai")
 
     if 'd' in flags or 'ancientcave' in activated_codes:
         # do this before treasure
@@ -6873,13 +6908,13 @@ r   Randomize character locations in the world of ruin.
     items = get_ranked_items()
     if 'i' in flags:
         manage_items(items, changed_commands=changed_commands)
-        improve_item_display(fout)
+        import_deferred("menufeatures").improve_item_display(fout)
     reseed()
 
     if 'm' in flags:
         aispaces = manage_final_boss(aispaces)
         monsters = manage_monsters()
-        improve_rage_menu(fout)
+        import_deferred("menufeatures").improve_rage_menu(fout)
     reseed()
 
     if 'm' in flags or 'o' in flags or 'w' in flags:
@@ -6897,7 +6932,7 @@ r   Randomize character locations in the world of ruin.
                  'christmas', 'halloween',
                  'kupokupo', 'quikdraw']) & activated_codes):
         manage_character_appearance(preserve_graphics=preserve_graphics)
-        show_original_names(fout)
+        import_deferred("menufeatures").show_original_names(fout)
     reseed()
 
     if 'q' in flags:
@@ -6905,7 +6940,8 @@ r   Randomize character locations in the world of ruin.
         manage_equipment(items)
     reseed()
 
-    esperrage_spaces = [FreeBlock(0x26469, 0x26469 + 919)]
+    esperrage_spaces = FreeSpace([(0x26469, 0x26469 + 919)],
+                                 name="espers")
     if 'e' in flags:
         if 'dancingmaduin' in activated_codes:
             allocate_espers('ancientcave' in activated_codes, get_espers(), get_characters(), fout)
@@ -6984,7 +7020,7 @@ r   Randomize character locations in the world of ruin.
 
     if 'd' in flags and 'ancientcave' not in activated_codes:
         # do this before treasure
-        manage_tower()
+        retry_phase(manage_tower)
     reseed()
 
     if 'f' in flags or 't' in flags:
@@ -6992,7 +7028,8 @@ r   Randomize character locations in the world of ruin.
 
     form_music = {}
     if 'f' in flags:
-        manage_formations_hidden(formations, freespaces=aispaces, form_music_overrides=form_music)
+        retry_phase(manage_formations_hidden, formations, freespaces=aispaces,
+                    form_music_overrides=form_music)
         for m in get_monsters():
             m.write_stats(fout)
     reseed()
@@ -7017,7 +7054,7 @@ r   Randomize character locations in the world of ruin.
         manage_colorize_dungeons()
 
     if 'ancientcave' in activated_codes:
-        manage_ancient(form_music_overrides=form_music)
+        retry_phase(manage_ancient, form_music_overrides=form_music)
     reseed()
 
     if 'o' in flags or 'w' in flags or 'm' in flags:
@@ -7085,12 +7122,15 @@ r   Randomize character locations in the world of ruin.
     if 'g' in flags:
         if 0x13 not in changed_commands:
             manage_dances()
-            improve_dance_menu(fout)
+            import_deferred("menufeatures").improve_dance_menu(fout)
     reseed()
 
     if 'johnnydmad' in activated_codes or 'johnnyachaotic' in activated_codes:
         f_mchaos = True if 'johnnyachaotic' in activated_codes else False
-        music_log = randomize_music(fout, f_mchaos = f_mchaos, codes=activated_codes, form_music_overrides=form_music)
+        musicrandomizer = import_deferred("musicrandomizer")
+        music_log = retry_phase(musicrandomizer.randomize_music, fout,
+                                f_mchaos=f_mchaos, codes=activated_codes,
+                                form_music_overrides=form_music)
         log(music_log, section="music")
 
     # ----- NO MORE RANDOMNESS PAST THIS LINE -----
@@ -7100,7 +7140,7 @@ r   Randomize character locations in the world of ruin.
 
     # This needs to be after write_all_locations_misc()
     # so the changes to Daryl don't get stomped.
-    event_freespaces = [FreeBlock(0xCFE2A, 0xCFE2a + 470)]
+    event_freespaces = FreeSpace([(0xCFE2A, 0xCFE2a + 470)], name="events")
     if 'airship' in activated_codes:
         event_freespaces = activate_airship_mode(event_freespaces)
 
@@ -7171,8 +7211,9 @@ r   Randomize character locations in the world of ruin.
         sprint_shoes_hint()
 
     rewrite_title(text="FF6 BCEX %s" % seed)
-    fout.close()
     rewrite_checksum()
+    rom = fout.getvalue()
+    fout.close()
 
     print("\nWriting log...")
     for c in sorted(characters, key=lambda c: c.id):
@@ -7189,19 +7230,312 @@ r   Randomize character locations in the world of ruin.
     if "ancientcave" not in activated_codes:
         log_chests()
     log_break_learn_items()
-
-    f = open(outlog, 'w+')
-    f.write(get_logstring())
+    rom_map = get_rom_map()
+    if rom_map:
+        log("\n".join(rom_map), section="rom map")
+
+    return rom, get_logstring()
+
+
+class SavedState(object):
+    """A pristine copy of every randomizer module's globals.
+
+    The modules keep their working data in module globals (and RestStop
+    keeps a class counter), so putting them all back is enough to make a
+    run independent of the runs before it. Everything is copied in one
+    deepcopy so that objects shared between modules, like the monsters
+    inside formations, stay shared. The RNG is left alone; reseed() sets
+    it up per seed.
+    """
+    # The command line's own globals, which a restore has to leave alone.
+    session = ["outfile", "answers"]
+    # Caches of things that do not depend on the seed (compiled songs,
+    # parsed text tables). Restoring them would only empty them before
+    # every seed of a batch.
+    caches = ["song_cache", "table_cache"]
+    # Saved states by md5 of the source rom, and None for the state from
+    # before any rom was read. Kept here because this class is not saved.
+    # Each is a full copy of the tables, so only the roms used most
+    # recently are kept (see load_source).
+    saved = {}
+    max_roms = 2
+    # The state of each module in DEFERRED_MODULES as it was right after
+    # its first import (see import_deferred). A restore puts back the ones
+    # that were not loaded yet when the restored state was saved.
+    deferred = {}
+
+    def __init__(self, modules=None):
+        self.namespaces = self.get_namespaces(modules)
+        self.values = deepcopy(self.get_values())
+
+    def get_namespaces(self, modules=None):
+        if modules is None:
+            from sys import modules
+            modules = list(modules.values())
+        here = os.path.dirname(os.path.abspath(__file__))
+        namespaces = []
+        for module in modules:
+            filename = getattr(module, "__file__", None)
+            if (not filename or
+                    os.path.dirname(os.path.abspath(filename)) != here):
+                continue
+            namespaces.append(module)
+            namespaces.extend(
+                value for value in list(vars(module).values())
+                if isinstance(value, type) and
+                not issubclass(value, SavedState) and
+                value.__module__ == module.__name__)
+        return namespaces
+
+    def get_values(self):
+        return [dict((name, value) for (name, value) in vars(ns).items()
+                     if is_state(name, value) and
+                     name not in self.session + self.caches)
+                for ns in self.namespaces]
+
+    def restore(self):
+        self.put_back()
+        self.restore_deferred()
+
+    def put_back(self):
+        values = deepcopy(self.values)
+        for namespace, saved in zip(self.namespaces, values):
+            for name, value in saved.items():
+                setattr(namespace, name, value)
+
+    def restore_deferred(self):
+        for state in self.deferred.values():
+            if state.namespaces[0] not in self.namespaces:
+                state.put_back()
+
+
+class Snapshot(SavedState):
+    """The randomizer state partway through a run, so that a phase that
+    fails can be undone and tried again.
+
+    Unlike SavedState, a snapshot is put back in place: every object it
+    copied gets its old contents back, so references held outside the
+    module globals, like the locals of randomize_rom(), are rolled back
+    too. Anything in `objects` is copied along with the globals.
+    """
+    def __init__(self, objects=()):
+        self.namespaces = self.get_namespaces()
+        self.memo = {}
+        self.values = deepcopy(self.get_values(), self.memo)
+        self.objects = deepcopy(list(objects), self.memo)
+
+    def restore(self):
+        # deepcopy() keeps every object it copied alive in the memo, under
+        # the memo's own id. Copying the saved contents through a memo that
+        # maps each copy back to its original gives the old contents in
+        # terms of the originals; the saved copies themselves stay as they
+        # are, ready for another restore.
+        originals, seen = [], set()
+        for original in self.memo.get(id(self.memo), []):
+            if id(original) not in seen and id(original) in self.memo:
+                seen.add(id(original))
+                originals.append(original)
+        memo = dict((id(self.memo[id(o)]), o) for o in originals)
+        for original in originals:
+            restore_contents(original, self.memo[id(original)], memo)
+        for namespace, saved in zip(self.namespaces, self.values):
+            for name, value in saved.items():
+                setattr(namespace, name, deepcopy(value, memo))
+        self.restore_deferred()
+
+
+def restore_contents(original, saved, memo):
+    if isinstance(original, dict):
+        contents = [(deepcopy(k, memo), deepcopy(v, memo))
+                    for (k, v) in saved.items()]
+        original.clear()
+        original.update(contents)
+    elif isinstance(original, list):
+        original[:] = [deepcopy(v, memo) for v in saved]
+    elif isinstance(original, set):
+        contents = [deepcopy(v, memo) for v in saved]
+        original.clear()
+        original.update(contents)
+    elif isinstance(original, bytearray):
+        original[:] = saved
+
+    if isinstance(original, type):
+        return
+    if hasattr(original, "__dict__"):
+        contents = deepcopy(vars(saved), memo)
+        vars(original).clear()
+        vars(original).update(contents)
+    for cls in type(original).__mro__:
+        slots = vars(cls).get("__slots__", ())
+        for name in ([slots] if isinstance(slots, str) else slots):
+            if name in ["__dict__", "__weakref__"]:
+                continue
+            if hasattr(saved, name):
+                setattr(original, name, deepcopy(getattr(saved, name), memo))
+            elif hasattr(original, name):
+                delattr(original, name)
+
+
+def is_state(name, value):
+    return not (name.startswith("__") or
+                isinstance(value, (ModuleType, FunctionType, MethodType,
+                                   BuiltinFunctionType, type, property,
+                                   staticmethod, classmethod, IOBase,
+                                   Random, MemberDescriptorType)))
+
+
+# The tables read from the source rom, in the order they are read; each
+# comes after the tables its reader uses. Reading the formations places
+# their monsters and gives them their moulds, so those two are read
+# together.
+#
+# Every run needs all of them, whatever its flags: the formations, sets
+# and locations are always written back, and the spoiler log gives each
+# monster's location and morph items. So they are read up front, before
+# any phase can change what a reader sees, rather than when a phase first
+# asks for them; that would make a table depend on which phases ran
+# before it was read.
+ROM_TABLES = [get_ranked_items, get_monsters, get_formations, get_fsets,
+              get_locations, get_zones, get_metamorphs]
+
+
+def load_rom_tables(filename):
+    for reader in ROM_TABLES:
+        reader(filename)
+
+    # These are the spells in rank order as of the first read in a run,
+    # which depends on the seed (see madworld), so leave them to the run.
+    import itemrandomizer, monsterrandomizer
+    itemrandomizer.all_spells = None
+    monsterrandomizer.all_spells = None
+
+
+def read_source(sourcefile):
+    f = open(sourcefile, 'rb')
+    data = f.read()
     f.close()
+    if len(data) % 0x400 == 0x200:
+        data = data[0x200:]
+    return data
+
+
+def import_deferred(name):
+    # A module that is first loaded partway through a run would otherwise
+    # carry its globals into the next run, since the saved states do not
+    # have it; so its state right after the import is kept for them.
+    from sys import modules
+    assert name in DEFERRED_MODULES
+    if name not in modules:
+        module = import_module(name)
+        SavedState.deferred[name] = SavedState([module])
+    return modules[name]
+
+
+def load_source(data):
+    # The rom tables are read once per source rom. Later runs on the same
+    # rom start from a copy of the tables as they were right after that,
+    # as long as it is one of the last SavedState.max_roms roms used.
+    key = md5(data).hexdigest()
+    saved = SavedState.saved
+    if key in saved:
+        # Moved to the end, which is the most recently used.
+        saved[key] = saved.pop(key)
+        saved[key].restore()
+        return
 
-    print("Randomization successful. Output filename: %s\n" % outfile)
+    if None in saved:
+        saved[None].restore()
+    else:
+        # The pipeline imports this file by name (chestrandomizer and
+        # towerrandomizer do), which loads a second copy of it when it is
+        # run as a script. That copy has to exist before anything is saved.
+        __import__("randomizer")
+        saved[None] = SavedState()
+
+    set_rom_image(SOURCE_ROM, data)
+    state = random.getstate()
+    load_rom_tables(SOURCE_ROM)
+    assert random.getstate() == state
+    saved[key] = SavedState()
+    roms = [k for k in saved if k is not None]
+    for old in roms[:-SavedState.max_roms]:
+        del saved[old]
+
+
+def run_worker(sourcefile, fullseed, replies, outputs=()):
+    # generate() restores the saved tables and everything else a seed
+    # depends on comes from the seed itself, so it makes no difference
+    # which worker runs it or what that worker ran before.
+    randomize(args=[argv[0], sourcefile, fullseed] + list(outputs),
+              replies=replies)
+    return outfile
+
+
+def randomize_batch(sourcefile, fullseeds, jobs=1, outputs=()):
+    numbers = []
+    for fullseed in fullseeds:
+        try:
+            version, flags, number = tuple(fullseed.split('.'))
+            numbers.append(int(number) % (10**10))
+        except ValueError:
+            raise ValueError('Seed should be in the format '
+                             '<version>.<flags>.<seed>, with a seed number.')
+    if len(set(numbers)) < len(numbers):
+        raise Exception("Output files are named after the seed number, so "
+                        "every seed in a batch needs a different one.")
+
+    # Nobody answers prompts in a batch, so ask the only one that matters
+    # up front. randomboost and bingoboingo take their blank defaults.
+    replies = {}
+    if md5(read_source(sourcefile)).hexdigest() != MD5HASH:
+        print ("WARNING! The md5 hash of this file does not match the known "
+               "hash of the english FF6 1.0 rom!")
+        x = input("Continue? y/n ")
+        if not (x and x.lower()[0] == 'y'):
+            return fullseeds
+        replies["continue"] = "y"
 
-    if 'bingoboingo' in activated_codes:
-        manage_bingo()
+    failed = []
+    if jobs == 1:
+        for fullseed in fullseeds:
+            try:
+                run_worker(sourcefile, fullseed, replies, outputs)
+            except Exception as e:
+                print("ERROR: %s" % e)
+                failed.append(fullseed)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+        # Spawned rather than forked, so that workers start from a clean
+        # interpreter and not from whatever state this process is in.
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 mp_context=get_context("spawn")) as executor:
+            futures = [executor.submit(run_worker, sourcefile, fullseed,
+                                       replies, outputs)
+                       for fullseed in fullseeds]
+            for fullseed, future in zip(fullseeds, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print("ERROR: %s: %s" % (fullseed, e))
+                    failed.append(fullseed)
+
+    if failed:
+        print("These seeds failed: %s" % " ".join(failed))
+    return failed
 
 
 if __name__ == "__main__":
     args = list(argv)
+    if len(argv) > 2 and argv[1].strip().lower() == "batch":
+        outputs = [a for a in args if a in OUTPUT_ARGS]
+        args = [a for a in args[2:] if a not in OUTPUT_ARGS]
+        jobs = 1
+        if args[0].startswith("-j"):
+            jobs = int(args.pop(0)[2:] or os.cpu_count())
+        randomize_batch(args[0].strip(), args[1:], jobs=jobs,
+                        outputs=outputs)
+        exit()
     if len(argv) > 3 and argv[3].strip().lower() == "test" or TEST_ON:
         randomize()
         exit()
@@ -7214,7 +7548,10 @@ if __name__ == "__main__":
             fout.close()
         if outfile is not None:
             print("Please try again with a different seed.")
-            input("Press enter to delete %s and quit. " % outfile)
-            os.remove(outfile)
+            if os.path.exists(outfile):
+                input("Press enter to delete %s and quit. " % outfile)
+                os.remove(outfile)
+            else:
+                input("Press enter to quit. ")
         else:
             input("Press enter to quit. ")
@@ -0,0 +1,115 @@
+from copy import deepcopy
+from struct import calcsize, iter_unpack, pack, unpack_from
+
+from utils import get_rom_image
+
+INT_FORMATS = {1: "B", 2: "H", 3: "3s", 4: "I"}
+slot_names = {}
+
+
+class Record(object):
+    """The layout of the records in a ROM table.
+
+    `fields` lists (name, size) pairs in the order they are stored. A
+    field is a little-endian integer of `size` bytes, or a list of `size`
+    bytes if it is given as (name, size, list). The table holds `count`
+    records starting at `start`.
+
+    The first read from a rom image unpacks the whole table with one
+    struct call and keeps it with the image, so the blocks that read their
+    own record one at a time still cost one unpack per table. Records are
+    read and written as dicts of field values; get() collects one from the
+    attributes of a block.
+    """
+    def __init__(self, start, count, fields):
+        self.start = start
+        self.count = count
+        self.names = []
+        self.lists = set([])
+        self.ints3 = set([])
+        self.format = "<"
+        for field in fields:
+            name, size = field[:2]
+            self.names.append(name)
+            if field[2:] == (list,):
+                self.lists.add(name)
+                self.format += "%ss" % size
+            else:
+                if size == 3:
+                    self.ints3.add(name)
+                self.format += INT_FORMATS[size]
+        self.size = calcsize(self.format)
+
+    def get_table(self, image):
+        key = (self.format, self.start, self.count)
+        if key not in image.tables:
+            end = self.start + (self.size * self.count)
+            image.tables[key] = list(
+                iter_unpack(self.format, image.data[self.start:end]))
+        return image.tables[key]
+
+    def read(self, filename, pointer):
+        image = get_rom_image(filename)
+        index, offset = divmod(pointer - self.start, self.size)
+        if offset == 0 and 0 <= index < self.count:
+            values = self.get_table(image)[index]
+        else:
+            values = unpack_from(self.format, image.data, pointer)
+
+        record = {}
+        for name, value in zip(self.names, values):
+            if name in self.lists:
+                value = list(value)
+            elif name in self.ints3:
+                value = int.from_bytes(value, 'little')
+            record[name] = value
+        return record
+
+    def get(self, obj):
+        # The record held in the attributes of `obj`.
+        return dict((name, getattr(obj, name)) for name in self.names)
+
+    def pack(self, record):
+        values = []
+        for name in self.names:
+            value = record[name]
+            if name in self.lists:
+                value = bytes(value)
+            elif name in self.ints3:
+                value = value.to_bytes(3, 'little')
+            values.append(value)
+        return pack(self.format, *values)
+
+    def write(self, fout, pointer, record):
+        fout.seek(pointer)
+        fout.write(self.pack(record))
+
+
+def bitflag(name, mask, index=None):
+    """A read-only property for the bits `mask` of the byte in attribute
+    `name`, or of byte `index` if the attribute is a list of bytes."""
+    if index is None:
+        return property(lambda self: getattr(self, name) & mask)
+    return property(lambda self: getattr(self, name)[index] & mask)
+
+
+def deepcopy_slots(self, memo):
+    """A __deepcopy__ for blocks that keep their attributes in __slots__.
+
+    copy.deepcopy() would have the object build a dict of its slots and
+    copy that; setting the slots on a new object directly is about twice
+    as fast, which is most of the cost of saving the rom tables.
+    """
+    cls = type(self)
+    if cls not in slot_names:
+        slot_names[cls] = [name for c in reversed(cls.__mro__)
+                           for name in vars(c).get("__slots__", ())]
+    new = cls.__new__(cls)
+    memo[id(self)] = new
+    for name in slot_names[cls]:
+        try:
+            value = getattr(self, name)
+        except AttributeError:
+            continue
+        setattr(new, name, deepcopy(value, memo))
+    return new
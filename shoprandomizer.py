@@ -1,7 +1,7 @@
 
 
-from utils import utilrandom as random
-from itemrandomizer import get_ranked_items, get_item
+from utils import utilrandom as random, open_rom
+from itemrandomizer import get_item_catalogue, get_item
 
 # Despite documentation, these are the only pricings available.
 # 0 x1 price
@@ -24,7 +24,7 @@ class ShopBlock:
         self.shopid = shopid
 
     def read_data(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.pointer)
         self.misc = ord(f.read(1))
         self.items = bytes(f.read(8))
@@ -79,26 +79,22 @@ class ShopBlock:
                 break
 
     def mutate_items(self, fout, crazy_shops=False):
-        items = get_ranked_items()
+        items = get_item_catalogue()
         if crazy_shops:
-            weapons_tools = [i for i in items if i.is_weapon or i.is_tool]
-            armors = [i for i in items if i.is_armor]
-            relics = [i for i in items if i.is_relic]
-            consumables = [i for i in items if i.is_consumable]
-            
-            types = [weapons_tools, armors, relics, consumables]
-            
+            types = [get_item_catalogue(kind=kind).objects for kind in
+                     ["weapons", "armor", "relics", "consumables"]]
+
             valid_items = items
         elif self.shoptype == 1:
-            valid_items = [c for c in items if c.is_weapon or c.is_tool]
+            valid_items = get_item_catalogue(kind="weapons")
         elif self.shoptype == 2:
-            valid_items = [c for c in items if c.is_armor]
+            valid_items = get_item_catalogue(kind="armor")
         elif self.shoptype == 3:
-            valid_items = [c for c in items if not (c.is_weapon or c.is_armor or c.is_relic)]
+            valid_items = get_item_catalogue(kind="items")
         elif self.shoptype == 4:
-            valid_items = [c for c in items if c.is_relic]
+            valid_items = get_item_catalogue(kind="relics")
         elif self.shoptype == 5:
-            valid_items = list(items)
+            valid_items = items
 
         old_items = [i for i in self.items if i != 0xFF]
         if not old_items:
@@ -110,7 +106,7 @@ class ShopBlock:
             average_value = 0
         else:
             average_value = sum([i.rank() for i in old_items]) / len(old_items)
-        average_item = len([i for i in valid_items if i.rank() <= average_value])
+        average_item = valid_items.count_upto(average_value)
         average_item += -1
         average_item = valid_items[average_item]
 
@@ -129,7 +125,7 @@ class ShopBlock:
                     candidates = valid_items
 
                 try:
-                    index = candidates.index(item)
+                    index = candidates.index(item.itemid)
                 except ValueError:
                     continue
 
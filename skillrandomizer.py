@@ -1,31 +1,53 @@
 from utils import (hex2int, int2bytes, Substitution, SPELL_TABLE,
-                   SPELLBANS_TABLE, name_to_bytes, utilrandom as random)
+                   SPELLBANS_TABLE, name_to_bytes, utilrandom as random,
+                   open_rom, RankedCatalogue)
+from records import Record, bitflag, deepcopy_slots
+from tablecache import load_table
 
 spelldict = {}
-spellnames = {}
-f = open(SPELL_TABLE)
-for line in f:
-    line = line.strip()
-    while '  ' in line:
-        line = line.replace('  ', ' ')
-    value, strength, name = tuple(line.split(','))
-    spellnames[hex2int(value)] = name
-f.close()
-
-spellbans = {}
-f = open(SPELLBANS_TABLE)
-for line in f:
-    line = line.strip()
-    if line[0] == '#':
-        continue
-    spellid, modifier, name, ban = tuple(line.split(','))
-    if ban == "ban":
-        modifier = int(modifier) * -1
-    spellbans[hex2int(spellid)] = int(modifier)
-f.close()
+spell_catalogue = None
+SPELL_RECORD = Record(0x46AC0, 255, [
+    ("targeting", 1), ("elements", 1), ("effect1", 1), ("dmgtype", 1),
+    ("effect2", 1), ("mp", 1), ("power", 1), ("unknown", 1),
+    ("accuracy", 1), ("special", 1), ("statuses", 4, list)])
+
+
+def read_spell_names(sources):
+    names = {}
+    for line in open(sources[0]):
+        line = line.strip()
+        while '  ' in line:
+            line = line.replace('  ', ' ')
+        value, strength, name = tuple(line.split(','))
+        names[hex2int(value)] = name
+    return names
+
+
+def read_spell_bans(sources):
+    bans = {}
+    for line in open(sources[0]):
+        line = line.strip()
+        if line[0] == '#':
+            continue
+        spellid, modifier, name, ban = tuple(line.split(','))
+        if ban == "ban":
+            modifier = int(modifier) * -1
+        bans[hex2int(spellid)] = int(modifier)
+    return bans
+
+
+spellnames = load_table([SPELL_TABLE], read_spell_names)
+spellbans = load_table([SPELLBANS_TABLE], read_spell_bans)
 
 
 class SpellBlock:
+    # The spell data is kept as the raw bytes; the flags in them are read
+    # through the properties below.
+    __slots__ = ["spellid", "valid", "name", "pointer", "targeting",
+                 "elements", "effect1", "dmgtype", "effect2", "mp", "power",
+                 "accuracy", "special", "statuses", "_rank"]
+    __deepcopy__ = deepcopy_slots
+
     def __init__(self, spellid, filename):
         self.spellid = spellid
         if self.spellid in spellbans and spellbans[self.spellid] < 0:
@@ -34,76 +56,61 @@ class SpellBlock:
             self.valid = True
         self.name = spellnames[self.spellid]
         self.pointer = 0x46AC0 + (14 * spellid)
-        f = open(filename, 'r+b')
-
-        f.seek(self.pointer)
-        targeting = ord(f.read(1))
-        self.targeting = targeting
-        self.target_random = targeting & 0x80
-        self.target_enemy_default = targeting & 0x40
-        self.target_group = targeting & 0x20
-        self.target_auto = targeting & 0x10
-        self.target_group_default = targeting & 0x08
-        self.target_everyone = targeting & 0x04
-        self.target_one_side_only = targeting & 0x02
-        self.target_one = targeting & 0x01
-
-        f.seek(self.pointer+1)
-        self.elements = ord(f.read(1))
-        self.elemental = self.elements > 0
-
-        f.seek(self.pointer+2)
-        effect1 = ord(f.read(1))
-        self.physical = effect1 & 0x01
-        self.miss_if_death_prot = effect1 & 0x02
-        self.target_dead = effect1 & 0x04
-        self.invert_undead = effect1 & 0x08
-        self.randomize_target = effect1 & 0x10
-        self.ignore_defense = effect1 & 0x20
-        self.no_split_damage = effect1 & 0x40
-        self.abort_on_allies = effect1 & 0x80
-
-        f.seek(self.pointer+3)
-        self.dmgtype = ord(f.read(1))
-        self.outsidebattle = self.dmgtype & 0x01
-        self.unreflectable = self.dmgtype & 0x02
-        self.learnifcast = self.dmgtype & 0x04
-        self.enablerunic = self.dmgtype & 0x08
-        self.unknown = self.dmgtype & 0x10
-        self.retargetdead = self.dmgtype & 0x20
-        self.casterdies = self.dmgtype & 0x40
-        self.concernsmp = self.dmgtype & 0x80
-
-        f.seek(self.pointer+4)
-        effect2 = ord(f.read(1))
-        self.healing = effect2 & 0x01
-        self.draining = effect2 & 0x02
-        self.cure_status = effect2 & 0x04
-        self.invert_status = effect2 & 0x08
-        self.uses_stamina = effect2 & 0x10
-        self.unblockable = effect2 & 0x20
-        self.level_spell = effect2 & 0x40
-        self.percentage = effect2 & 0x80
-
-        f.seek(self.pointer+5)
-        self.mp = ord(f.read(1))
-        f.seek(self.pointer+6)
-        self.power = ord(f.read(1))
-        f.seek(self.pointer+8)
-        self.accuracy = ord(f.read(1))
-        f.seek(self.pointer+9)
-        self.special = ord(f.read(1))
-        f.seek(self.pointer+10)
-        statuses = list(f.read(4))
-        self.death = statuses[0] & 0x80
-        self.petrify = statuses[0] & 0x40
-        self.condemned = statuses[1] & 0x1
-        self.statuses = statuses
-        self.has_status = sum([bin(b).count("1") for b in statuses])
-        f.close()
-        
+        record = SPELL_RECORD.read(filename, self.pointer)
+        for name in ["targeting", "elements", "effect1", "dmgtype",
+                     "effect2", "mp", "power", "accuracy", "special",
+                     "statuses"]:
+            setattr(self, name, record[name])
         self._rank = None
 
+    target_random = bitflag("targeting", 0x80)
+    target_enemy_default = bitflag("targeting", 0x40)
+    target_group = bitflag("targeting", 0x20)
+    target_auto = bitflag("targeting", 0x10)
+    target_group_default = bitflag("targeting", 0x08)
+    target_everyone = bitflag("targeting", 0x04)
+    target_one_side_only = bitflag("targeting", 0x02)
+    target_one = bitflag("targeting", 0x01)
+
+    physical = bitflag("effect1", 0x01)
+    miss_if_death_prot = bitflag("effect1", 0x02)
+    target_dead = bitflag("effect1", 0x04)
+    invert_undead = bitflag("effect1", 0x08)
+    randomize_target = bitflag("effect1", 0x10)
+    ignore_defense = bitflag("effect1", 0x20)
+    no_split_damage = bitflag("effect1", 0x40)
+    abort_on_allies = bitflag("effect1", 0x80)
+
+    outsidebattle = bitflag("dmgtype", 0x01)
+    unreflectable = bitflag("dmgtype", 0x02)
+    learnifcast = bitflag("dmgtype", 0x04)
+    enablerunic = bitflag("dmgtype", 0x08)
+    unknown = bitflag("dmgtype", 0x10)
+    retargetdead = bitflag("dmgtype", 0x20)
+    casterdies = bitflag("dmgtype", 0x40)
+    concernsmp = bitflag("dmgtype", 0x80)
+
+    healing = bitflag("effect2", 0x01)
+    draining = bitflag("effect2", 0x02)
+    cure_status = bitflag("effect2", 0x04)
+    invert_status = bitflag("effect2", 0x08)
+    uses_stamina = bitflag("effect2", 0x10)
+    unblockable = bitflag("effect2", 0x20)
+    level_spell = bitflag("effect2", 0x40)
+    percentage = bitflag("effect2", 0x80)
+
+    death = bitflag("statuses", 0x80, index=0)
+    petrify = bitflag("statuses", 0x40, index=0)
+    condemned = bitflag("statuses", 0x1, index=1)
+
+    @property
+    def elemental(self):
+        return self.elements > 0
+
+    @property
+    def has_status(self):
+        return sum([bin(b).count("1") for b in self.statuses])
+
     def __cmp__(self, other):
         if other is None:
             return 1
@@ -138,6 +145,11 @@ class SpellBlock:
         fout.seek(self.pointer+3)
         fout.write(bytes([self.dmgtype]))
 
+    def set_rank(self, rank):
+        global spell_catalogue
+        self._rank = rank
+        spell_catalogue = None
+
     def rank(self):
         if self._rank is not None:
             return self._rank
@@ -241,7 +253,7 @@ class CommandBlock:
         return self.properties & 0x1
 
     def read_properties(self, filename):
-        f = open(filename, 'r+b')
+        f = open_rom(filename)
         f.seek(self.proppointer)
         self.properties = ord(f.read(1))
         assert not self.properties & 0xF0
@@ -301,19 +313,25 @@ class CommandBlock:
         self.set_bit(0x204D4, fout, unset=True)
 
 
-def get_ranked_spells(filename=None, magic_only=False):
-    if spelldict:
-        spells = sorted(list(spelldict.values()), key=lambda s: s.spellid)
-    else:
-        spells = [SpellBlock(i, filename) for i in range(0xFF)]
-        for s in spells:
-            spelldict[s.spellid] = s
+def get_spell_catalogue(filename=None, magic_only=False):
+    global spell_catalogue
+    if spell_catalogue is None:
+        if spelldict:
+            spells = sorted(list(spelldict.values()),
+                            key=lambda s: s.spellid)
+        else:
+            spells = [SpellBlock(i, filename) for i in range(0xFF)]
+            for s in spells:
+                spelldict[s.spellid] = s
+        spell_catalogue = RankedCatalogue(spells, "spellid")
 
     if magic_only:
-        spells = [s for s in spells if s.spellid < 0x36]
+        return spell_catalogue.subset("magic", lambda s: s.spellid < 0x36)
+    return spell_catalogue
 
-    spells = sorted(spells, key=lambda i: i.rank())
-    return spells
+
+def get_ranked_spells(filename=None, magic_only=False):
+    return list(get_spell_catalogue(filename, magic_only).objects)
 
 
 def get_spell(spellid):
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+
+from mml2mfvi import mml_to_akao, COMPILER_VERSION
+from tablecache import write_atomic
+
+SONG_CACHE_PATH = os.path.join('cache', 'songs')
+SONG_CACHE_LIMIT = 32 * 1024 * 1024
+
+
+class SongCache(object):
+    """Songs compiled from MML, kept on disk between runs.
+
+    An entry holds what `mml_to_akao` returned: the AKAO data and
+    instrument set of every variant. Entries are keyed by a hash of the
+    MML text, the variant and sfx mode asked for, and COMPILER_VERSION,
+    so editing a song or the compiler just makes new entries. Reading an
+    entry touches its file, and once the cache holds more than `limit`
+    bytes the least recently used files are deleted. The data size of
+    every compiled variant is also kept in a small index that outlives
+    eviction, so a song that cannot fit can be turned down without being
+    compiled again.
+
+    Any error reading or writing the cache is ignored; the song is then
+    just compiled.
+    """
+    def __init__(self, path=SONG_CACHE_PATH, limit=SONG_CACHE_LIMIT):
+        self.path = path
+        self.limit = limit
+        self.songs = {}
+        self.sizes = None
+        self.total = None
+
+    def key(self, mml, sfxmode=False, variant=None):
+        h = hashlib.sha1()
+        h.update(("%s\0%s\0%s\0" % (COMPILER_VERSION, sfxmode, variant)).encode())
+        h.update(mml.encode('utf-8', 'surrogateescape'))
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + ".akao")
+
+    def size(self, key, variant='_default_'):
+        # Length of the compiled data of `variant`, or None if the song
+        # has never been compiled.
+        if self.sizes is None:
+            self.sizes = self.read_sizes()
+        return self.sizes.get(key, {}).get(variant)
+
+    def compile(self, mml, fileid='mml', sfxmode=False, variant=None):
+        key = self.key(mml, sfxmode, variant)
+        if key not in self.songs:
+            akao = self.read(key)
+            if akao is None:
+                akao = mml_to_akao(mml, fileid, sfxmode, variant)
+                self.write(key, akao)
+            self.songs[key] = akao
+            if self.sizes is None:
+                self.sizes = self.read_sizes()
+            if key not in self.sizes:
+                self.write_sizes(key, dict((v, len(data)) for (v, (data, inst))
+                                           in akao.items()))
+        return self.songs[key]
+
+    def read(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                akao = {}
+                for variant, datalen, instlen in json.loads(f.readline().decode()):
+                    data, inst = f.read(datalen), f.read(instlen)
+                    if len(data) != datalen or len(inst) != instlen:
+                        return None
+                    akao[variant] = (data.decode('latin-1'), inst.decode('latin-1'))
+            os.utime(filename)
+        except (OSError, ValueError):
+            return None
+        return akao
+
+    def write(self, key, akao):
+        header = [[variant, len(data), len(inst)]
+                  for (variant, (data, inst)) in akao.items()]
+        contents = (json.dumps(header) + "\n").encode()
+        for data, inst in akao.values():
+            contents += (data + inst).encode('latin-1')
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            write_atomic(self.filename(key), contents)
+            if self.total is None:
+                self.total = sum(size for (_, size, _) in self.entries())
+            else:
+                self.total += len(contents)
+            if self.total > self.limit:
+                self.evict()
+        except OSError:
+            pass
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".akao"):
+                filename = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        self.total = sum(size for (_, size, _) in entries)
+        for _, size, filename in entries:
+            if self.total <= self.limit:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self.total -= size
+
+    def read_sizes(self):
+        try:
+            with open(os.path.join(self.path, "sizes.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_sizes(self, key, sizes):
+        # Merged with what is on disk, in case another process has
+        # added to the index since it was read.
+        self.sizes = self.read_sizes()
+        self.sizes[key] = sizes
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            write_atomic(os.path.join(self.path, "sizes.json"),
+                         json.dumps(self.sizes).encode())
+        except OSError:
+            pass
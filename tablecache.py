@@ -0,0 +1,105 @@
+import hashlib
+import os
+import pickle
+
+TABLE_CACHE_FILE = os.path.join('cache', 'tables.pickle')
+# Bump this whenever a parser given to load_table() changes what it
+# returns; the cache has no other way of knowing.
+TABLE_CACHE_VERSION = 1
+
+
+def write_atomic(filename, contents):
+    # Batch workers share the cache, so files are written aside and
+    # renamed into place; readers never see half of one.
+    temp = "%s.%s.tmp" % (filename, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(contents)
+    os.replace(temp, filename)
+
+
+class TableCache(object):
+    """The text tables, parsed, kept in one file between runs.
+
+    An entry is keyed by the source files and the parser, and holds the
+    pickled result with the mtime, size and a hash of every source. The
+    whole file is read the first time a table is asked for. A source with
+    a new mtime or size is hashed again, and only parsed again if the hash
+    has changed too. Each load unpickles a fresh copy of the table, since
+    the modules change theirs as they go.
+
+    Any error reading or writing the cache is ignored; the table is then
+    just parsed.
+    """
+    def __init__(self, filename=TABLE_CACHE_FILE):
+        self.filename = filename
+        self.entries = None
+
+    def load(self, sources, parse):
+        if self.entries is None:
+            self.entries = self.read()
+        key = (tuple(sources), parse.__module__, parse.__qualname__)
+        stamps = [self.stamp(source) for source in sources]
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] != stamps:
+            if entry[1] == self.digest(sources):
+                entry = (stamps,) + entry[1:]
+                self.entries[key] = entry
+                self.write()
+            else:
+                entry = None
+
+        if entry is None:
+            table = parse(sources)
+            entry = (stamps, self.digest(sources),
+                     pickle.dumps(table, pickle.HIGHEST_PROTOCOL))
+            self.entries[key] = entry
+            self.write()
+            return table
+        return pickle.loads(entry[2])
+
+    def stamp(self, source):
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def digest(self, sources):
+        h = hashlib.sha1()
+        for source in sources:
+            try:
+                with open(source, 'rb') as f:
+                    h.update(f.read())
+            except OSError:
+                pass
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def read(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                version, entries = pickle.loads(f.read())
+        except Exception:
+            return {}
+        if version != TABLE_CACHE_VERSION:
+            return {}
+        return entries
+
+    def write(self):
+        try:
+            path = os.path.dirname(self.filename)
+            if path and not os.path.isdir(path):
+                os.makedirs(path)
+            write_atomic(self.filename, pickle.dumps(
+                (TABLE_CACHE_VERSION, self.entries),
+                pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            pass
+
+
+table_cache = TableCache()
+
+
+def load_table(sources, parse):
+    """parse(sources), from the cache if none of `sources` has changed."""
+    return table_cache.load(sources, parse)
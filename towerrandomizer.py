@@ -3,7 +3,7 @@
 from utils import (ANCIENT_CHECKPOINTS_TABLE, TOWER_CHECKPOINTS_TABLE,
                    TOWER_LOCATIONS_TABLE, TREASURE_ROOMS_TABLE,
                    ENTRANCE_REACHABILITY_TABLE,
-                   utilrandom as random)
+                   DeadEndError, utilrandom as random)
 from locationrandomizer import (get_locations, get_location, Location,
                                 get_unused_locations, Entrance,
                                 add_location_map, update_locations)
@@ -104,6 +104,13 @@ def remap_maps(routes):
         conclusters.extend(route.consolidated_clusters)
         conclusters = sorted(set(conclusters), key=lambda c: c.clusterid)
 
+    graph = LinkGraph(conclusters, conlinks)
+    for a, b in cononeways:
+        graph.add_link(a, b, oneway=True)
+    locid_clusters = {}
+    for c in conclusters:
+        locid_clusters.setdefault(c.locid, []).append(c)
+
     if ANCIENT:
         unused_maps = [l.locid for l in get_locations()
                        if l.locid not in towerlocids
@@ -132,8 +139,8 @@ def remap_maps(routes):
         if (locid, cluster.clusterid) in locexchange:
             continue
 
-        locclusters = [c for c in conclusters if
-                       not isinstance(c, RestStop) and c.locid == locid]
+        locclusters = [c for c in locid_clusters[locid]
+                       if not isinstance(c, RestStop)]
         if locid in towerlocids:
             for c in locclusters:
                 locexchange[(locid, c.clusterid)] = locid
@@ -150,14 +157,22 @@ def remap_maps(routes):
                 for c in locclusters:
                     locexchange[(locid, c.clusterid)] = newlocid
 
+    exchanged = {}
+    for key, value in locexchange.items():
+        exchanged.setdefault(value, []).append(key)
+    exchanged_clusters = {}
+    for c in conclusters:
+        newlocid = locexchange[(c.locid, c.clusterid)]
+        exchanged_clusters.setdefault(newlocid, []).append(c)
+    conentrances = set(conentrances)
+
     newlocations = []
     for newlocid in sorted(set(locexchange.values())):
-        keys = [key for (key, value) in locexchange.items()
-                if value == newlocid]
+        keys = exchanged[newlocid]
         assert len(set([a for (a, b) in keys])) == 1
         copylocid = keys[0][0]
         if copylocid >= 1000:
-            cluster = [c for c in conclusters if c.locid == copylocid][0]
+            cluster = locid_clusters[copylocid][0]
             copylocid = 413
             location = get_location(413)
             newlocation = Location(locid=newlocid, dummy=True)
@@ -178,19 +193,16 @@ def remap_maps(routes):
                      if (e.location.locid, e.entid) in FIXED_ENTRANCES]
             newlocation.entrance_set.entrances.extend(fixed)
 
-        locclusters = [c for c in conclusters if
-                       locexchange[(c.locid, c.clusterid)] == newlocid]
+        locclusters = exchanged_clusters.get(newlocid, [])
         clustents = [e for c in locclusters for e in c.entrances]
         clustents = [e for e in clustents if e in conentrances]
 
         for ent in clustents:
-            destent = [(a, b) for (a, b) in conlinks if ent in (a, b)]
-            destent += [(a, b) for (a, b) in cononeways if ent == a]
+            destent = graph.get_links(ent)
             assert len(destent) == 1
             destent = destent[0]
             destent = [d for d in destent if d != ent][0]
-            destclust = [c for c in conclusters
-                         if destent in c.entrances]
+            destclust = graph.get_clusters(destent)
             assert len(destclust) == 1
             destclust = destclust[0]
             newdestlocid = locexchange[(destclust.locid, destclust.clusterid)]
@@ -284,11 +296,14 @@ def remap_maps(routes):
                     cluster.routerank = n
                     ranked_clusters.append(cluster)
 
+    newlocdict = {}
+    for l in newlocations:
+        newlocdict.setdefault(l.locid, l)
     ranked_locations = []
     for cluster in ranked_clusters:
         locid, clusterid = cluster.locid, cluster.clusterid
         newlocid = locexchange[locid, clusterid]
-        newloc = [l for l in newlocations if l.locid == newlocid][0]
+        newloc = newlocdict[newlocid]
         if newloc not in ranked_locations:
             newloc.routerank = cluster.routerank
             ranked_locations.append(newloc)
@@ -336,7 +351,7 @@ def remap_maps(routes):
         ranked334 = s334segment.ranked_clusters
         if (ranked292.index(s292cluster) > ranked292.index(g334cluster) and
                 ranked334.index(s334cluster) > ranked334.index(g292cluster)):
-            raise Exception("Dungeon cannot be completed with this layout.")
+            raise DeadEndError("Dungeon cannot be completed with this layout.")
 
     return newlocations, unused_maps
 
@@ -480,6 +495,43 @@ def get_cluster(locid, entid):
             return c
 
 
+# Clusters and the links between their entrances, indexed for routing:
+# which clusters each entrance belongs to, and which links touch each
+# entrance, in the order they were added. Links are two-way unless added
+# as one-way.
+class LinkGraph:
+    def __init__(self, clusters=None, links=None):
+        self.clusters = []
+        self.links = []
+        self.entrance_clusters = {}
+        self.entrance_links = {}
+        for cluster in (clusters or []):
+            self.add_cluster(cluster)
+        for a, b in (links or []):
+            self.add_link(a, b)
+
+    def add_cluster(self, cluster):
+        self.clusters.append(cluster)
+        for e in cluster.entrances:
+            self.entrance_clusters.setdefault(e, []).append(cluster)
+
+    def add_link(self, a, b, oneway=False):
+        self.links.append((a, b))
+        self.entrance_links.setdefault(a, []).append((a, b))
+        if b is not a and not oneway:
+            self.entrance_links.setdefault(b, []).append((a, b))
+
+    def get_clusters(self, entrance):
+        return self.entrance_clusters.get(entrance, [])
+
+    def get_links(self, entrance):
+        return self.entrance_links.get(entrance, [])
+
+    def get_linked_entrances(self, entrance):
+        return [b if a is entrance else a
+                for (a, b) in self.get_links(entrance)]
+
+
 class Segment:
     def __init__(self, checkpoints):
         self.clusters = []
@@ -502,32 +554,32 @@ class Segment:
     @property
     def ranked_clusters(self):
         startclust = self.clusters[0]
+        consolidated = self.consolidated_clusters
+        graph = LinkGraph(links=self.consolidated_links)
         done = set([startclust])
+        ents = set(startclust.entrances)
         ranked = []
         if startclust not in ranked:
             ranked.append(startclust)
         while True:
-            ents = [e for c in done for e in c.entrances]
-            relevant_links = [(a, b) for (a, b) in self.consolidated_links
-                              if a in ents or b in ents]
             new_ents = set([])
-            for a, b in relevant_links:
-                if a not in ents:
-                    new_ents.add(a)
-                if b not in ents:
-                    new_ents.add(b)
+            for e in ents:
+                for dest in graph.get_linked_entrances(e):
+                    if dest not in ents:
+                        new_ents.add(dest)
             if not new_ents:
                 break
-            newclusts = [c for c in self.consolidated_clusters
-                         if set(c.entrances) & new_ents]
+            newclusts = [c for c in consolidated
+                         if not new_ents.isdisjoint(c.entrances)]
             done |= set(newclusts)
+            ents.update(e for c in newclusts for e in c.entrances)
             newclusts = sorted(newclusts, key=lambda c: c.clusterid)
             random.shuffle(newclusts)
             for c in newclusts:
                 if c not in ranked:
                     ranked.append(c)
 
-        if set(self.consolidated_clusters) != set(ranked):
+        if set(consolidated) != set(ranked):
             import pdb; pdb.set_trace()
         return ranked
 
@@ -596,11 +648,11 @@ class Segment:
                     if intercands:
                         break
                 else:
-                    raise Exception("No available intersegments.")
+                    raise DeadEndError("No available intersegments.")
                 chosen = random.choice(intercands)
                 excands = (chosen.get_external_candidates(num=1))
                 if excands is None:
-                    raise Exception("Routing error.")
+                    raise DeadEndError("Routing error.")
                 links.append((aent, excands[0]))
                 a.entering, a.exiting = True, True
 
@@ -615,12 +667,12 @@ class Segment:
                         links.append((c, d))
                         break
                     else:
-                        raise Exception("No exit segment available.")
+                        raise DeadEndError("No exit segment available.")
             elif not inter.empty:
                 if not b.singleton:
                     excands = inter.get_external_candidates(num=2)
                     if excands is None:
-                        raise Exception("No exit segment available. (2)")
+                        raise DeadEndError("No exit segment available. (2)")
                     random.shuffle(excands)
                     links.append((bent, excands[1]))
                     b.entering = True
@@ -656,7 +708,7 @@ class Segment:
                         break
                     i += -1
                 if inter.empty:
-                    raise Exception("Routing error.")
+                    raise DeadEndError("Routing error.")
                 excands = inter.get_external_candidates(num=1)
                 links.append((aent, excands[0]))
                 a.entering = True
@@ -665,12 +717,13 @@ class Segment:
         self.check_links()
 
     def fill_out(self):
-        entrances = list(self.consolidated_entrances)
+        entrances = set(self.consolidated_entrances)
         seen = []
         for cluster, inter in zip(self.clusters, self.intersegments):
             if cluster.locid == 334 and 11 in cluster.entids:
+                consolidated = set(self.consolidated_entrances)
                 additionals = [e for e in cluster.entrances
-                               if e not in self.consolidated_entrances]
+                               if e not in consolidated]
                 assert len(additionals) == 1
                 extra = inter.fill_out(additionals[0])
             else:
@@ -744,6 +797,25 @@ class InterSegment(Segment):
         self.links = []
         self.linked_edge = []
 
+    @property
+    def links(self):
+        return self._links
+
+    @links.setter
+    def links(self, links):
+        self._links = links
+        self._graph = None
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self._graph = LinkGraph(self.clusters, self.links)
+        return self._graph
+
+    def add_cluster(self, cluster, need=False):
+        super(InterSegment, self).add_cluster(cluster, need=need)
+        self._graph = None
+
     @property
     def empty(self):
         return len(self.clusters) == 0
@@ -759,9 +831,9 @@ class InterSegment(Segment):
         return linked
 
     def get_entrance_cluster(self, entrance):
-        for c in self.clusters:
-            if entrance in c.entrances:
-                return c
+        clusters = self.graph.get_clusters(entrance)
+        if clusters:
+            return clusters[0]
         raise Exception("Could not find related cluster.")
 
     def calculate_distance(self, a, b):
@@ -782,7 +854,7 @@ class InterSegment(Segment):
                         return i
                     if dest is not None and dest not in reachable:
                         reachable.append(dest)
-        raise Exception("Clusters not connected.")
+        raise DeadEndError("Clusters not connected.")
 
     def get_max_edge_distance(self, clusters):
         if len(clusters) == 1:
@@ -810,13 +882,9 @@ class InterSegment(Segment):
         if not self.clusters:
             return None
         candidates = []
-        linked_clusters = []
-        for e in self.linked_entrances:
-            for c in self.clusters:
-                if e in c.entrances:
-                    linked_clusters.append(c)
         done_clusts = set([])
         done_ents = set(self.linked_entrances)
+        linked_edge = set(self.linked_edge)
 
         for _ in range(num):
             candclusts = [c for c in self.clusters
@@ -825,7 +893,7 @@ class InterSegment(Segment):
             if tempclusts:
                 candclusts = tempclusts
             tempclusts = [c for c in candclusts if
-                          not set(c.entrances) & set(self.linked_edge)]
+                          linked_edge.isdisjoint(c.entrances)]
             if tempclusts:
                 candclusts = tempclusts
             try:
@@ -878,7 +946,7 @@ class InterSegment(Segment):
         self.links = links
 
     def fill_out(self, additional=None):
-        linked = self.linked_entrances
+        linked = set(self.linked_entrances)
         links = []
         unlinked = []
         for cluster in self.clusters:
@@ -3,6 +3,7 @@ TIME=1426615861
 rm program.*.rom
 rm program.*.txt
 set -e
+python devtools/check_startup.py
 yes | python randomizer.py program.rom .owzbmciqetulnfspdah.$TIME test
 yes | python randomizer.py program.rom .wzbmciqetulnfspdah.$TIME test
 yes | python randomizer.py program.rom .ozbmciqetulnfspdah.$TIME test
@@ -1,7 +1,18 @@
 from os import path
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from io import BytesIO
+from sys import byteorder
 import random
 
+from tablecache import load_table
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     from sys import _MEIPASS
     MEI = True
@@ -67,6 +78,112 @@ def open_mei_fallback(filename, mode='r'):
     return f
 
 
+class RomImage(object):
+    """An immutable, in-memory copy of a ROM file.
+
+    Block readers get a cheap file-like view of the image through
+    `open_rom` instead of reopening the ROM on disk for every record.
+    Tables unpacked from the image are kept in `tables` (see records.py).
+    """
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.tables = {}
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls(f.read())
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def open(self):
+        # BytesIO shares the underlying bytes until it is written to.
+        return BytesIO(self.data)
+
+
+rom_images = {}
+
+
+def set_rom_image(filename, data):
+    image = data if isinstance(data, RomImage) else RomImage(data)
+    rom_images[filename] = image
+    return image
+
+
+def get_rom_image(filename):
+    if isinstance(filename, RomImage):
+        return filename
+    if filename not in rom_images:
+        rom_images[filename] = RomImage.from_file(filename)
+    return rom_images[filename]
+
+
+def open_rom(filename):
+    return get_rom_image(filename).open()
+
+
+class RomBuffer(object):
+    """A writable in-memory ROM image with the usual file API.
+
+    All writers share one bytearray, `data`, which code that edits large
+    regions (such as the music inserter) may also modify directly.
+    `save` writes it to disk in one go.
+    """
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.data)
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0:
+            end = len(self.data)
+        else:
+            end = min(start + size, len(self.data))
+        if end <= start:
+            return b''
+        self.position = end
+        return bytes(self.data[start:end])
+
+    def write(self, bytestring):
+        if self.position > len(self.data):
+            self.data.extend(bytes(self.position - len(self.data)))
+        end = self.position + len(bytestring)
+        self.data[self.position:end] = bytestring
+        self.position = end
+        return len(bytestring)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        return bytes(self.data)
+
+
+class DeadEndError(Exception):
+    """Raised by a phase that has randomized itself into a corner, such as
+    a tower route with no way on or a pool with no room left. Another
+    random stream may well get through, so retry_phase() tries the phase
+    again on these and on nothing else."""
+
+
 class Substitution(object):
     location = None
 
@@ -82,14 +199,74 @@ class Substitution(object):
         fout.write(bytes(self.bytestring))
 
 
-texttable = {}
-f = open(TEXT_TABLE)
-for line in f:
-    line = line.strip()
-    char, value = tuple(line.split())
-    texttable[char] = value
+class RankedCatalogue(object):
+    """Objects in order of rank(), as sorted() would put them, with the
+    ranks and the position of each object kept alongside.
+
+    Objects are looked up by the attribute `key`, like an item's itemid.
+    Ranks are found with bisect, so a range of ranks costs two searches
+    rather than a pass over every object. subset() gives a catalogue of
+    the objects that pass a test, in the same order; it is built the first
+    time it is asked for and kept. Nothing here notices a rank changing:
+    the module that owns the catalogue has to drop it when one does.
+    """
+    def __init__(self, objects, key, ranks=None):
+        if ranks is None:
+            objects = list(objects)
+            ranks = [o.rank() for o in objects]
+            order = sorted(range(len(objects)), key=ranks.__getitem__)
+            objects = [objects[i] for i in order]
+            ranks = [ranks[i] for i in order]
+        self.objects = objects
+        self.ranks = ranks
+        self.key = key
+        self.positions = dict((getattr(o, key), i)
+                              for (i, o) in enumerate(objects))
+        self.subsets = {}
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __getitem__(self, index):
+        return self.objects[index]
+
+    def subset(self, name, condition):
+        if name not in self.subsets:
+            chosen = [i for (i, o) in enumerate(self.objects)
+                      if condition(o)]
+            self.subsets[name] = RankedCatalogue(
+                [self.objects[i] for i in chosen], self.key,
+                [self.ranks[i] for i in chosen])
+        return self.subsets[name]
+
+    def index(self, value):
+        # The position of the object whose key is `value`; raises
+        # ValueError like list.index() if there is none.
+        if value not in self.positions:
+            raise ValueError("{0} is not in the catalogue".format(value))
+        return self.positions[value]
+
+    def count_upto(self, rank):
+        # The number of objects ranked `rank` or lower.
+        return bisect_right(self.ranks, rank)
+
+    def between(self, lower, upper):
+        # The objects with lower <= rank < upper, in order.
+        return self.objects[bisect_left(self.ranks, lower):
+                            bisect_left(self.ranks, upper)]
+
+
+def read_text_table(sources):
+    table = {}
+    for line in open(sources[0]):
+        line = line.strip()
+        char, value = tuple(line.split())
+        table[char] = value
+    return table
+
+
+texttable = load_table([TEXT_TABLE], read_text_table)
 texttable[' '] = 'FE'
-f.close()
 
 
 def name_to_bytes(name, length):
@@ -100,23 +277,21 @@ def name_to_bytes(name, length):
     return bytes(name)
 
 
-shorttexttable = {}
-f = open(SHORT_TEXT_TABLE)
-for line in f:
-    line = line.strip()
-    char, value = tuple(line.split())
-    shorttexttable[char] = value
+shorttexttable = load_table([SHORT_TEXT_TABLE], read_text_table)
 shorttexttable[' '] = 'FF'
-f.close()
 
 
-dialoguetexttable = {}
-f = open(DIALOGUE_TEXT_TABLE, encoding='utf8')
-for line in f:
-    line = line.strip('\n')
-    value, string = tuple(line.split('=', 1))
-    dialoguetexttable[string] = value
-f.close()
+def read_dialogue_text_table(sources):
+    table = {}
+    for line in open(sources[0], encoding='utf8'):
+        line = line.strip('\n')
+        value, string = tuple(line.split('=', 1))
+        table[string] = value
+    return table
+
+
+dialoguetexttable = load_table([DIALOGUE_TEXT_TABLE],
+                               read_dialogue_text_table)
 
 
 def hex2int(hexstr):
@@ -146,14 +321,18 @@ def dialogue_to_bytes(text, null_terminate=True):
     return bytes(bs)
 
     
-battlebg_palettes = {}
-f = open(BATTLE_BG_PALETTE_TABLE)
-for line in f:
-    line = line.strip()
-    bg, palette = tuple(line.split())
-    bg, palette = hex2int(bg), hex2int(palette)
-    battlebg_palettes[bg] = palette
-f.close()
+def read_battlebg_palettes(sources):
+    palettes = {}
+    for line in open(sources[0]):
+        line = line.strip()
+        bg, palette = tuple(line.split())
+        bg, palette = hex2int(bg), hex2int(palette)
+        palettes[bg] = palette
+    return palettes
+
+
+battlebg_palettes = load_table([BATTLE_BG_PALETTE_TABLE],
+                               read_battlebg_palettes)
 
 
 def int2bytes(value, length=2, reverse=True):
@@ -200,6 +379,22 @@ def write_multi(f, value, length=2, reverse=True):
     f.write(bytes(vals))
 
 
+def read_palette(f, length):
+    # Reads `length` little-endian BGR15 colors as one block.
+    palette = array('H')
+    palette.frombytes(f.read(length*2))
+    if byteorder == 'big':
+        palette.byteswap()
+    return palette.tolist()
+
+
+def write_palette(f, palette):
+    palette = array('H', palette)
+    if byteorder == 'big':
+        palette.byteswap()
+    f.write(palette.tobytes())
+
+
 utilrandom = random.Random()
 utran = utilrandom
 random = utilrandom
@@ -285,6 +480,65 @@ def shift_middle(triple, degree, ungray=False):
     return tuple(triple)
 
 
+# What every palette transformer needs to know about each of the 32768
+# colors, whatever its swap codes and degree. Filled in on first use.
+palette_tables = {}
+
+
+def get_palette_tables(key=None, colors_to_indexes=None):
+    if not palette_tables:
+        colors = numpy.arange(0x8000)
+        triple = (colors & 0x1f, (colors >> 5) & 0x1f, (colors >> 10) & 0x1f)
+        low = numpy.minimum(numpy.minimum(*triple[:2]), triple[2])
+        high = numpy.maximum(numpy.maximum(*triple[:2]), triple[2])
+        medium = sum(triple) - low - high
+        swapped, shifts = [], []
+        for swapcode in range(8):
+            red, green, blue = generate_swapfunc(swapcode)(triple)
+            swapped.append(red | (green << 5) | (blue << 10))
+            # shift_middle replaces the first component equal to the median
+            shifts.append(numpy.where(red == medium, 0,
+                                      numpy.where(green == medium, 5, 10)))
+        palette_tables.update(colors=colors, low=low, medium=medium,
+                              high=high, swapped=numpy.array(swapped),
+                              shifts=numpy.array(shifts))
+    if key is not None and key not in palette_tables:
+        palette_tables[key] = colors_to_indexes(palette_tables["colors"])
+    return palette_tables
+
+
+def get_palette_table(indexes, swapcodes, degree=None, colors=None):
+    # The palette transformer as a lookup table over `colors` (all 32768
+    # by default), with -1 for colors whose index has no swap code.
+    # shift_middle's float math is done for every (median, low or high)
+    # pair exactly as shift_middle does it, so the colors come out
+    # identical. With no swap codes at all (an empty base palette), every
+    # color is -1.
+    tables = get_palette_tables()
+    if colors is None:
+        colors = tables["colors"]
+    size = max(max(swapcodes, default=-1), indexes.max()) + 1
+    codes = numpy.full(size, -1)
+    for key, code in swapcodes.items():
+        codes[key] = code
+    codes = codes[indexes[colors]]
+    rows = numpy.maximum(codes, 0)
+    table = tables["swapped"][rows, colors]
+
+    if degree is not None:
+        value = tables["low"] if degree < 0 else tables["high"]
+        degree = abs(degree)
+        pairs = numpy.arange(32*32)
+        shifted = numpy.round((1 - (degree/90.0)) * (pairs >> 5) +
+                              (degree/90.0) * (pairs & 0x1f)).astype(int)
+        shifted = shifted[(tables["medium"][colors] << 5) | value[colors]]
+        shifts = tables["shifts"][rows, colors]
+        table = (table & ~(0x1f << shifts)) | (shifted << shifts)
+
+    table[codes < 0] = -1
+    return table
+
+
 def get_palette_transformer(use_luma=False, always=None, middle=True,
                             basepalette=None):
     def get_ratio(a, b):
@@ -295,6 +549,12 @@ def get_palette_transformer(use_luma=False, always=None, middle=True,
         else:
             return 9999
 
+    def get_ratios(a, b):
+        # get_ratio for arrays
+        ratios = numpy.maximum(a, b) / numpy.maximum(numpy.minimum(a, b), 1)
+        return numpy.where((a > 0) & (b > 0), ratios,
+                           numpy.where(abs(a-b) <= 1, 1.0, 9999))
+
     def color_to_components(color):
         blue = (color & 0x7c00) >> 10
         green = (color & 0x03e0) >> 5
@@ -328,6 +588,23 @@ def get_palette_transformer(use_luma=False, always=None, middle=True,
 
             return index
 
+        def colors_to_indexes(colors):
+            red, green, blue = color_to_components(colors)
+            a = red >= green
+            b = red >= blue
+            c = green >= blue
+            d = get_ratios(red, green) >= threshold
+            e = get_ratios(red, blue) >= threshold
+            f = get_ratios(green, blue) >= threshold
+
+            index = (d << 2) | (e << 1) | f
+            index |= ((a & ~d) << 5)
+            index |= ((b & ~e) << 4)
+            index |= ((c & ~f) << 3)
+
+            return index
+
+        indexkey = "hue"
         colordict = defaultdict(set)
         for color in basepalette:
             index = color_to_index(color)
@@ -394,6 +671,9 @@ def get_palette_transformer(use_luma=False, always=None, middle=True,
             index = red + green + blue
             return index
 
+        colors_to_indexes = color_to_index
+        indexkey = "luma"
+
         values = []
         for color in basepalette:
             index = color_to_index(color)
@@ -449,32 +729,64 @@ def get_palette_transformer(use_luma=False, always=None, middle=True,
         def color_to_index(color):
             return 0
 
+        def colors_to_indexes(colors):
+            return numpy.zeros_like(colors)
+        indexkey = "none"
+
         if always:
             swapmap[0] = random.randint(1, 7)
         else:
             swapmap[0] = random.randint(0, 7)
 
+    swapcodes = dict(swapmap)
     for key in swapmap:
         swapmap[key] = generate_swapfunc(swapmap[key])
 
     if middle:
         degree = utran.randint(-75, 75)
 
+    def transform_color(color):
+        index = color_to_index(color)
+        swapfunc = swapmap[index]
+        red, green, blue = color_to_components(color)
+        red, green, blue = swapfunc((red, green, blue))
+        if middle:
+            red, green, blue = shift_middle((red, green, blue), degree)
+        return components_to_color((red, green, blue))
+
+    # Nothing below uses the RNG, so the result for each color is fixed
+    # once the transformer is made. With numpy, the first call maps just
+    # the colors it is given, which is all most transformers are used
+    # for; a transformer that is called again maps the whole 15-bit
+    # color space into a lookup table and reuses it.
+    if numpy is not None:
+        indexes = get_palette_tables(indexkey, colors_to_indexes)[indexkey]
+    table, called = None, False
+
     def palette_transformer(raw_palette, single_bytes=False):
+        nonlocal table, called
         if single_bytes:
             raw_palette = list(zip(raw_palette, raw_palette[1:]))
             raw_palette = [p for (i, p) in enumerate(raw_palette) if not i % 2]
             raw_palette = [(b << 8) | a for (a, b) in raw_palette]
-        transformed = []
-        for color in raw_palette:
-            index = color_to_index(color)
-            swapfunc = swapmap[index]
-            red, green, blue = color_to_components(color)
-            red, green, blue = swapfunc((red, green, blue))
-            if middle:
-                red, green, blue = shift_middle((red, green, blue), degree)
-            color = components_to_color((red, green, blue))
-            transformed.append(color)
+        if numpy is not None:
+            colors = numpy.array(raw_palette, dtype=int) & 0x7FFF
+            if called and table is None:
+                table = get_palette_table(indexes, swapcodes,
+                                          degree if middle else None)
+            if table is None:
+                transformed = get_palette_table(
+                    indexes, swapcodes, degree if middle else None,
+                    colors=colors)
+            else:
+                transformed = table[colors]
+            called = True
+            if (transformed < 0).any():
+                raise KeyError(color_to_index(
+                    int(colors[transformed < 0][0])))
+            transformed = transformed.tolist()
+        else:
+            transformed = [transform_color(color) for color in raw_palette]
         if single_bytes:
             major = [p >> 8 for p in transformed]
             minor = [p & 0xFF for p in transformed]